@@ -23,6 +23,11 @@ QJsonObject JsonProtocol::calc_preview(QString index, uint width, uint height) {
     return construct_json("calc_preview", QJsonObject{{"index", index}, {"width", (int) width}, {"height", (int) height}});
 }
 
+QJsonObject JsonProtocol::calc_previews(QStringList indices, uint width, uint height) {
+    return construct_json("calc_previews",
+                          QJsonObject{{"indices", QJsonArray::fromStringList(indices)}, {"width", (int) width}, {"height", (int) height}});
+}
+
 QJsonObject JsonProtocol::calc_index(QString index) {
     return construct_json("calc_index", QJsonObject{{"index", index}});
 }
@@ -17,6 +17,7 @@ public:
     QJsonObject shutdown();
     QJsonObject import_gtiff(QString file, QString band);
     QJsonObject calc_preview(QString index, uint width, uint height);
+    QJsonObject calc_previews(QStringList indices, uint width, uint height);
     QJsonObject calc_index(QString index);
     QJsonObject set_satellite(QString satellite, QString proc_level);
     QJsonObject end_session();
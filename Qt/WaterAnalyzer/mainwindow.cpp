@@ -18,6 +18,7 @@ MainWindow::MainWindow(QWidget *parent)
 
     connect(&timer_status, &QTimer::timeout, [this]() { ui->lbl_status->clear(); });
     retries = 3;
+    preview_retries = 120;
     curr_try = 0;
 }
 
@@ -165,6 +166,18 @@ void MainWindow::process_get(QUrl endpoint, QHttpHeaders headers, QByteArray bod
         } else {
             self.result_p->set_preview(options.value("preview_type"), preview);
         }
+        if (headers.value("preview-final") == "0") {
+            ushort try_ = options.value("preview_try", "0").toUShort();
+            if (try_ < preview_retries) {
+                options.insert("preview_try", QString::number(try_ + 1));
+                QString url = endpoint.path() + "?id=" + QUrlQuery(endpoint).queryItemValue("id");
+                QTimer::singleShot(500, [this, url, options]() {
+                    send_request("resource", QJsonObject{{"result", QJsonObject{{"url", url}}}}, options);
+                });
+            } else {
+                append_log("info", "Не удалось дождаться уточнённого предпросмотра, показан грубый.");
+            }
+        }
     } else if (type == "index") {
         QString path = QFileDialog::getSaveFileName(this, "Сохранить файл GeoTiff", self.dir.path());
         if (path.isEmpty()) {
@@ -233,6 +246,16 @@ void MainWindow::process_post(QUrl endpoint, QHttpHeaders headers, QByteArray bo
         set_status_message(true, "Файл загружен");
     } else if (command == "calc_preview") {
         send_request("resource", QJsonDocument::fromJson(body).object(), options);
+    } else if (command == "calc_previews") {
+        QJsonObject urls = result["urls"].toObject();
+        for (const QString &index : urls.keys()) {
+            QMap<QString, QString> opts = {{"preview_type", get_type_by_index(index)}, {"scalebar", "1"}, {"mask", "0"}};
+            if (index == "nat_col") {
+                opts = {{"preview_type", "summary"}, {"scalebar", "0"}, {"mask", "1"}};
+            }
+            QJsonObject data = {{"result", QJsonObject{{"url", urls[index].toString()}}}};
+            send_request("resource", data, opts);
+        }
     } else if (command == "calc_index") {
         DATASET ds;
         ds.index = result["index"].toString();
@@ -648,16 +671,16 @@ void MainWindow::change_page(PAGE to) {
     }
     case PAGE::RESULT: {
         auto refresh_previews = [this]() {
-            uint width = self.result_p->get_preview_width();
-            uint height = self.result_p->get_preview_height();
+            uint        width = self.result_p->get_preview_width();
+            uint        height = self.result_p->get_preview_height();
+            QStringList indices;
             for (DATASET &ds : self.datasets) {
                 if (!ds.index.isEmpty()) {
-                    QMap<QString, QString> options = {{"preview_type", get_type_by_index(ds.index)}, {"scalebar", "1"}, {"mask", "0"}};
-                    send_request("command", proto.calc_preview(ds.index, width, height), options);
+                    indices.append(ds.index);
                 }
             }
-            QMap<QString, QString> options = {{"preview_type", "summary"}, {"scalebar", "0"}, {"mask", "1"}};
-            send_request("command", proto.calc_preview("nat_col", width, height), options);
+            indices.append("nat_col");
+            send_request("command", proto.calc_previews(indices, width, height));
             send_request("command", proto.generate_description("summary", "ru"));
         };
         auto export_index = [this](QString type) {
@@ -6,6 +6,7 @@
 #include <QNetworkAccessManager>
 #include <QNetworkReply>
 #include <QTimer>
+#include <QUrlQuery>
 #include "importpage.hpp"
 #include "jsonprotocol.hpp"
 #include "processpage.hpp"
@@ -70,7 +71,7 @@ private:
 
     Ui::MainWindow *ui;
     QTimer          timer_status;
-    ushort          retries, curr_try;
+    ushort          retries, curr_try, preview_retries;
 
     void       send_request(QString type, QJsonObject data, QMap<QString, QString> options = {});
     void       handle_error(QNetworkReply *response);
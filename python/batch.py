@@ -0,0 +1,349 @@
+# Headless batch processing of Landsat 8/9 scenes without the HTTP server.
+# Every scene directory (bands and an MTL file as delivered by USGS) is processed by 'GdalExecutor.execute' in a pool of worker processes; calculated indices are written
+# as tiled, compressed GeoTiffs to OUTPUT/<scene>/<index>.tif and their statistics to OUTPUT/stats.csv. A scene is complete when OUTPUT/<scene>/batch.json is written,
+# complete scenes are skipped when the batch is run again, so an interrupted batch is resumed by running the same command.
+# Run from this directory:
+#   python batch.py '/data/landsat/LC0*_L1TP_*' --indices ndwi water_mask -o /data/out --workers 8 --memory-limit 6000
+
+import argparse
+import csv
+import glob
+import json
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from osgeo import gdal
+from json_proto import Protocol
+from gdal_executor import GdalExecutor, DatasetManager, AdmissionController
+
+gdal.UseExceptions()
+
+SATELLITE = 'Landsat 8/9'
+# file name suffixes of bands by processing level, matched case-insensitively
+BAND_SUFFIXES = {
+    'L1TP': {'1': '_B1.TIF', '2': '_B2.TIF', '3': '_B3.TIF', '4': '_B4.TIF', '5': '_B5.TIF', '6': '_B6.TIF', '7': '_B7.TIF', '10': '_B10.TIF', 'QA_PIXEL': '_QA_PIXEL.TIF'},
+    'L2SP': {'1': '_SR_B1.TIF', '2': '_SR_B2.TIF', '3': '_SR_B3.TIF', '4': '_SR_B4.TIF', '5': '_SR_B5.TIF', '6': '_SR_B6.TIF', '7': '_SR_B7.TIF', '10': '_ST_B10.TIF', 'QA_PIXEL': '_QA_PIXEL.TIF'}
+}
+DEFAULT_INDICES = ('ndwi', 'water_mask')
+MARKER_FILE = 'batch.json'
+STATS_FILE = 'stats.csv'
+STATS_COLUMNS = ('scene', 'proc_level', 'index', 'file', 'min', 'max', 'mean', 'stdev', 'ph_unit')
+# share of the per-worker memory limit given to the GDAL block cache
+CACHE_SHARE = 8
+# seconds between samples of the resident memory of a worker, see '_MemoryWatchdog'
+WATCHDOG_INTERVAL = 0.1
+_proto = None
+_executor = None
+_watchdog = None
+
+def find_scene(directory: str) -> dict:
+    """Finds the MTL file and band files of the scene in 'directory'. Returns {'name', 'dir', 'proc_level', 'mtl', 'bands': {band: file}}.
+    Raises ValueError if the directory is not a supported scene."""
+
+    mtl = sorted(glob.glob(os.path.join(glob.escape(directory), '*_MTL.txt')))
+    if len(mtl) != 1:
+        raise ValueError(f"expected one *_MTL.txt file in '{directory}', found {len(mtl)}")
+    mtl = mtl[0]
+    parts = os.path.basename(mtl).split('_')
+    proc_level = parts[1] if len(parts) > 1 else None
+    if proc_level not in BAND_SUFFIXES:
+        raise ValueError(f"unsupported processing level of '{mtl}', supported are {tuple(BAND_SUFFIXES)}")
+
+    files = os.listdir(directory)
+    bands = {}
+    for band, suffix in BAND_SUFFIXES[proc_level].items():
+        for file in files:
+            upper = file.upper()
+            # '_B1.TIF' must not match '_SR_B1.TIF' of another level
+            if upper.endswith(suffix) and (proc_level == 'L2SP' or '_SR_' not in upper and '_ST_' not in upper):
+                bands[band] = os.path.join(directory, file)
+                break
+    return {
+        'name': os.path.basename(os.path.normpath(directory)),
+        'dir': directory,
+        'proc_level': proc_level,
+        'mtl': mtl,
+        'bands': bands
+    }
+
+def find_scenes(patterns: list[str], list_file: str=None) -> (list[dict], list[str]):
+    """Expands 'patterns' (directories or glob patterns) and the directories listed in 'list_file', one per line. Returns (scenes, errors) sorted by scene name; scenes are unique by name."""
+
+    directories = []
+    if list_file is not None:
+        with open(list_file, 'r', encoding='utf-8') as f:
+            patterns = patterns + [l.strip() for l in f if l.strip() != '' and not l.startswith('#')]
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        directories += [d for d in matches if os.path.isdir(d)]
+        if len(matches) == 0 or not any(os.path.isdir(d) for d in matches):
+            print(f"No scene directories match '{pattern}'")
+
+    scenes, errors = {}, []
+    for directory in dict.fromkeys(directories):
+        try:
+            scene = find_scene(directory)
+        except (OSError, ValueError) as e:
+            errors.append(str(e))
+            continue
+        if scene['name'] in scenes:
+            errors.append(f"scene '{scene['name']}' is given twice: '{scenes[scene['name']]['dir']}' and '{directory}'")
+            continue
+        scenes[scene['name']] = scene
+    return [scenes[name] for name in sorted(scenes)], errors
+
+class _MemoryWatchdog:
+    """Samples resident memory of the worker process every WATCHDOG_INTERVAL seconds on a daemon thread and remembers the peak since the last 'reset'."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._peak = 0
+        self._lock = threading.Lock()
+        threading.Thread(target=self._run, name='memory-watchdog', daemon=True).start()
+
+    def _run(self) -> None:
+        while True:
+            rss = AdmissionController._rss()
+            if rss is not None:
+                with self._lock:
+                    self._peak = max(self._peak, rss)
+            time.sleep(WATCHDOG_INTERVAL)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._peak = 0
+
+    def check(self) -> None:
+        """Raises MemoryError if resident memory exceeded the limit since the last 'reset'."""
+
+        with self._lock:
+            peak = self._peak
+        if peak > self.limit:
+            raise MemoryError(f'resident memory of the worker reached {peak // (1024 * 1024)} MB, over --memory-limit of {self.limit // (1024 * 1024)} MB')
+
+def _init_worker(memory_limit: int | None, gdal_threads: int) -> None:
+    """Creates the executor of a worker process. 'memory_limit' in bytes is the executor's memory budget, see 'AdmissionController', and sizes the GDAL block cache.
+    The budget is strict: an operation estimated to need more than the whole budget is rejected. Resident memory is watched as well, and a scene fails at its next request once the worker went over the limit, see '_MemoryWatchdog'.
+    The address space is not capped: it counts reserved but unused memory (thread stacks, malloc arenas, mapped libraries) and would fail allocations long before the resident memory reaches the budget."""
+
+    global _proto, _executor, _watchdog
+    # settings the user did not give are sized for one worker out of many, see 'GdalExecutor._tune_gdal'
+    os.environ.setdefault('GDAL_NUM_THREADS', str(gdal_threads))
+    if memory_limit is not None:
+        os.environ.setdefault('GDAL_CACHEMAX', str(max(16, memory_limit // CACHE_SHARE // (1024 * 1024))))
+        os.environ['MEMORY_BUDGET_MB'] = str(memory_limit // (1024 * 1024))
+        os.environ['MEMORY_BUDGET_STRICT'] = '1'
+        _watchdog = _MemoryWatchdog(memory_limit)
+    os.environ.pop('PREFETCH_INDICES', None)
+    os.environ.pop('PREFETCH_PREVIEWS', None)
+    _proto = Protocol()
+    _executor = GdalExecutor(_proto)
+
+def _request(operation: str, **parameters) -> dict:
+    request = {
+        'proto_version': _proto.get_version(),
+        'server_version': _executor.get_version(),
+        'id': 0,
+        'operation': operation,
+        'parameters': parameters
+    }
+    response = _proto.validate(request)
+    if response['status'] != 0:
+        return response
+    return _executor.execute(request)
+
+def _check(response: dict, what: str) -> dict:
+    if _watchdog is not None:
+        _watchdog.check()
+    if response['status'] != 0:
+        raise RuntimeError(f"{what}: {response['status']} {response['result'].get('error', '')}")
+    return response['result']
+
+def _write_index(url: int, index: str, stats: dict, file: str, options: list[str]) -> None:
+    """Writes calculated index 'url' to 'file' as a GeoTiff with 'options'. The file appears only when completely written."""
+
+    dataset = _executor.ds_man.get(url).dataset
+    tmp = file + '.tmp'
+    predictor = 'PREDICTOR=3' if dataset.GetRasterBand(1).DataType in (gdal.GDT_Float32, gdal.GDT_Float64) else 'PREDICTOR=2'
+    out = gdal.GetDriverByName('GTiff').CreateCopy(tmp, dataset, strict=0, options=options + [predictor])
+    band = out.GetRasterBand(1)
+    band.SetStatistics(stats['min'], stats['max'], stats['mean'], stats['stdev'])
+    band.SetDescription(index)
+    out.FlushCache()
+    out = None
+    os.replace(tmp, file)
+
+def process_scene(scene: dict, indices: list[str], output: str) -> dict:
+    """Processes 'scene' from 'find_scene' in a worker process: imports bands and calibration, calculates 'indices' and writes them to 'output'/<scene>.
+    Returns the contents of the scene's MARKER_FILE, or {'scene', 'error'} on failure. The session is ended afterwards."""
+
+    start = time.perf_counter()
+    directory = os.path.join(output, scene['name'])
+    options = [o for o in DatasetManager.SNAPSHOT_GTIFF_OPTIONS if not o.startswith('NUM_THREADS=')] + [f"NUM_THREADS={os.environ.get('GDAL_NUM_THREADS', '1')}"]
+    if _watchdog is not None:
+        _watchdog.reset()
+    try:
+        os.makedirs(directory, exist_ok=True)
+        _check(_request('set_satellite', satellite=SATELLITE, proc_level=scene['proc_level']), 'set_satellite')
+        for band, file in scene['bands'].items():
+            _check(_request('import_gtiff', file=file, band=band), f'import_gtiff {file}')
+        if scene['proc_level'] == 'L1TP':
+            _check(_request('import_metafile', file=scene['mtl']), f"import_metafile {scene['mtl']}")
+
+        results = {}
+        for index in indices:
+            result = _check(_request('calc_index', index=index), f'calc_index {index}')
+            info = result['info']
+            stats = {key: info[key] for key in ('min', 'max', 'mean', 'stdev', 'ph_unit')}
+            file = f'{index}.tif'
+            _write_index(result['url'], index, stats, os.path.join(directory, file), options)
+            results[index] = {'file': file} | stats
+        if _watchdog is not None:
+            _watchdog.check()
+
+        marker = {
+            'scene': scene['name'],
+            'dir': scene['dir'],
+            'proc_level': scene['proc_level'],
+            'indices': results,
+            'seconds': time.perf_counter() - start
+        }
+        with open(os.path.join(directory, MARKER_FILE + '.tmp'), 'w', encoding='utf-8') as f:
+            json.dump(marker, f, indent=4)
+        os.replace(os.path.join(directory, MARKER_FILE + '.tmp'), os.path.join(directory, MARKER_FILE))
+        return marker
+    except (RuntimeError, OSError, MemoryError) as e:
+        return {'scene': scene['name'], 'error': str(e) or type(e).__name__}
+    finally:
+        _request('end_session')
+
+def load_marker(output: str, scene: dict, indices: list[str]) -> dict | None:
+    """Returns the MARKER_FILE of 'scene' if the scene is complete for 'indices' and all its files exist, None otherwise."""
+
+    directory = os.path.join(output, scene['name'])
+    try:
+        with open(os.path.join(directory, MARKER_FILE), 'r', encoding='utf-8') as f:
+            marker = json.load(f)
+        if all(index in marker['indices'] and os.path.isfile(os.path.join(directory, marker['indices'][index]['file'])) for index in indices):
+            return marker
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return None
+
+def _rows(marker: dict, indices: list[str]) -> list[dict]:
+    return [{
+        'scene': marker['scene'],
+        'proc_level': marker['proc_level'],
+        'index': index,
+        'file': os.path.join(marker['scene'], marker['indices'][index]['file'])
+    } | {key: marker['indices'][index][key] for key in STATS_COLUMNS[4:]} for index in indices]
+
+def order_indices(indices: list[str]) -> list[str]:
+    """Removes duplicates and moves 'water_mask' after the water extraction indices it is calculated from."""
+
+    indices = list(dict.fromkeys(indices))
+    if 'water_mask' in indices:
+        indices.remove('water_mask')
+        indices.append('water_mask')
+    return indices
+
+def run_batch(scenes: list[dict], indices: list[str], output: str, workers: int, memory_limit_mb: int=None, force: bool=False) -> (list[dict], list[dict]):
+    """Calculates 'indices' (in order, see 'order_indices') of 'scenes' from 'find_scenes' into 'output' with 'workers' processes and writes STATS_FILE. Complete scenes are skipped unless 'force' is set.
+    Returns (markers of complete scenes, failures as {'scene', 'error'}). Exits on Ctrl+C."""
+
+    os.makedirs(output, exist_ok=True)
+    done, pending = [], []
+    for scene in scenes:
+        marker = None if force else load_marker(output, scene, indices)
+        if marker is not None:
+            done.append(marker)
+        else:
+            pending.append(scene)
+    workers = min(workers, max(1, len(pending)))
+    print(f'{len(scenes)} scenes: {len(done)} complete, {len(pending)} to process with {workers} workers')
+
+    # the CSV is rebuilt from complete scenes, so rows of interrupted scenes never appear in it
+    stats = open(os.path.join(output, STATS_FILE), 'w', encoding='utf-8', newline='')
+    writer = csv.DictWriter(stats, STATS_COLUMNS)
+    writer.writeheader()
+    for marker in done:
+        writer.writerows(_rows(marker, indices))
+    stats.flush()
+    if len(pending) == 0:
+        stats.close()
+        return done, []
+
+    failed, processed = [], 0
+    start = time.perf_counter()
+    memory_limit = memory_limit_mb * 1024 * 1024 if memory_limit_mb is not None else None
+    gdal_threads = max(1, (os.cpu_count() or 1) // workers)
+    # GDAL is not safe to fork with open datasets or running threads, so workers are spawned
+    pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'), initializer=_init_worker, initargs=(memory_limit, gdal_threads))
+    with stats:
+        try:
+            futures = {pool.submit(process_scene, scene, indices, output): scene for scene in pending}
+            for i, future in enumerate(as_completed(futures)):
+                try:
+                    result = future.result()
+                except BrokenProcessPool:
+                    raise
+                except Exception as e:
+                    # an error 'process_scene' does not expect fails only its scene
+                    result = {'scene': futures[future]['name'], 'error': f'{type(e).__name__}: {e}'}
+                if 'error' in result:
+                    failed.append(result)
+                    print(f"[{i + 1}/{len(pending)}] {result['scene']}: failed: {result['error']}")
+                    continue
+                writer.writerows(_rows(result, indices))
+                stats.flush()
+                done.append(result)
+                processed += 1
+                print(f"[{i + 1}/{len(pending)}] {result['scene']}: done in {result['seconds']:.1f} s")
+        except BrokenProcessPool:
+            # a worker was killed, e.g. by the OOM killer; finished scenes are kept
+            print('A worker process died, the batch is stopped. Run the same command again to resume, with a lower --memory-limit or fewer --workers.')
+            failed.append({'scene': None, 'error': 'worker process died'})
+        except KeyboardInterrupt:
+            print('Interrupted. Run the same command again to resume.')
+            raise SystemExit(130)
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    elapsed = time.perf_counter() - start
+    print(f"Processed {processed} scenes in {elapsed:.1f} s ({processed / elapsed * 3600 if elapsed > 0 else 0:.1f} scenes/hour), {len(failed)} failed. Statistics written to {os.path.join(output, STATS_FILE)}")
+    return done, failed
+
+def main():
+    supported = tuple(i for i in GdalExecutor.SUPPORTED_INDICES if i != 'test')
+    parser = argparse.ArgumentParser(description='Calculate indices of many Landsat 8/9 scenes in parallel.')
+    parser.add_argument('scenes', nargs='*', help='scene directories or glob patterns of them (quote patterns to keep them from the shell)')
+    parser.add_argument('--list', default=None, help='file with scene directories or glob patterns, one per line')
+    parser.add_argument('--indices', nargs='+', default=list(DEFAULT_INDICES), choices=supported, help=f"indices to calculate, default: {' '.join(DEFAULT_INDICES)}")
+    parser.add_argument('-o', '--output', required=True, help='output directory')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='number of worker processes, default: number of CPUs')
+    parser.add_argument('--memory-limit', type=int, default=None, help='memory limit of a worker process in MB: operations estimated above it are rejected and a scene fails once its worker exceeds it (checked between requests, so leave headroom)')
+    parser.add_argument('--force', action='store_true', help='process complete scenes again instead of resuming')
+    args = parser.parse_args()
+
+    indices = order_indices(args.indices)
+    if 'water_mask' in indices and not any(i in indices for i in GdalExecutor.WATER_EXTRACTION_INDICES):
+        parser.error(f"'water_mask' needs one of the water extraction indices: {' '.join(GdalExecutor.WATER_EXTRACTION_INDICES)}")
+    if args.workers <= 0:
+        parser.error('--workers must be > 0')
+    if args.memory_limit is not None and args.memory_limit <= 0:
+        parser.error('--memory-limit must be > 0')
+    if len(args.scenes) == 0 and args.list is None:
+        parser.error('no scenes given')
+
+    scenes, errors = find_scenes(args.scenes, args.list)
+    for error in errors:
+        print(f'Skipped: {error}')
+    _, failed = run_batch(scenes, indices, args.output, args.workers, args.memory_limit, args.force)
+    if len(failed) > 0 or len(errors) > 0:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
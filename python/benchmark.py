@@ -0,0 +1,294 @@
+# Benchmark of the server on synthetic Landsat 8/9 scenes.
+# Generates band GeoTiffs and an MTL file, drives 'GdalExecutor.execute' and the resource endpoints the same way the client does and writes wall time, peak RSS and throughput of every stage to a JSON report.
+# Run from this directory:
+#   python benchmark.py --sizes 2000x2000 7000x7000 --levels L1TP L2SP --repeat 3 -o report.json
+
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import tempfile
+import time
+import numpy as np
+from osgeo import gdal, osr
+from server import server, proto, executor
+
+gdal.UseExceptions()
+
+BANDS = ('1', '2', '3', '4', '5', '6', '7', '10', 'QA_PIXEL')
+PIXEL_SIZE = 30
+REFINE_TIMEOUT = 600
+EPSG = 32637
+# QA_PIXEL values of Collection 2: clear land, clear water and high confidence cloud
+QA_CLEAR, QA_WATER, QA_CLOUD = 21824, 21952, 22280
+# typical DN of Level 1 bands over land and water, band 10 holds brightness of a ~20 °C surface
+L1_LAND = {'1': 9500, '2': 8800, '3': 8600, '4': 8300, '5': 16000, '6': 14000, '7': 11000, '10': 30000}
+L1_WATER = {'1': 9800, '2': 9200, '3': 9400, '4': 8000, '5': 7200, '6': 6600, '7': 6500, '10': 29000}
+# typical DN of Level 2 surface reflectance (scale 2.75e-05, offset -0.2) and surface temperature (scale 0.00341802, offset 149) bands
+L2_LAND = {'1': 8500, '2': 9000, '3': 10500, '4': 11000, '5': 20000, '6': 17000, '7': 13000, '10': 42000}
+L2_WATER = {'1': 9200, '2': 9800, '3': 11000, '4': 8600, '5': 7900, '6': 7600, '7': 7500, '10': 41000}
+
+def _scene_masks(width: int, height: int, rng: np.random.Generator) -> (np.typing.NDArray[bool], np.typing.NDArray[bool], np.typing.NDArray[bool]):
+    """Returns (valid, water, cloud) masks of a synthetic scene: a rotated collar of NoData around the image, a few lakes of different size and a cloud blob."""
+
+    y, x = np.ogrid[:height, :width]
+    u, v = x / width - 0.5, y / height - 0.5
+    valid = (np.abs(u * 0.97 + v * 0.24) < 0.44) & (np.abs(v * 0.97 - u * 0.24) < 0.44)
+    water = np.zeros((height, width), dtype=bool)
+    for cx, cy, rx, ry in rng.uniform((-0.3, -0.3, 0.01, 0.01), (0.3, 0.3, 0.12, 0.08), (12, 4)):
+        water |= ((u - cx) / rx) ** 2 + ((v - cy) / ry) ** 2 < 1
+    cloud = ((u + 0.2) / 0.1) ** 2 + ((v - 0.25) / 0.06) ** 2 < 1
+    return valid, water, cloud
+
+def generate_scene(directory: str, proc_level: str, width: int, height: int, seed: int=0) -> dict:
+    """Writes band GeoTiffs and an MTL file of a synthetic Landsat 8/9 'proc_level' scene of 'width' x 'height' pixels to 'directory'.
+    Bands are tiled and DEFLATE compressed UInt16 rasters like Collection 2 products. Returns {'bands': {band: file}, 'mtl': file}."""
+
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    valid, water, cloud = _scene_masks(width, height, rng)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(EPSG)
+    driver = gdal.GetDriverByName('GTiff')
+    land_dn, water_dn = (L1_LAND, L1_WATER) if proc_level == 'L1TP' else (L2_LAND, L2_WATER)
+    prefix = 'LC09_L1TP_179021_20250610_20250610_02_T1' if proc_level == 'L1TP' else 'LC09_L2SP_179021_20250610_20250611_02_T1'
+
+    files = {}
+    for band in BANDS:
+        if band == 'QA_PIXEL':
+            data = np.where(water, QA_WATER, QA_CLEAR).astype(np.uint16)
+            data[cloud] = QA_CLOUD
+            data[~valid] = 1
+            name = f'{prefix}_QA_PIXEL.TIF'
+        else:
+            noise = rng.normal(0, 0.03, (height, width)).astype(np.float32)
+            data = np.where(water, water_dn[band], land_dn[band]) * (1 + noise)
+            data[cloud] = 45000
+            data = np.clip(data, 1, 65535).astype(np.uint16)
+            data[~valid] = 0
+            if proc_level == 'L1TP':
+                name = f'{prefix}_B{band}.TIF'
+            else:
+                name = f'{prefix}_ST_B10.TIF' if band == '10' else f'{prefix}_SR_B{band}.TIF'
+        file = os.path.join(directory, name)
+        ds = driver.Create(file, width, height, 1, gdal.GDT_UInt16, ['TILED=YES', 'COMPRESS=DEFLATE', 'BLOCKXSIZE=256', 'BLOCKYSIZE=256'])
+        ds.SetGeoTransform((500000, PIXEL_SIZE, 0, 6300000, 0, -PIXEL_SIZE))
+        ds.SetProjection(srs.ExportToWkt())
+        ds.GetRasterBand(1).WriteArray(data)
+        ds = None
+        files[band] = file
+
+    mtl = os.path.join(directory, f'{prefix}_MTL.txt')
+    with open(mtl, 'w', encoding='utf-8') as f:
+        f.write('GROUP = LANDSAT_METADATA_FILE\n')
+        f.write('  GROUP = IMAGE_ATTRIBUTES\n    SUN_ELEVATION = 55.12345678\n    EARTH_SUN_DISTANCE = 1.0153254\n  END_GROUP = IMAGE_ATTRIBUTES\n')
+        if proc_level == 'L1TP':
+            f.write('  GROUP = LEVEL1_MIN_MAX_RADIANCE\n')
+            for band in BANDS[:7]:
+                f.write(f'    RADIANCE_MAXIMUM_BAND_{band} = 700.00000\n    RADIANCE_MINIMUM_BAND_{band} = -57.80000\n')
+            f.write('  END_GROUP = LEVEL1_MIN_MAX_RADIANCE\n')
+            f.write('  GROUP = LEVEL1_MIN_MAX_REFLECTANCE\n')
+            for band in BANDS[:7]:
+                f.write(f'    REFLECTANCE_MAXIMUM_BAND_{band} = 1.210700\n    REFLECTANCE_MINIMUM_BAND_{band} = -0.099980\n')
+            f.write('  END_GROUP = LEVEL1_MIN_MAX_REFLECTANCE\n')
+            f.write('  GROUP = LEVEL1_RADIOMETRIC_RESCALING\n')
+            for band in BANDS[:8]:
+                mult, add = (3.3420E-04, 0.10000) if band == '10' else (1.1563E-02, -57.81370)
+                f.write(f'    RADIANCE_MULT_BAND_{band} = {mult:.4E}\n    RADIANCE_ADD_BAND_{band} = {add:.5f}\n')
+            f.write('  END_GROUP = LEVEL1_RADIOMETRIC_RESCALING\n')
+            f.write('  GROUP = LEVEL1_THERMAL_CONSTANTS\n    K1_CONSTANT_BAND_10 = 774.8853\n    K2_CONSTANT_BAND_10 = 1321.0789\n  END_GROUP = LEVEL1_THERMAL_CONSTANTS\n')
+        f.write('END_GROUP = LANDSAT_METADATA_FILE\nEND\n')
+    return {'bands': files, 'mtl': mtl}
+
+def _rss() -> dict:
+    """Returns the current and the peak resident set size of the process in bytes. The current size is only known on Linux."""
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak = peak if platform.system() == 'Darwin' else peak * 1024
+    current = None
+    try:
+        with open('/proc/self/statm') as f:
+            current = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        pass
+    return {'rss': current, 'peak_rss': peak}
+
+class Run:
+    """Sends requests to the executor and the resource endpoints and records a measurement of every stage."""
+
+    def __init__(self):
+        self.stages = []
+        self._id = 0
+        self._client = server.test_client()
+
+    def request(self, operation: str, **parameters) -> dict:
+        request = {
+            'proto_version': proto.get_version(),
+            'server_version': executor.get_version(),
+            'id': self._id,
+            'operation': operation,
+            'parameters': parameters
+        }
+        self._id += 1
+        response = proto.validate(request)
+        if response['status'] != 0:
+            return response
+        return executor.execute(request)
+
+    def get(self, url: str, accept: str) -> 'TestResponse':
+        return self._client.get(url, headers={'Accept': accept, 'Protocol-Version': proto.get_version(), 'Request-ID': '0'})
+
+    def measure(self, stage: str, func: 'Callable[[], tuple[int, int, int]]') -> dict:
+        """Runs 'func' that returns (status, processed pixels, processed bytes) and records its wall time, memory and throughput as 'stage'."""
+
+        start = time.perf_counter()
+        status, pixels, bytes_ = func()
+        elapsed = time.perf_counter() - start
+        record = {
+            'stage': stage,
+            'status': status,
+            'seconds': elapsed,
+            'megapixels_per_second': pixels / elapsed / 1e6 if pixels and elapsed > 0 else None,
+            'megabytes_per_second': bytes_ / elapsed / 1e6 if bytes_ and elapsed > 0 else None,
+            'bytes': bytes_
+        } | _rss()
+        self.stages.append(record)
+        return record
+
+def run_scene(scene: dict, proc_level: str, width: int, height: int, preview_size: int) -> list[dict]:
+    """Processes 'scene' from 'generate_scene' the way the client does and returns measurements of every stage. The session is ended afterwards."""
+
+    run = Run()
+    pixels = width * height
+    run.measure('set_satellite', lambda: (run.request('set_satellite', satellite='Landsat 8/9', proc_level=proc_level)['status'], 0, 0))
+    for band, file in scene['bands'].items():
+        run.measure(f'import_gtiff:{band}', lambda: (run.request('import_gtiff', file=file, band=band)['status'], 0, os.path.getsize(file)))
+    if proc_level == 'L1TP':
+        run.measure('import_metafile', lambda: (run.request('import_metafile', file=scene['mtl'])['status'], 0, 0))
+
+    # the water mask needs a water extraction index first
+    indices = [i for i in executor.get_supported_indices() if i != 'water_mask'] + ['water_mask']
+    urls = {}
+    for index in indices:
+        def _calc_index():
+            response = run.request('calc_index', index=index)
+            if response['status'] == 0:
+                urls[index] = response['result']['url']
+            return response['status'], pixels, 0
+        run.measure(f'calc_index:{index}', _calc_index)
+
+    previews = ['nat_col'] + list(urls)
+    pv_urls = {}
+    def _calc_previews():
+        response = run.request('calc_previews', indices=previews, width=preview_size, height=preview_size)
+        if response['status'] == 0:
+            pv_urls.update(response['result']['urls'])
+        return response['status'], pixels * len(previews), 0
+    run.measure('calc_previews', _calc_previews)
+    def _refine_previews():
+        # large previews are refined in the background, wait for all of them to become final
+        deadline = time.perf_counter() + REFINE_TIMEOUT
+        while not all(executor.pv_man.get(id_).final for id_ in pv_urls.values()):
+            if time.perf_counter() > deadline:
+                return -1, 0, 0
+            time.sleep(0.01)
+        return 0, pixels * len(pv_urls), 0
+    run.measure('refine_previews', _refine_previews)
+
+    for index, id_ in pv_urls.items():
+        for accept in ('image/png', 'image/webp'):
+            def _get_preview():
+                response = run.get(f'/resource/preview?id={id_}&sb=0&mask=0', accept)
+                return response.status_code, 0, len(response.get_data())
+            run.measure(f'get_preview:{index}:{accept}', _get_preview)
+    for index, id_ in urls.items():
+        def _get_index():
+            response = run.get(f'/resource/index?id={id_}', 'image/tiff')
+            return response.status_code, pixels, len(response.get_data())
+        run.measure(f'get_index:{index}', _get_index)
+
+    run.measure('end_session', lambda: (run.request('end_session')['status'], 0, 0))
+    return run.stages
+
+def _summary(runs: list[list[dict]]) -> list[dict]:
+    """Combines measurements of repeated runs stage by stage: minimum and median wall time, throughput of the median run and the highest peak RSS."""
+
+    ret = []
+    for stages in zip(*runs):
+        seconds = [s['seconds'] for s in stages]
+        median = sorted(stages, key=lambda s: s['seconds'])[len(stages) // 2]
+        ret.append({
+            'stage': stages[0]['stage'],
+            'status': [s['status'] for s in stages],
+            'min_seconds': min(seconds),
+            'median_seconds': statistics.median(seconds),
+            'megapixels_per_second': median['megapixels_per_second'],
+            'megabytes_per_second': median['megabytes_per_second'],
+            'bytes': median['bytes'],
+            'peak_rss': max(s['peak_rss'] for s in stages)
+        })
+    return ret
+
+def _commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the server on synthetic Landsat 8/9 scenes.')
+    parser.add_argument('--sizes', nargs='+', default=['2000x2000'], help='scene sizes as WIDTHxHEIGHT')
+    parser.add_argument('--levels', nargs='+', default=['L1TP', 'L2SP'], choices=['L1TP', 'L2SP'], help='processing levels')
+    parser.add_argument('--repeat', type=int, default=1, help='number of runs of every scene')
+    parser.add_argument('--preview-size', type=int, default=1024, help='requested preview width and height')
+    parser.add_argument('--workdir', default=None, help='directory for generated scenes, a temporary one is used and removed if not set')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', default='benchmark.json', help='JSON report file')
+    args = parser.parse_args()
+
+    report = {
+        'commit': _commit(),
+        'server_version': executor.get_version(),
+        'python': platform.python_version(),
+        'gdal': gdal.__version__,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'scenes': []
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        workdir = args.workdir if args.workdir is not None else tmp
+        for size in args.sizes:
+            width, height = (int(s) for s in size.lower().split('x'))
+            for level in args.levels:
+                directory = os.path.join(workdir, f'{level}_{width}x{height}')
+                start = time.perf_counter()
+                scene = generate_scene(directory, level, width, height, args.seed)
+                generated = time.perf_counter() - start
+                print(f'{level} {width}x{height}: generated in {generated:.1f} s')
+                runs = []
+                for i in range(args.repeat):
+                    stages = run_scene(scene, level, width, height, args.preview_size)
+                    total = sum(s['seconds'] for s in stages)
+                    print(f'{level} {width}x{height}: run {i + 1}/{args.repeat} took {total:.1f} s')
+                    runs.append(stages)
+                report['scenes'].append({
+                    'proc_level': level,
+                    'width': width,
+                    'height': height,
+                    'generation_seconds': generated,
+                    'total_seconds': statistics.median(sum(s['seconds'] for s in stages) for stages in runs),
+                    'stages': _summary(runs),
+                    'runs': runs
+                })
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=4)
+    print(f'Report written to {args.output}')
+
+if __name__ == '__main__':
+    main()
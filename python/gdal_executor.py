@@ -1,66 +1,519 @@
-from math import isclose
+from math import isclose, floor, ceil
 from time import sleep
+import os, time, shutil, tempfile
 import threading
-from osgeo import gdal
+import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from osgeo import gdal, ogr, osr
 import numpy as np
+from PIL import Image
 import index_calculator as indcal
+import timing
+import metrics
 gdal.UseExceptions()
 
 class Preview:
-    def __init__(self, array: np.ndarray, index: str):
-        self.array = array
+    def __init__(self, array: np.ndarray, index: str, req_width: int=None, req_height: int=None, alpha: np.typing.NDArray[bool]=None, final: bool=True):
+        """'array' is an 8 bit image of shape (height, width) for grayscale previews or (height, width, 3) for RGB ones.
+        'alpha' is a boolean array of shape (height, width) where False=transparent. It is stored bit-packed. None means the preview is opaque.
+        'final' is False for a coarse preview that is being refined to the requested size."""
+
+        self.array = np.ascontiguousarray(array, dtype=np.uint8)
+        self.alpha = np.packbits(alpha, axis=None) if alpha is not None else None
         self.index = index
         self.width = array.shape[1]
         self.height = array.shape[0]
+        self.req_width = req_width if req_width is not None else self.width
+        self.req_height = req_height if req_height is not None else self.height
+        self.nbytes = self.array.nbytes + (self.alpha.nbytes if self.alpha is not None else 0)
+        self.final = final
+
+    def get_alpha(self) -> np.typing.NDArray[bool]:
+        """Returns the unpacked alpha mask where False=transparent."""
+
+        if self.alpha is None:
+            return np.ones((self.height, self.width), dtype=np.bool)
+        return np.unpackbits(self.alpha, count=self.width * self.height).reshape(self.height, self.width).view(np.bool)
+
+    def image(self, colormap: str=None, normalize_brightness: bool=False) -> Image.Image:
+        """Composes the preview into a PIL image of 'LA' mode for grayscale previews or 'RGBA' mode for RGB ones.
+        If 'colormap' is one of index_calculator.COLORMAPS, a grayscale preview is colorized with it and an 'RGBA' image is returned.
+        If 'normalize_brightness' is True, a grayscale preview is scaled by the gain of its mean brightness before colorizing, see index_calculator.normalize_brightness. RGB previews are normalized when rendered."""
+
+        valid = self.get_alpha()
+        alpha = valid.view(np.uint8) * np.uint8(255)
+        array = self.array
+        if normalize_brightness and array.ndim == 2:
+            array = indcal.normalize_brightness(array, valid)
+        if colormap is not None and array.ndim == 2:
+            return Image.fromarray(np.dstack((indcal.colormap_lut(colormap)[array], alpha)))
+        return Image.fromarray(np.dstack((array, alpha)))
+
+class PreviewBusyError(Exception):
+    """Raised by a preview renderer when an evicted preview cannot be regenerated because memory is not available. 'retry_after' is the number of seconds after which the client should retry."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f'not enough memory to regenerate the preview, retry after {retry_after} s')
+        self.retry_after = retry_after
 
 class PreviewManager:
-    def __init__(self):
+    DEFAULT_BUDGET = 256 * 1024 * 1024
+
+    def __init__(self, renderer: 'Callable[[str, int, int], tuple[np.ndarray, np.ndarray] | None]'=None, budget: int=DEFAULT_BUDGET):
+        """'renderer' is called as renderer(index, width, height) to regenerate an evicted preview and must return its (array, alpha) or None on failure. It may raise 'PreviewBusyError', which 'get' passes to the caller.
+        'budget' is the maximum number of bytes held by preview arrays. When exceeded, arrays of least recently used previews are evicted, while their ids stay valid."""
+
         self._previews = {}
+        self._evicted = {}
+        self._keys = {}
+        self._by_index = {}
+        self._lru = {}
+        self._renderer = renderer
+        self._budget = budget
+        self._bytes = 0
+        self._evictions = 0
+        self._regenerations = 0
         self._counter = 0
         self._lock = threading.Lock()
 
-    def add(self, array: np.ndarray, index: str) -> int:
-        """Stores 'array' referring to a preview image and returns its id. The array must be of shape (height, width, channels).
-        'index' refers to the index for which the preview was created. index='nat_col' is for natural color."""
+    def _store(self, id_: int, pv: Preview) -> None:
+        """Makes 'pv' resident and evicts other previews if the budget is exceeded. Must be called with the lock held."""
+
+        self._previews[id_] = pv
+        self._by_index.setdefault(pv.index, set()).add(id_)
+        self._lru[id_] = None
+        self._bytes += pv.nbytes
+        self._evict(keep=id_)
+
+    def _unstore(self, id_: int) -> Preview:
+        """Drops resident preview 'id_' and returns it. Must be called with the lock held."""
+
+        pv = self._previews.pop(id_)
+        self._by_index[pv.index].discard(id_)
+        if len(self._by_index[pv.index]) == 0:
+            self._by_index.pop(pv.index)
+        self._lru.pop(id_)
+        self._bytes -= pv.nbytes
+        return pv
+
+    def _evict(self, keep: int=None) -> None:
+        """Evicts least recently used previews except 'keep' until the budget is met, remembering how to regenerate them. Must be called with the lock held."""
+
+        for id_ in list(self._lru.keys()):
+            if self._bytes <= self._budget:
+                break
+            if id_ == keep:
+                continue
+            pv = self._unstore(id_)
+            self._evicted[id_] = (pv.index, pv.req_width, pv.req_height)
+            self._evictions += 1
+
+    def add(self, array: np.ndarray, index: str, width: int=None, height: int=None, alpha: np.typing.NDArray[bool]=None, final: bool=True) -> int:
+        """Stores 'array' referring to a preview image and returns its id. The array must be of shape (height, width) for grayscale or (height, width, 3) for RGB previews, 'alpha' is its transparency mask, see 'Preview'.
+        'index' refers to the index for which the preview was created. index='nat_col' is for natural color.
+        'width' and 'height' are the size the preview was requested with, used as a key by 'find' and to regenerate the preview after eviction. If None, the array's size is used.
+        'final'=False stores a coarse preview to be replaced later with 'refine'."""
 
         with self._lock:
-            self._previews[self._counter] = Preview(array, index)
+            id_ = self._counter
+            pv = Preview(array, index, width, height, alpha, final)
+            self._keys[(index, pv.req_width, pv.req_height)] = id_
+            self._store(id_, pv)
             self._counter += 1
-            return self._counter - 1
+            return id_
 
     def find(self, index: str, width: int, height: int) -> int | None:
-        """Tries to find a preview of 'width' x 'height' referring to 'index'. If the preview is found, returns its id, otherwise returns None."""
+        """Tries to find a preview referring to 'index' that was requested as 'width' x 'height'. If the preview is found, returns its id, otherwise returns None.
+        Lock-free: a single dict lookup is atomic."""
+
+        return self._keys.get((index, width, height))
+
+    def find_larger(self, index: str, width: int, height: int) -> int | None:
+        """Tries to find the smallest resident preview referring to 'index' that is at least 'width' x 'height' pixels, so that it can be downscaled instead of being generated again. Returns its id or None."""
 
         with self._lock:
-            for id_, pr in self._previews.items():
-                if pr.index == index:
-                    if pr.width == width or pr.height == height:
-                        return id_
-            return None
+            best, best_area = None, 0
+            for id_ in self._by_index.get(index, ()):
+                pv = self._previews[id_]
+                if pv.final and pv.width >= width and pv.height >= height:
+                    if best is None or pv.width * pv.height < best_area:
+                        best, best_area = id_, pv.width * pv.height
+            return best
+
+    def refine(self, id_: int, array: np.ndarray, alpha: np.typing.NDArray[bool]=None) -> bool:
+        """Replaces preview 'id_' with its final 'array' and 'alpha' keeping the id and the requested size. Returns False if the preview was removed in the meantime."""
+
+        with self._lock:
+            if id_ in self._previews:
+                old = self._unstore(id_)
+                index, width, height = old.index, old.req_width, old.req_height
+            elif id_ in self._evicted:
+                index, width, height = self._evicted.pop(id_)
+            else:
+                return False
+            self._store(id_, Preview(array, index, width, height, alpha))
+            return True
+
+    def finalize(self, id_: int) -> bool:
+        """Marks coarse preview 'id_' final when it cannot be refined, so that clients stop waiting for the final one. The preview is no longer returned by 'find', so a new request of its size renders it again. An evicted preview needs nothing, as it is regenerated at the requested size. Returns False if the preview was removed in the meantime."""
+
+        with self._lock:
+            if id_ in self._previews:
+                pv = self._previews[id_]
+                pv.final = True
+                key = (pv.index, pv.req_width, pv.req_height)
+            elif id_ in self._evicted:
+                key = self._evicted[id_]
+            else:
+                return False
+            if self._keys.get(key) == id_:
+                self._keys.pop(key)
+            return True
 
     def remove(self, id_: int) -> None:
         with self._lock:
-            try:
-                self._previews.pop(id_)
-            except KeyError:
+            if id_ in self._previews:
+                pv = self._unstore(id_)
+                key = (pv.index, pv.req_width, pv.req_height)
+            elif id_ in self._evicted:
+                key = self._evicted.pop(id_)
+            else:
                 raise KeyError(f'Preview {id_} does not exist but "remove" method called')
+            if self._keys.get(key) == id_:
+                self._keys.pop(key)
 
     def remove_all(self) -> None:
-        ids = list(self._previews.keys())
+        ids = list(self._previews.keys()) + list(self._evicted.keys())
         for id_ in ids:
             self.remove(id_)
+        with self._lock:
+            self._evictions = 0
+            self._regenerations = 0
 
     def get(self, id_: int) -> Preview:
+        """Returns preview 'id_'. If it was evicted, regenerates it with the renderer first.
+        Raises KeyError if the preview does not exist or cannot be regenerated and 'PreviewBusyError' if the renderer is out of memory; the preview stays evicted then."""
+
         with self._lock:
-            try:
+            resident = id_ in self._previews
+            metrics.cache_lookup('preview_resident', resident)
+            if resident:
+                self._lru[id_] = self._lru.pop(id_)
                 return self._previews[id_]
+            try:
+                index, width, height = self._evicted[id_]
             except KeyError:
                 raise KeyError(f'Preview {id_} does not exist but "get" method called')
 
+        rendered = self._renderer(index, width, height) if self._renderer is not None else None
+        if rendered is None:
+            raise KeyError(f'Preview {id_} was evicted and cannot be regenerated')
+        array, alpha = rendered
+        with self._lock:
+            if id_ in self._previews:
+                return self._previews[id_]
+            if self._evicted.pop(id_, None) is None:
+                raise KeyError(f'Preview {id_} was removed while being regenerated')
+            pv = Preview(array, index, width, height, alpha)
+            self._store(id_, pv)
+            self._regenerations += 1
+            return pv
+
     def get_all(self) -> list[Preview]:
         with self._lock:
             return list(self._previews.values())
 
+    def set_budget(self, budget: int) -> None:
+        """Sets the maximum number of bytes held by preview arrays and evicts previews if needed."""
+
+        with self._lock:
+            self._budget = budget
+            self._evict()
+
+    def get_memory_stats(self) -> dict:
+        with self._lock:
+            return {
+                'previews': len(self._previews) + len(self._evicted),
+                'resident': len(self._previews),
+                'bytes': self._bytes,
+                'budget': self._budget,
+                'evictions': self._evictions,
+                'regenerations': self._regenerations
+            }
+
+class Admission:
+    __slots__ = ('kind', 'base', 'estimate', 'started', 'start_rss', 'peak_rss', 'alone')
+
+    def __init__(self, kind: str, base: int, estimate: int):
+        self.kind = kind
+        self.base = base
+        self.estimate = estimate
+        self.started = None
+        self.start_rss = None
+        self.peak_rss = None
+        self.alone = True
+
+class AdmissionController:
+    """Admits memory-heavy operations against a global budget of estimated peak bytes. An operation that does not fit waits in a FIFO queue of at most MAX_QUEUE operations for up to 'wait' seconds and is rejected after that.
+    An operation larger than the whole budget is admitted when nothing else runs, unless the controller is 'strict': then it is rejected at once.
+    While operations run, resident memory of the process is sampled every PEAK_INTERVAL seconds. The peak of an operation that ran alone refines the estimates of its kind: estimates are scaled by an exponential moving average of peak / estimate."""
+
+    DEFAULT_BUDGET = 4 * 1024 * 1024 * 1024
+    DEFAULT_WAIT = 10
+    MAX_QUEUE = 8
+    PEAK_INTERVAL = 0.05
+    MIN_ESTIMATE = 1024 * 1024
+    SMOOTHING = 0.3
+    MIN_FACTOR = 0.5
+    MAX_FACTOR = 10.0
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+    def __init__(self, budget: int=DEFAULT_BUDGET, wait: float=DEFAULT_WAIT, strict: bool=False):
+        self._budget = budget
+        self._wait = wait
+        self._strict = strict
+        self._in_use = 0
+        self._running = set()
+        self._queue = []
+        self._factors = {}
+        self._durations = {}
+        self._admitted = 0
+        self._queued = 0
+        self._rejected = 0
+        self._monitor = None
+        self._cond = threading.Condition()
+
+    @staticmethod
+    def _rss() -> int | None:
+        """Returns resident memory of the process in bytes or None if it cannot be read (only Linux is supported)."""
+
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * AdmissionController.PAGE_SIZE
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def estimate(self, kind: str, base: int) -> Admission:
+        """Returns an admission request for an operation of 'kind' whose peak memory is estimated as 'base' bytes before refinement."""
+
+        base = max(int(base), self.MIN_ESTIMATE)
+        with self._cond:
+            factor = self._factors.get(kind, 1.0)
+        return Admission(kind, base, int(base * factor))
+
+    def _fits(self, admission: Admission) -> bool:
+        return self._in_use + admission.estimate <= self._budget or not self._strict and len(self._running) == 0
+
+    def acquire(self, admission: Admission, wait: float=None) -> bool:
+        """Waits until 'admission' fits into the budget and returns True, or returns False if it did not fit in 'wait' seconds ('wait' given to the constructor if None) or the queue is full.
+        Every admitted operation must be released with 'release'."""
+
+        wait = self._wait if wait is None else wait
+        with self._cond:
+            if len(self._queue) == 0 and self._fits(admission):
+                self._start(admission)
+                return True
+            if len(self._queue) >= self.MAX_QUEUE or self._strict and admission.estimate > self._budget:
+                self._rejected += 1
+                return False
+            self._queued += 1
+            self._queue.append(admission)
+            admitted = self._cond.wait_for(lambda: self._queue[0] is admission and self._fits(admission), wait)
+            self._queue.remove(admission)
+            if admitted:
+                self._start(admission)
+            else:
+                self._rejected += 1
+            self._cond.notify_all()
+            return admitted
+
+    def try_acquire(self, admission: Admission) -> bool:
+        """Admits 'admission' only if no operation is waiting and it fits into the budget right now. A refusal is not counted as a rejection.
+        Every admitted operation must be released with 'release'."""
+
+        with self._cond:
+            if len(self._queue) == 0 and self._in_use + admission.estimate <= self._budget:
+                self._start(admission)
+                return True
+            return False
+
+    def _start(self, admission: Admission) -> None:
+        """Must be called with the lock held."""
+
+        if len(self._running) > 0:
+            admission.alone = False
+            for other in self._running:
+                other.alone = False
+        admission.started = time.perf_counter()
+        admission.start_rss = admission.peak_rss = self._rss()
+        self._running.add(admission)
+        self._in_use += admission.estimate
+        self._admitted += 1
+        if self._monitor is None and admission.start_rss is not None:
+            self._monitor = threading.Thread(target=self._sample_peaks, name='admission', daemon=True)
+            self._monitor.start()
+
+    def release(self, admission: Admission) -> None:
+        with self._cond:
+            self._running.discard(admission)
+            self._in_use -= admission.estimate
+            duration = time.perf_counter() - admission.started
+            self._durations[admission.kind] = duration if admission.kind not in self._durations else self._durations[admission.kind] * (1 - self.SMOOTHING) + duration * self.SMOOTHING
+            rss = self._rss()
+            if rss is not None and admission.peak_rss is not None:
+                admission.peak_rss = max(admission.peak_rss, rss)
+                # resident memory does not grow when freed memory is reused, so estimates are never scaled below MIN_FACTOR
+                if admission.alone and admission.peak_rss - admission.start_rss >= self.MIN_ESTIMATE:
+                    ratio = min(max((admission.peak_rss - admission.start_rss) / admission.base, self.MIN_FACTOR), self.MAX_FACTOR)
+                    factor = self._factors.get(admission.kind)
+                    self._factors[admission.kind] = ratio if factor is None else factor * (1 - self.SMOOTHING) + ratio * self.SMOOTHING
+            self._cond.notify_all()
+
+    def _sample_peaks(self) -> None:
+        while True:
+            with self._cond:
+                if len(self._running) == 0:
+                    self._monitor = None
+                    return
+                rss = self._rss()
+                for admission in self._running:
+                    if admission.peak_rss is not None and rss is not None and rss > admission.peak_rss:
+                        admission.peak_rss = rss
+            sleep(self.PEAK_INTERVAL)
+
+    def retry_after(self) -> int:
+        """Returns the number of seconds after which a rejected operation is likely to be admitted: the typical duration of an operation times the number of operations waiting before it, plus one."""
+
+        with self._cond:
+            durations = list(self._durations.values())
+            waiting = len(self._queue)
+        typical = sum(durations) / len(durations) if len(durations) > 0 else 1
+        return max(1, ceil(typical * (waiting + 1)))
+
+    def set_budget(self, budget: int) -> None:
+        with self._cond:
+            self._budget = budget
+            self._cond.notify_all()
+
+    def get_stats(self) -> dict:
+        with self._cond:
+            return {
+                'budget': self._budget,
+                'in_use': self._in_use,
+                'running': len(self._running),
+                'waiting': len(self._queue),
+                'admitted': self._admitted,
+                'queued': self._queued,
+                'rejected': self._rejected,
+                'factors': dict(self._factors)
+            }
+
+class _Foreground:
+    __slots__ = ('_prefetcher',)
+
+    def __init__(self, prefetcher: 'Prefetcher'):
+        self._prefetcher = prefetcher
+
+    def __enter__(self):
+        with self._prefetcher._cond:
+            self._prefetcher._foreground += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self._prefetcher._cond:
+            self._prefetcher._foreground -= 1
+            self._prefetcher._last_foreground = time.perf_counter()
+            self._prefetcher._cond.notify_all()
+        return False
+
+class Prefetcher:
+    """Runs speculative tasks one by one on a background thread with lowered OS priority. A task starts only when no foreground request, see 'foreground', has been running for IDLE_DELAY seconds; a task that has already started is not interrupted.
+    A task is a callable returning True if it did the work and False if it was skipped."""
+
+    IDLE_DELAY = 0.5
+    NICENESS = 10
+
+    def __init__(self, idle_delay: float=IDLE_DELAY):
+        self.idle_delay = idle_delay
+        self._tasks = deque()
+        self._foreground = 0
+        self._last_foreground = 0.0
+        self._running = False
+        self._scheduled = 0
+        self._completed = 0
+        self._skipped = 0
+        self._thread = None
+        self._cond = threading.Condition()
+
+    def foreground(self) -> _Foreground:
+        """Returns a context manager to wrap a foreground request with. Tasks are not started while it is entered."""
+
+        return _Foreground(self)
+
+    def schedule(self, tasks: list['Callable[[], bool]']) -> None:
+        """Replaces pending tasks with 'tasks', run in order."""
+
+        with self._cond:
+            self._tasks = deque(tasks)
+            self._scheduled += len(tasks)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='prefetch', daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def cancel(self) -> None:
+        """Drops pending tasks. A running task is not interrupted."""
+
+        with self._cond:
+            self._skipped += len(self._tasks)
+            self._tasks.clear()
+
+    def _idle(self) -> bool:
+        """Must be called with the lock held."""
+
+        return self._foreground == 0 and time.perf_counter() - self._last_foreground >= self.idle_delay
+
+    def _run(self) -> None:
+        try:
+            # Linux applies niceness to single threads
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), self.NICENESS)
+        except (AttributeError, OSError):
+            pass
+        while True:
+            with self._cond:
+                while len(self._tasks) == 0 or not self._idle():
+                    self._cond.wait(None if len(self._tasks) == 0 or self._foreground > 0 else max(0.0, self.idle_delay - (time.perf_counter() - self._last_foreground)))
+                task = self._tasks.popleft()
+                self._running = True
+            done = False
+            try:
+                done = task()
+            except Exception as e:
+                print(f'Prefetch task failed: {e}')
+            with self._cond:
+                self._running = False
+                if done:
+                    self._completed += 1
+                else:
+                    self._skipped += 1
+                self._cond.notify_all()
+
+    def wait_idle(self, timeout: float=None) -> bool:
+        """Waits until all tasks are done. Returns False on timeout."""
+
+        with self._cond:
+            return self._cond.wait_for(lambda: len(self._tasks) == 0 and not self._running, timeout)
+
+    def get_stats(self) -> dict:
+        with self._cond:
+            return {
+                'pending': len(self._tasks) + int(self._running),
+                'scheduled': self._scheduled,
+                'completed': self._completed,
+                'skipped': self._skipped
+            }
+
 class Dataset:
     def __init__(self, dataset: gdal.Dataset, band: str=None, nodata: float | int=None, stats: dict=None, description: dict=None):
         self.dataset = dataset
@@ -74,27 +527,53 @@ class Dataset:
         self.refl_max = None
         self.stats = stats
         self.description = description
+        self.lock = threading.Lock()
 
 class DatasetManager:
+    CLOUD_CACHE_SIZE = 4
+    AOI_MASK_CACHE_SIZE = 4
+    CALIBRATION_KEYS = ('radio_mult', 'radio_add', 'thermal_k1', 'thermal_k2', 'rad_max', 'refl_max')
+    SNAPSHOT_GTIFF_OPTIONS = ['TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512', 'COMPRESS=DEFLATE', 'ZLEVEL=6', 'NUM_THREADS=ALL_CPUS']
+    SNAPSHOT_GENERATION_PREFIX = 'snapshot_'
+    ADVISE_READ_PIXELS = 1024 * 1024
+
     def __init__(self):
         self._datasets = {}
-        self._cloud_mask = None
+        self._names = {}
+        self._files = {}
+        self._cloud_source = None
+        self._cloud_bits = None
+        self._cloud_shape = None
+        self._cloud_cache = {}
+        self._cloud_lock = threading.Lock()
+        self._aoi = None
+        self._aoi_geometry = None
+        self._aoi_masks = {}
+        self._aoi_lock = threading.Lock()
         self._sun_elev = None
         self._earth_sun_dist = None
         self._counter = 0
-        self._lock = threading.Lock()
+        self._lock = metrics.TimedLock('dataset_manager')
+        # windows of at least this many pixels are announced to GDAL with AdviseRead before reading, 0 disables it
+        self.advise_read_pixels = self.ADVISE_READ_PIXELS
 
     def add_index(self, dataset: gdal.Dataset, index: str, nodata: float | int, statistics: dict) -> int:
         """Stores 'dataset' with its associated 'index' name, 'nodata' and 'statistics' and returns its own generated id."""
 
         with self._lock:
-            self._datasets[self._counter] = Dataset(dataset, index, nodata, statistics)
+            id_ = self._counter
+            self._datasets[id_] = Dataset(dataset, index, nodata, statistics)
+            self._names[index] = id_
             self._counter += 1
-            return self._counter - 1
+            return id_
 
     def open(self, filename: str, band: str, nodata: float | int) -> int:
         """Tries to open 'file' as a GDAL dataset, saves 'band' and 'nodata' and returns dataset's generated id.
-        If a dataset with 'band' is already open, overwrites it with a new dataset."""
+        If a dataset with 'band' is already open, overwrites it with a new dataset. If 'file' is already open, returns its id without opening it again."""
+
+        id_ = self._files.get(filename)
+        if id_ is not None:
+            return id_
 
         try:
             dataset = gdal.Open(filename, gdal.GA_ReadOnly)
@@ -104,29 +583,37 @@ class DatasetManager:
             raise ValueError(f'Opened file {filename} is not a spatial image')
 
         with self._lock:
-            for id_, ds in self._datasets.items():
-                if ds.dataset.GetDescription() == dataset.GetDescription():
-                    return id_
-                if ds.band == band:
-                    self._datasets[id_] = Dataset(dataset, band, nodata)
-                    return id_
-            self._datasets[self._counter] = Dataset(dataset, band, nodata)
-            self._counter += 1
-            return self._counter - 1
+            id_ = self._files.get(dataset.GetDescription())
+            if id_ is not None:
+                return id_
+            id_ = self._names.get(band)
+            if id_ is not None:
+                old = self._datasets[id_].dataset.GetDescription()
+                if self._files.get(old) == id_:
+                    self._files.pop(old)
+            else:
+                id_ = self._counter
+                self._counter += 1
+            self._datasets[id_] = Dataset(dataset, band, nodata)
+            self._names[band] = id_
+            self._files[dataset.GetDescription()] = id_
+            return id_
 
     def find(self, band_index: str) -> int | None:
         """Tries to find a band by or a spectral index by its name.
-        If the band or the index is found, returns its id, otherwise returns None."""
+        If the band or the index is found, returns its id, otherwise returns None.
+        Lock-free: a single dict lookup is atomic."""
 
-        with self._lock:
-            for id_, ds in self._datasets.items():
-                if ds.band == band_index:
-                    return id_
-            return None
+        return self._names.get(band_index)
 
-    def add_cloud_mask(self, cloud_mask: np.ma.MaskedArray) -> None:
-        """Save the cloud mask for future calculations."""
-        self._cloud_mask = cloud_mask
+    def set_cloud_source(self, id_: int) -> None:
+        """Saves dataset 'id_' as the QA band to build the cloud mask from. The mask itself is built on first use, see 'get_cloud_mask'."""
+
+        with self._cloud_lock:
+            self._cloud_source = id_
+            self._cloud_bits = None
+            self._cloud_shape = None
+            self._cloud_cache = {}
 
     def add_description(self, id_: int, notes: str=None, desc: str=None) -> None:
         """Adds 'notes' and 'desc' to index's description."""
@@ -156,31 +643,353 @@ class DatasetManager:
     def close(self, id_: int) -> None:
         with self._lock:
             try:
-                self._datasets.pop(id_)
+                ds = self._datasets.pop(id_)
             except KeyError:
                 raise KeyError(f'Dataset {id_} is not opened but "close" method called')
+            if self._names.get(ds.band) == id_:
+                self._names.pop(ds.band)
+            file = ds.dataset.GetDescription()
+            if self._files.get(file) == id_:
+                self._files.pop(file)
+
+    def close_indices(self) -> None:
+        """Closes all in-memory datasets (calculated indices) keeping imported bands open."""
+
+        with self._lock:
+            ids = [id_ for id_, ds in self._datasets.items() if ds.dataset.GetDriver().ShortName == 'MEM']
+        for id_ in ids:
+            self.close(id_)
 
     def close_all(self) -> None:
         ids = list(self._datasets.keys())
         for id_ in ids:
             self.close(id_)
-        self._cloud_mask = None
+        with self._cloud_lock:
+            self._cloud_source = None
+            self._cloud_bits = None
+            self._cloud_shape = None
+            self._cloud_cache = {}
+        with self._aoi_lock:
+            self._aoi = None
+            self._aoi_geometry = None
+            self._aoi_masks = {}
         self._sun_elev = None
         self._earth_sun_dist = None
 
     def get(self, id_: int) -> Dataset:
-        with self._lock:
-            try:
-                return self._datasets[id_]
-            except KeyError:
-                raise KeyError(f'Dataset {id_} is not opened but "get" method called')
+        try:
+            return self._datasets[id_]
+        except KeyError:
+            raise KeyError(f'Dataset {id_} is not opened but "get" method called')
 
     def get_all(self) -> list[Dataset]:
         with self._lock:
             return self._datasets.values()
 
-    def get_cloud_mask(self) -> np.ma.MaskedArray | None:
-        return self._cloud_mask
+    def get_memory_stats(self) -> dict:
+        """Returns the number of held datasets and the number of bytes held in memory by in-memory datasets (calculated indices) and the cloud mask."""
+
+        with self._lock:
+            datasets = list(self._datasets.values())
+        count, in_memory, bytes_ = len(datasets), 0, 0
+        for ds in datasets:
+            if ds.dataset.GetDriver().ShortName == 'MEM':
+                in_memory += 1
+                band = ds.dataset.GetRasterBand(1)
+                bytes_ += ds.dataset.RasterXSize * ds.dataset.RasterYSize * ds.dataset.RasterCount * gdal.GetDataTypeSize(band.DataType) // 8
+        with self._cloud_lock:
+            if self._cloud_bits is not None:
+                bytes_ += self._cloud_bits.nbytes
+            for mask in self._cloud_cache.values():
+                bytes_ += mask.nbytes
+        return {
+            'datasets': count,
+            'in_memory': in_memory,
+            'bytes': bytes_
+        }
+
+    def snapshot(self, directory: str) -> dict:
+        """Writes calculated indices to a new generation subdirectory of 'directory' as tiled, compressed GeoTIFFs with their statistics and the cloud mask as a bit-packed .npy file. Files of previous snapshots are not touched; see 'discard_snapshots' to remove them once the new state is recorded.
+        Returns the rest of the state, including file paths relative to 'directory' and the 'generation' subdirectory, as a JSON serializable dictionary to be passed to 'restore'.
+        Imported bands are not copied: their paths, sizes and modification times are saved instead. Raises RuntimeError or OSError if a file cannot be written, the partial generation is removed then."""
+
+        os.makedirs(directory, exist_ok=True)
+        generation = tempfile.mkdtemp(prefix=self.SNAPSHOT_GENERATION_PREFIX, dir=directory)
+        try:
+            state = self._snapshot(directory, os.path.basename(generation))
+        except BaseException:
+            shutil.rmtree(generation, ignore_errors=True)
+            raise
+        return state
+
+    def _snapshot(self, directory: str, generation: str) -> dict:
+        """Writes the files of 'snapshot' to 'generation' subdirectory of 'directory' and returns the state."""
+
+        with self._lock:
+            items = sorted(self._datasets.items())
+        bands, indices = [], []
+        for id_, ds in items:
+            if ds.dataset.GetDriver().ShortName == 'MEM':
+                filename = os.path.join(generation, f'index_{ds.band}.tif')
+                band = ds.dataset.GetRasterBand(1)
+                predictor = 'PREDICTOR=3' if band.DataType in (gdal.GDT_Float32, gdal.GDT_Float64) else 'PREDICTOR=2'
+                with ds.lock:
+                    out = gdal.GetDriverByName('GTiff').CreateCopy(os.path.join(directory, filename), ds.dataset, options=self.SNAPSHOT_GTIFF_OPTIONS + [predictor])
+                    out.GetRasterBand(1).SetDescription(ds.band)
+                    stats = ds.stats or {}
+                    if all(type(stats.get(k)) is float and not np.isnan(stats[k]) for k in ('min', 'max', 'mean', 'stdev')):
+                        out.GetRasterBand(1).SetStatistics(stats['min'], stats['max'], stats['mean'], stats['stdev'])
+                    out.FlushCache()
+                    out = None
+                indices.append({
+                    'index': ds.band,
+                    'file': filename,
+                    'nodata': ds.no_data,
+                    'stats': ds.stats,
+                    'description': ds.description
+                })
+            else:
+                file = ds.dataset.GetDescription()
+                try:
+                    st = os.stat(file)
+                    size, mtime = st.st_size, st.st_mtime_ns
+                except OSError:
+                    size, mtime = None, None
+                band = {
+                    'band': ds.band,
+                    'file': file,
+                    'size': size,
+                    'mtime': mtime,
+                    'nodata': ds.no_data,
+                    'cloud_source': id_ == self._cloud_source
+                }
+                for key in self.CALIBRATION_KEYS:
+                    band[key] = getattr(ds, key)
+                bands.append(band)
+
+        cloud_mask = None
+        with self._cloud_lock:
+            if self._cloud_bits is not None:
+                filename = os.path.join(generation, 'cloud_mask.npy')
+                np.save(os.path.join(directory, filename), self._cloud_bits, allow_pickle=False)
+                cloud_mask = {'file': filename, 'shape': list(self._cloud_shape)}
+        with self._aoi_lock:
+            aoi = None
+            if self._aoi is not None:
+                aoi = {'bounds': list(self._aoi), 'geometry': self._aoi_geometry.ExportToWkt() if self._aoi_geometry is not None else None}
+        return {
+            'generation': generation,
+            'sun_elevation': self._sun_elev,
+            'earth_sun_distance': self._earth_sun_dist,
+            'bands': bands,
+            'indices': indices,
+            'cloud_mask': cloud_mask,
+            'aoi': aoi
+        }
+
+    def discard_snapshots(self, directory: str, keep: str=None) -> None:
+        """Removes generation subdirectories written by 'snapshot' to 'directory' except 'keep'."""
+
+        for name in os.listdir(directory):
+            if name.startswith(self.SNAPSHOT_GENERATION_PREFIX) and name != keep:
+                shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+    def restore(self, directory: str, state: dict) -> None:
+        """Reopens bands and loads indices and the cloud mask saved by 'snapshot' to 'directory'. Indices are copied to memory, so the snapshot may be overwritten afterwards. Must be called after 'close_all'.
+        Raises RuntimeError if a file cannot be opened, ValueError if a band was modified after the snapshot and KeyError or OSError if the snapshot is incomplete."""
+
+        for band in state['bands']:
+            if band['size'] is not None:
+                try:
+                    st = os.stat(band['file'])
+                except OSError:
+                    raise RuntimeError(f"Cannot open file {band['file']}")
+                if (st.st_size, st.st_mtime_ns) != (band['size'], band['mtime']):
+                    raise ValueError(f"File {band['file']} was modified after the snapshot")
+            id_ = self.open(band['file'], band['band'], band['nodata'])
+            ds = self.get(id_)
+            for key in self.CALIBRATION_KEYS:
+                setattr(ds, key, band[key])
+            if band['cloud_source']:
+                self.set_cloud_source(id_)
+
+        for index in state['indices']:
+            try:
+                src = gdal.Open(os.path.join(directory, index['file']), gdal.GA_ReadOnly)
+            except RuntimeError:
+                raise RuntimeError(f"Cannot open file {os.path.join(directory, index['file'])}")
+            dataset = gdal.GetDriverByName('MEM').CreateCopy('', src)
+            src = None
+            id_ = self.add_index(dataset, index['index'], index['nodata'], index['stats'])
+            if index['description'] is not None:
+                self.add_description(id_, notes=index['description']['notes'], desc=index['description']['text'])
+
+        self._sun_elev = state['sun_elevation']
+        self._earth_sun_dist = state['earth_sun_distance']
+        if state['cloud_mask'] is not None:
+            bits = np.load(os.path.join(directory, state['cloud_mask']['file']), allow_pickle=False)
+            with self._cloud_lock:
+                if self._cloud_source is not None:
+                    self._cloud_bits = bits
+                    self._cloud_shape = tuple(state['cloud_mask']['shape'])
+        if state['aoi'] is not None:
+            geometry = state['aoi']['geometry']
+            self.set_aoi(state['aoi']['bounds'], ogr.CreateGeometryFromWkt(geometry) if geometry is not None else None)
+
+    def get_band_spatial_ref(self) -> osr.SpatialReference | None:
+        """Returns the spatial reference of the first imported band or None if no bands are imported."""
+
+        with self._lock:
+            datasets = list(self._datasets.values())
+        for ds in datasets:
+            if ds.dataset.GetDriver().ShortName != 'MEM':
+                return ds.dataset.GetSpatialRef()
+        return None
+
+    def get_band_size(self) -> tuple[int, int] | None:
+        """Returns (xsize, ysize) of the window read from the first imported band, see 'get_window', or None if no bands are imported."""
+
+        with self._lock:
+            ids = list(self._datasets.keys())
+        for id_ in ids:
+            try:
+                ds = self.get(id_)
+            except KeyError:
+                continue
+            if ds.dataset.GetDriver().ShortName != 'MEM':
+                _, _, xsize, ysize = self.get_window(id_)
+                return xsize, ysize
+        return None
+
+    def _aoi_window(self, ds: gdal.Dataset, bounds: tuple[float, float, float, float]) -> tuple[int, int, int, int] | None:
+        inv = gdal.InvGeoTransform(ds.GetGeoTransform())
+        corners = [(x, y) for x in (bounds[0], bounds[2]) for y in (bounds[1], bounds[3])]
+        cols = [inv[0] + inv[1] * x + inv[2] * y for x, y in corners]
+        rows = [inv[3] + inv[4] * x + inv[5] * y for x, y in corners]
+        x0, x1 = max(0, floor(min(cols) + 1e-6)), min(ds.RasterXSize, ceil(max(cols) - 1e-6))
+        y0, y1 = max(0, floor(min(rows) + 1e-6)), min(ds.RasterYSize, ceil(max(rows) - 1e-6))
+        if x1 <= x0 or y1 <= y0:
+            return None
+        return x0, y0, x1 - x0, y1 - y0
+
+    def set_aoi(self, bounds: tuple[float, float, float, float] | None, geometry: ogr.Geometry=None) -> None:
+        """Limits reading of imported bands to the area of interest. 'bounds' is (xmin, ymin, xmax, ymax) in the projection of the bands, 'geometry' is an optional polygon in the same projection, pixels outside of which are masked. 'bounds'=None resets the AOI to the whole scene.
+        Raises ValueError if the AOI does not overlap an imported band. In-memory datasets (calculated indices) are not clipped, as they are already calculated within the AOI they were created with."""
+
+        if bounds is not None:
+            bounds = tuple(float(b) for b in bounds)
+            with self._lock:
+                datasets = list(self._datasets.values())
+            for ds in datasets:
+                if ds.dataset.GetDriver().ShortName != 'MEM' and self._aoi_window(ds.dataset, bounds) is None:
+                    raise ValueError(f'AOI {bounds} does not overlap dataset {ds.dataset.GetDescription()}')
+        with self._aoi_lock:
+            self._aoi = bounds
+            self._aoi_geometry = geometry.Clone() if bounds is not None and geometry is not None else None
+            self._aoi_masks = {}
+        with self._cloud_lock:
+            self._cloud_cache = {}
+
+    def get_aoi(self) -> tuple[float, float, float, float] | None:
+        return self._aoi
+
+    def get_window(self, id_: int) -> tuple[int, int, int, int]:
+        """Returns (xoff, yoff, xsize, ysize) of the pixel window of dataset 'id_' read by 'read_band': the part covered by the AOI for imported bands and the whole raster for in-memory datasets or if the AOI is not set."""
+
+        ds = self.get(id_).dataset
+        aoi = self._aoi
+        if aoi is not None and ds.GetDriver().ShortName != 'MEM':
+            window = self._aoi_window(ds, aoi)
+            if window is not None:
+                return window
+        return 0, 0, ds.RasterXSize, ds.RasterYSize
+
+    def get_geotransform(self, id_: int) -> tuple[float, float, float, float, float, float]:
+        """Returns the geotransform of the window of dataset 'id_' read by 'read_band', see 'get_window'."""
+
+        gt = self.get(id_).dataset.GetGeoTransform()
+        x0, y0, _, _ = self.get_window(id_)
+        return (gt[0] + x0 * gt[1] + y0 * gt[2], gt[1], gt[2], gt[3] + x0 * gt[4] + y0 * gt[5], gt[4], gt[5])
+
+    def get_aoi_mask(self, id_: int, shape: tuple[int, int]) -> np.typing.NDArray[bool] | None:
+        """Returns a read-only boolean array where True=outside of the AOI polygon for the window of dataset 'id_' resampled to 'shape'. Returns None if the AOI is not a polygon or the dataset is not an imported band.
+        Masks are rasterized at the requested shape and cached for the last AOI_MASK_CACHE_SIZE (grid, shape) pairs."""
+
+        geometry = self._aoi_geometry
+        ds = self.get(id_).dataset
+        if geometry is None or ds.GetDriver().ShortName == 'MEM':
+            return None
+        _, _, xsize, ysize = self.get_window(id_)
+        gt = self.get_geotransform(id_)
+        sx, sy = xsize / shape[1], ysize / shape[0]
+        gt = (gt[0], gt[1] * sx, gt[2] * sy, gt[3], gt[4] * sx, gt[5] * sy)
+        key = (gt, tuple(shape))
+        with self._aoi_lock:
+            hit = key in self._aoi_masks
+            metrics.cache_lookup('aoi_mask', hit)
+            if hit:
+                ret = self._aoi_masks.pop(key)
+                self._aoi_masks[key] = ret
+                return ret
+
+        vectors = ogr.GetDriverByName('Memory').CreateDataSource('')
+        layer = vectors.CreateLayer('aoi', srs=ds.GetSpatialRef())
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(geometry)
+        layer.CreateFeature(feature)
+        target = gdal.GetDriverByName('MEM').Create('', shape[1], shape[0], 1, gdal.GDT_Byte)
+        target.SetGeoTransform(gt)
+        target.SetProjection(ds.GetProjection())
+        gdal.RasterizeLayer(target, [1], layer, burn_values=[1])
+        ret = target.GetRasterBand(1).ReadAsArray() == 0
+        ret.flags.writeable = False
+
+        with self._aoi_lock:
+            if self._aoi_geometry is geometry:
+                self._aoi_masks[key] = ret
+                if len(self._aoi_masks) > self.AOI_MASK_CACHE_SIZE:
+                    self._aoi_masks.pop(next(iter(self._aoi_masks)))
+        return ret
+
+    def get_cloud_mask(self, shape: tuple[int, int]=None) -> np.typing.NDArray[bool] | None:
+        """Returns a read-only boolean array where True=cloud, resampled to 'shape' (full resolution of the AOI window if None). Returns None if the QA band was not imported.
+        The full resolution mask is built from the QA band on first call and kept bit-packed. It is cropped to the AOI window of the QA band, see 'get_window'. Reduced resolutions are max-pooled (a pixel is cloudy if any pixel of its block is) and cached for the last CLOUD_CACHE_SIZE shapes."""
+
+        with self._cloud_lock:
+            if self._cloud_source is None:
+                return None
+            if self._cloud_bits is None:
+                ds = self.get(self._cloud_source)
+                with ds.lock:
+                    qa = ds.dataset.GetRasterBand(1).ReadAsArray()
+                if ds.no_data is not None:
+                    qa = np.ma.masked_equal(qa, ds.no_data)
+                clouds = indcal.cloud_mask(qa, 3).filled(False)
+                self._cloud_bits = np.packbits(clouds, axis=None)
+                self._cloud_shape = clouds.shape
+
+            x0, y0, xsize, ysize = self.get_window(self._cloud_source)
+            if shape is None:
+                shape = (ysize, xsize)
+            shape = tuple(shape)
+            hit = shape in self._cloud_cache
+            metrics.cache_lookup('cloud_mask', hit)
+            if hit:
+                ret = self._cloud_cache.pop(shape)
+                self._cloud_cache[shape] = ret
+                return ret
+
+            full = np.unpackbits(self._cloud_bits, count=self._cloud_shape[0] * self._cloud_shape[1]).reshape(self._cloud_shape).view(np.bool)
+            full = full[y0:y0 + ysize, x0:x0 + xsize]
+            if shape == full.shape:
+                ret = full
+            else:
+                ret = indcal.downsample_mask(full, shape)
+                self._cloud_cache[shape] = ret
+                if len(self._cloud_cache) > self.CLOUD_CACHE_SIZE:
+                    self._cloud_cache.pop(next(iter(self._cloud_cache)))
+            ret.flags.writeable = False
+            return ret
 
     def get_sun_elevation(self) -> float | None:
         return self._sun_elev
@@ -197,13 +1006,76 @@ class DatasetManager:
     def set_earth_sun_distance(self, val: float) -> None:
         self._earth_sun_dist = val
 
-    def read_band(self, dataset_id: int, band_id: int, nodata: float | int=None, step_size_percent: float | int=100, resolution_percent: float | int=100) -> np.ma.MaskedArray:
+    def read_window(self, dataset_id: int, band_id: int, xoff: int, yoff: int, xsize: int, ysize: int, step: int=1) -> np.ndarray:
+        """Reads a 'xsize' x 'ysize' window of a band at ('xoff', 'yoff') as is: in the band's own data type, without NoData or cloud masking.
+        'step' > 1 decimates the window, taking every 'step'-th pixel starting from the first one, so the resulting array is of shape (ceil(ysize / step), ceil(xsize / step)) and its pixel i is pixel i * 'step' of the window.
+        Raises ValueError if the window does not fit into the raster."""
+
+        try:
+            dataset = self.get(dataset_id)
+        except KeyError:
+            raise KeyError(f'Dataset {dataset_id} is not opened but "read_window" method called')
+        ds = dataset.dataset
+        if step < 1 or xoff < 0 or yoff < 0 or xsize <= 0 or ysize <= 0 or xoff + xsize > ds.RasterXSize or yoff + ysize > ds.RasterYSize:
+            raise ValueError(f'Window {xsize}x{ysize} at ({xoff}, {yoff}) with step {step} does not fit into {ds.RasterXSize}x{ds.RasterYSize} raster of dataset {dataset_id}')
+        try:
+            band = ds.GetRasterBand(band_id)
+        except RuntimeError:
+            raise RuntimeError(f'Dataset {dataset_id} does not have band number {band_id}')
+
+        with dataset.lock:
+            data = band.ReadAsArray(xoff, yoff, xsize, ysize)
+        return data[::step, ::step] if step > 1 else data
+
+    def query_pixels(self, dataset_id: int, band_id: int, x: np.ndarray, y: np.ndarray) -> np.ma.MaskedArray:
+        """Returns values of a band at map coordinates 'x' and 'y' given in the dataset's projection. Points outside the raster and NoData values are masked, the cloud mask is not applied.
+        Pixel offsets of all points are computed from the geotransform at once. Points are grouped by the raster block they fall into and every block is read with one window that only spans its points."""
+
+        try:
+            dataset = self.get(dataset_id)
+        except KeyError:
+            raise KeyError(f'Dataset {dataset_id} is not opened but "query_pixels" method called')
+        ds = dataset.dataset
+        try:
+            band = ds.GetRasterBand(band_id)
+        except RuntimeError:
+            raise RuntimeError(f'Dataset {dataset_id} does not have band number {band_id}')
+
+        inv = gdal.InvGeoTransform(ds.GetGeoTransform())
+        cols = np.floor(inv[0] + inv[1] * x + inv[2] * y).astype(np.int64)
+        rows = np.floor(inv[3] + inv[4] * x + inv[5] * y).astype(np.int64)
+        inside = (cols >= 0) & (cols < ds.RasterXSize) & (rows >= 0) & (rows < ds.RasterYSize)
+        values = np.zeros(len(cols), dtype=np.float64)
+
+        points = np.flatnonzero(inside)
+        if len(points) > 0:
+            block_x, block_y = band.GetBlockSize()
+            blocks = (rows[points] // block_y) * -(-ds.RasterXSize // block_x) + cols[points] // block_x
+            order = np.argsort(blocks, kind='stable')
+            points, blocks = points[order], blocks[order]
+            starts = np.flatnonzero(np.r_[True, blocks[1:] != blocks[:-1]])
+            ends = np.r_[starts[1:], len(points)]
+            with dataset.lock:
+                for start, end in zip(starts, ends):
+                    c, r = cols[points[start:end]], rows[points[start:end]]
+                    xoff, yoff = int(c.min()), int(r.min())
+                    window = band.ReadAsArray(xoff, yoff, int(c.max()) - xoff + 1, int(r.max()) - yoff + 1)
+                    values[points[start:end]] = window[r - yoff, c - xoff]
+
+        mask = ~inside | np.isnan(values)
+        if dataset.no_data is not None:
+            mask |= values == dataset.no_data
+        return np.ma.array(values, mask=mask)
+
+    def read_band(self, dataset_id: int, band_id: int, nodata: float | int=None, step_size_percent: float | int=100, resolution_percent: float | int=100, dtype: type=np.float32) -> np.ma.MaskedArray:
         """Reads a band from the dataset and returns it as a numpy masked array, where mask corresponds to NoData values.
         'nodata' sets the pixel value that will be treated as the NoData value and will be used to define the resulting array's mask. If the parameter is left to None, the dataset's own nodata value will be used, if it was set prevously (if it was not set, all pixels will be treated as valid).
         'step_size_percent' is the percent of the raster's rows or columns that will be read during one iteration. For example, if the raster is 100x100 pixels and 'step_size'=20, the band will be read entirely within 5 iterations with five 20x100 windows.
         'step_size_percent' <=0 means the band will be read line by line. 'step_size' >=100 means the band will be read at once.
         The less 'step_size' is, the less memory is used and the slower the function is.
-        'resolution_percent' controls the resulting array resolution. if <=0, resoltion is set to 0.01 percent of the original raster; if >=100, the band will be read at full resolution."""
+        'resolution_percent' controls the resulting array resolution. if <=0, resoltion is set to 0.01 percent of the original raster; if >=100, the band will be read at full resolution.
+        'dtype' is the data type of the resulting array. None keeps the band's own data type.
+        Imported bands are read only within the AOI window, see 'set_aoi' and 'get_window', so the sizes and percents above refer to the window. Pixels outside of an AOI polygon are masked."""
 
         def _to_percent(value):
             if isclose(0, value, abs_tol=0.01) or value < 0:
@@ -223,7 +1095,8 @@ class DatasetManager:
         except RuntimeError:
             raise RuntimeError(f'Dataset {dataset_id} does not have band number {band_id}')
 
-        x_size, y_size, step, res, data = ds.RasterXSize, ds.RasterYSize, 0, 0, 0
+        x0, y0, x_size, y_size = self.get_window(dataset_id)
+        step, res, data = 0, 0, 0
         if _to_percent(step_size_percent) == 0:
             step = 1
         elif _to_percent(step_size_percent) == 100:
@@ -239,56 +1112,62 @@ class DatasetManager:
         else:
             res = resolution_percent / 100
 
-        # we'll read along the side that is shorter
-        # e.g. raster size 100x50 -> read along y=50
-        if x_size >= y_size:
-            buf_x = int(x_size * res) if int(x_size * res) > 0 else 1
-            buf_y = int(1 * res) if int(1 * res) > 0 else 1
-            with self._lock:
-                data = band.ReadAsMaskedArray(xoff=0, yoff=0, win_xsize=x_size, win_ysize=1, buf_xsize=buf_x, buf_ysize=buf_y)
-            buf_y = int(step * res) if int(step * res) > 0 else 1
-            for i in range(1, y_size, step):
-                if y_size >= i + step:
-                    with self._lock:
-                        win = band.ReadAsMaskedArray(xoff=0, yoff=i, win_xsize=x_size, win_ysize=step, buf_xsize=buf_x, buf_ysize=buf_y)
-                else:
-                    buf_y = int((y_size - i) * res) if int((y_size - i) * res) > 0 else 1
-                    with self._lock:
-                        win = band.ReadAsMaskedArray(xoff=0, yoff=i, win_xsize=x_size, win_ysize=y_size - i, buf_xsize=buf_x, buf_ysize=buf_y)
-                data = np.ma.vstack((data, win))
-        else:
-            buf_x = int(1 * res) if int(1 * res) > 0 else 1
-            buf_y = int(y_size * res) if int(y_size * res) > 0 else 1
-            with self._lock:
-                data = band.ReadAsMaskedArray(xoff=0, yoff=0, win_xsize=1, win_ysize=y_size, buf_xsize=buf_x, buf_ysize=buf_y)
-            buf_x = int(step * res) if int(step * res) > 0 else 1
-            for i in range(1, x_size, step):
-                if x_size >= i + step:
-                    with self._lock:
-                        win = band.ReadAsMaskedArray(xoff=i, yoff=0, win_xsize=step, win_ysize=y_size, buf_xsize=buf_x, buf_ysize=buf_y)
-                else:
-                    buf_x = int((x_size - i) * res) if int((x_size - i) * res) > 0 else 1
-                    with self._lock:
-                        win = band.ReadAsMaskedArray(xoff=i, yoff=0, win_xsize=x_size - i, win_ysize=y_size, buf_xsize=buf_x, buf_ysize=buf_y)
-                data = np.ma.hstack((data, win))
+        with timing.span('decode'):
+            if 0 < self.advise_read_pixels <= x_size * y_size:
+                # lets drivers that support it (e.g. GTiff, remote files) prefetch all blocks of the window at once
+                try:
+                    with dataset.lock:
+                        band.AdviseRead(x0, y0, x_size, y_size, max(1, int(x_size * res)), max(1, int(y_size * res)))
+                except RuntimeError:
+                    pass
+            # we'll read along the side that is shorter
+            # e.g. raster size 100x50 -> read along y=50
+            if x_size >= y_size:
+                buf_x = int(x_size * res) if int(x_size * res) > 0 else 1
+                buf_y = int(1 * res) if int(1 * res) > 0 else 1
+                with dataset.lock:
+                    data = band.ReadAsMaskedArray(xoff=x0, yoff=y0, win_xsize=x_size, win_ysize=1, buf_xsize=buf_x, buf_ysize=buf_y)
+                buf_y = int(step * res) if int(step * res) > 0 else 1
+                for i in range(1, y_size, step):
+                    if y_size >= i + step:
+                        with dataset.lock:
+                            win = band.ReadAsMaskedArray(xoff=x0, yoff=y0 + i, win_xsize=x_size, win_ysize=step, buf_xsize=buf_x, buf_ysize=buf_y)
+                    else:
+                        buf_y = int((y_size - i) * res) if int((y_size - i) * res) > 0 else 1
+                        with dataset.lock:
+                            win = band.ReadAsMaskedArray(xoff=x0, yoff=y0 + i, win_xsize=x_size, win_ysize=y_size - i, buf_xsize=buf_x, buf_ysize=buf_y)
+                    data = np.ma.vstack((data, win))
+            else:
+                buf_x = int(1 * res) if int(1 * res) > 0 else 1
+                buf_y = int(y_size * res) if int(y_size * res) > 0 else 1
+                with dataset.lock:
+                    data = band.ReadAsMaskedArray(xoff=x0, yoff=y0, win_xsize=1, win_ysize=y_size, buf_xsize=buf_x, buf_ysize=buf_y)
+                buf_x = int(step * res) if int(step * res) > 0 else 1
+                for i in range(1, x_size, step):
+                    if x_size >= i + step:
+                        with dataset.lock:
+                            win = band.ReadAsMaskedArray(xoff=x0 + i, yoff=y0, win_xsize=step, win_ysize=y_size, buf_xsize=buf_x, buf_ysize=buf_y)
+                    else:
+                        buf_x = int((x_size - i) * res) if int((x_size - i) * res) > 0 else 1
+                        with dataset.lock:
+                            win = band.ReadAsMaskedArray(xoff=x0 + i, yoff=y0, win_xsize=x_size - i, win_ysize=y_size, buf_xsize=buf_x, buf_ysize=buf_y)
+                    data = np.ma.hstack((data, win))
                 
-        if nodata is not None:
-            data = np.ma.masked_values(data, nodata, atol=indcal.FLOAT_PRECISION)
-            data = np.ma.masked_invalid(data)
-        elif dataset.no_data is not None:
-            data = np.ma.masked_values(data, dataset.no_data, atol=indcal.FLOAT_PRECISION)
-            data = np.ma.masked_invalid(data)
-        else:
-            data = np.ma.array(data, mask=False)
-        clouds = self.get_cloud_mask()
-        if clouds is not None:
-            if resolution_percent != 100:
-                x = np.linspace(0, clouds.shape[0] - 1, data.shape[0]).astype(int)
-                y = np.linspace(0, clouds.shape[1] - 1, data.shape[1]).astype(int)
-                data.mask |= clouds[np.ix_(x, y)]
+            if nodata is not None:
+                data = np.ma.masked_values(data, nodata, atol=indcal.FLOAT_PRECISION)
+                data = np.ma.masked_invalid(data)
+            elif dataset.no_data is not None:
+                data = np.ma.masked_values(data, dataset.no_data, atol=indcal.FLOAT_PRECISION)
+                data = np.ma.masked_invalid(data)
             else:
+                data = np.ma.array(data, mask=False)
+            clouds = self.get_cloud_mask(data.shape)
+            if clouds is not None:
                 data.mask |= clouds
-        return np.ma.array(data, dtype=np.float32)
+            outside = self.get_aoi_mask(dataset_id, data.shape)
+            if outside is not None:
+                data.mask |= outside
+            return np.ma.array(data, dtype=dtype)
 
 class IndexErr:
     def __init__(self, code: int, msg: str):
@@ -300,6 +1179,30 @@ class GdalExecutor:
     SUPPORTED_PROTOCOL_VERSIONS = ('3.2.1')
     SUPPORTED_INDICES = ('test', 'water_mask', 'ndbi', 'wi2015', 'andwi', 'ndwi', 'nsmi', 'oc3', 'oc3_concentration', 'cdom_ndwi', 'toa_temperature_landsat', 'ls_temperature_landsat')
     WATER_EXTRACTION_INDICES = ('wi2015', 'andwi', 'ndwi')
+    NAT_COL_CLIP_PERCENT = 2
+    MASK_OVERLAY_COLOR = (255, 0, 0, 165)
+    MASK_OVERLAY_CACHE_SIZE = 8
+    PREVIEW_WORKERS = 4
+    COARSE_PREVIEW_SIZE = 256
+    ZONE_CACHE_SIZE = 4
+    WATER_BODY_CACHE_SIZE = 2
+    # number of band reads per index, for memory estimates
+    INDEX_INPUTS = {
+        'test': 2, 'water_mask': 1, 'ndbi': 2, 'ndvi': 2, 'wi2015': 5, 'andwi': 6, 'ndwi': 2, 'nsmi': 3, 'oc3': 3, 'oc3_concentration': 3, 'cdom_ndwi': 2,
+        'toa_temperature_landsat': 1, 'ls_temperature_landsat': 8, 'nat_col': 3
+    }
+    # bytes per pixel: a masked float32 band with its conversion temporaries; formula temporaries, the result, its in-memory copy and statistics; labeling
+    BYTES_PER_INPUT_PIXEL = 16
+    BYTES_PER_OUTPUT_PIXEL = 24
+    BYTES_PER_LABEL_PIXEL = 24
+    REFINE_WAIT = 60
+    SNAPSHOT_FILE = 'session.json'
+    SNAPSHOT_VERSION = 1
+    # GDAL configuration options set at construction. A value comes from the environment variable of the same name if it is set (GDAL reads it itself), else from the "gdal" section of the JSON file at $GDAL_TUNING_FILE, else from 'tuning_defaults'
+    TUNING_OPTIONS = ('GDAL_CACHEMAX', 'GDAL_NUM_THREADS', 'GTIFF_DIRECT_IO', 'VSI_CACHE', 'VSI_CACHE_SIZE')
+    # requests that do not keep the prefetcher waiting
+    PREFETCH_IGNORED = ('PING', 'session_stats', 'gdal_diagnostics')
+    PREFETCH_PREVIEW_SIZE = (1024, 1024)
     SUPPORTED_SATELLITES = {
         'Landsat 8/9': ('L1TP', 'L2SP')
     }
@@ -312,12 +1215,238 @@ class GdalExecutor:
     def __init__(self, protocol: 'Protocol'):
         self.supported_operations = protocol.get_supported_operations()
         self.ds_man = DatasetManager()
-        self.pv_man = PreviewManager()
+        self.pv_man = PreviewManager(self._regenerate_preview)
         self.geotiff = gdal.GetDriverByName('GTiff')
         self.satellite = None
         self.proc_level = None
+        self.preview_colormaps = {}
+        self._mask_overlays = {}
+        self._mask_lock = threading.Lock()
+        self._preview_pool = ThreadPoolExecutor(self.PREVIEW_WORKERS, thread_name_prefix='preview')
+        self._channel_pool = ThreadPoolExecutor(3, thread_name_prefix='channel')
+        self._zones = {}
+        self._zones_lock = threading.Lock()
+        self._water_bodies = {}
+        self._water_bodies_lock = threading.Lock()
+        budget = os.environ.get('MEMORY_BUDGET_MB')
+        self.admission = AdmissionController(int(budget) * 1024 * 1024 if budget else AdmissionController.DEFAULT_BUDGET, strict=os.environ.get('MEMORY_BUDGET_STRICT', '0') == '1')
+        self.tuning = self._tune_gdal(os.environ.get('GDAL_TUNING_FILE'))
+        self._computing = {}
+        self._computing_lock = threading.Lock()
+        self._session = 0
+        self.prefetcher = Prefetcher()
+        self.prefetch_indices, self.prefetch_previews, self.prefetch_preview_size = self._prefetch_config()
         print(f'Server running version {self.VERSION}')
 
+    def _prefetch_config(self) -> (tuple[str], tuple[str], tuple[int, int]):
+        """Reads indices and previews to prefetch from environment variables PREFETCH_INDICES and PREFETCH_PREVIEWS (comma-separated names) and the preview size from PREFETCH_PREVIEW_SIZE ('<width>x<height>'). Unknown names are reported and ignored."""
+
+        def _names(variable: str, supported: tuple[str]) -> tuple[str]:
+            names = []
+            for name in os.environ.get(variable, '').split(','):
+                name = name.strip()
+                if name == '':
+                    continue
+                if name not in supported:
+                    print(f"{variable}: '{name}' is not supported and is not prefetched")
+                    continue
+                names.append(name)
+            return tuple(dict.fromkeys(names))
+
+        indices = _names('PREFETCH_INDICES', self.SUPPORTED_INDICES)
+        previews = _names('PREFETCH_PREVIEWS', self.SUPPORTED_INDICES + ('nat_col',))
+        size = self.PREFETCH_PREVIEW_SIZE
+        if os.environ.get('PREFETCH_PREVIEW_SIZE'):
+            try:
+                width, height = (int(x) for x in os.environ['PREFETCH_PREVIEW_SIZE'].lower().split('x'))
+                if width <= 0 or height <= 0:
+                    raise ValueError
+                size = (width, height)
+            except ValueError:
+                print(f"PREFETCH_PREVIEW_SIZE: '{os.environ['PREFETCH_PREVIEW_SIZE']}' is not '<width>x<height>', {size[0]}x{size[1]} is used")
+        return indices, previews, size
+
+    @staticmethod
+    def tuning_defaults() -> dict:
+        """Returns default values of TUNING_OPTIONS for this host: 10% of physical memory for the block cache, decompression on all cores, buffered I/O and a 64 MB cache of file reads."""
+
+        return {
+            'GDAL_CACHEMAX': '10%',
+            'GDAL_NUM_THREADS': str(os.cpu_count() or 1),
+            'GTIFF_DIRECT_IO': 'NO',
+            'VSI_CACHE': 'TRUE',
+            'VSI_CACHE_SIZE': str(64 * 1024 * 1024)
+        }
+
+    def _tune_gdal(self, filename: str=None) -> dict:
+        """Sets GDAL configuration options, see TUNING_OPTIONS, and the AdviseRead threshold of the dataset manager ("advise_read_pixels" key of the tuning file). Returns where every value came from.
+        An unreadable tuning file is reported and ignored."""
+
+        config = {}
+        if filename is not None:
+            try:
+                with open(filename, 'r', encoding='utf-8') as f:
+                    config = json.load(f)
+                if type(config) is not dict or type(config.get('gdal', {})) is not dict:
+                    raise ValueError('must be a JSON object with an optional "gdal" object')
+            except (OSError, ValueError) as e:
+                print(f'GDAL tuning file {filename} is ignored: {e}')
+                config, filename = {}, None
+
+        sources = {}
+        defaults, file_options = self.tuning_defaults(), config.get('gdal', {})
+        for option in self.TUNING_OPTIONS:
+            if os.environ.get(option) is not None:
+                sources[option] = 'environment'
+                continue
+            if option in file_options:
+                value, sources[option] = str(file_options[option]), 'file'
+            else:
+                value, sources[option] = defaults[option], 'default'
+            gdal.SetConfigOption(option, value)
+
+        advise = config.get('advise_read_pixels')
+        if type(advise) is int and advise >= 0:
+            self.ds_man.advise_read_pixels = advise
+        return {
+            'file': filename,
+            'sources': sources
+        }
+
+    def get_gdal_diagnostics(self) -> dict:
+        """Returns effective values of TUNING_OPTIONS with their sources, block cache usage and the AdviseRead threshold."""
+
+        return {
+            'gdal_version': gdal.VersionInfo('RELEASE_NAME'),
+            'cpus': os.cpu_count(),
+            'options': {option: {'value': gdal.GetConfigOption(option), 'source': self.tuning['sources'][option]} for option in self.TUNING_OPTIONS},
+            'cache': {
+                'max': gdal.GetCacheMax(),
+                'used': gdal.GetCacheUsed()
+            },
+            'advise_read_pixels': self.ds_man.advise_read_pixels,
+            'tuning_file': self.tuning['file']
+        }
+
+    def _admission(self, kind: str, index: str, pixels: int=None) -> Admission:
+        """Returns an admission request for operation 'kind' on 'index' over 'pixels' pixels (the AOI window of the imported bands if None), see 'AdmissionController'."""
+
+        if pixels is None:
+            size = self.ds_man.get_band_size()
+            pixels = size[0] * size[1] if size is not None else 0
+        if kind == 'water_bodies':
+            return self.admission.estimate(kind, pixels * self.BYTES_PER_LABEL_PIXEL)
+        return self.admission.estimate(kind, pixels * (self.INDEX_INPUTS.get(index, 3) * self.BYTES_PER_INPUT_PIXEL + self.BYTES_PER_OUTPUT_PIXEL))
+
+    def _calc_index(self, index: str, speculative: bool=False) -> (IndexErr, int):
+        """Returns (None, id) of an already calculated or a newly calculated 'index' and (err, None) on failure. Concurrent calls for the same index calculate it once.
+        A 'speculative' calculation (prefetch) does not wait for memory or for another calculation of the index and is dropped if the session ends meanwhile; it returns (None, None) when it does nothing."""
+
+        while True:
+            existing = self.ds_man.find(index)
+            if existing is not None:
+                if not speculative:
+                    metrics.cache_lookup('index', True)
+                return None, existing
+            with self._computing_lock:
+                computing = self._computing.get(index)
+                if computing is None:
+                    computing = self._computing[index] = threading.Event()
+                    break
+            if speculative:
+                return None, None
+            # calculated by someone else; if that failed, the loop calculates it here
+            computing.wait()
+
+        if not speculative:
+            metrics.cache_lookup('index', False)
+        session = self._session
+        try:
+            admission = self._admission('calc_index', index)
+            if speculative:
+                if not self.admission.try_acquire(admission):
+                    return None, None
+            elif not self.admission.acquire(admission):
+                return IndexErr(20200, f"server is busy: not enough memory to calculate index '{index}'"), None
+            try:
+                with timing.span('kernel'):
+                    err, res = self._index(index)
+                if err is not None:
+                    return err, None
+                geotransform, projection, result, data_type, nodata, ph_unit, notes_ = res
+
+                with timing.span('write'):
+                    res_ds = gdal.GetDriverByName('MEM').Create('', result.shape[1], result.shape[0], 1, data_type)
+                    res_ds.SetGeoTransform(geotransform)
+                    res_ds.SetProjection(projection)
+                    res_ds.GetRasterBand(1).SetNoDataValue(nodata)
+                    res_ds.GetRasterBand(1).WriteArray(result)
+                with timing.span('stats'):
+                    stats = {
+                        'min': np.nanmin(result).item(),
+                        'max': np.nanmax(result).item(),
+                        'mean': np.nanmean(result).item(),
+                        'stdev': np.nanstd(result).item(),
+                        'ph_unit': ph_unit
+                    }
+            finally:
+                self.admission.release(admission)
+            if speculative and session != self._session:
+                return None, None
+            dataset_id = self.ds_man.add_index(res_ds, index, nodata, stats)
+            if index == 'water_mask':
+                with self._mask_lock:
+                    self._mask_overlays = {}
+            self.ds_man.add_description(dataset_id, notes=notes_)
+            return None, dataset_id
+        finally:
+            with self._computing_lock:
+                del self._computing[index]
+            computing.set()
+
+    def _prefetch_index(self, index: str, session: int) -> bool:
+        if session != self._session:
+            return False
+        err, dataset_id = self._calc_index(index, speculative=True)
+        return err is None and dataset_id is not None
+
+    def _prefetch_preview(self, index: str, session: int) -> bool:
+        """Renders the final preview of 'index' at PREFETCH_PREVIEW_SIZE unless it or a larger one exists. Smaller previews are then downscaled from it, see '_preview'."""
+
+        if session != self._session:
+            return False
+        width, height = self.prefetch_preview_size
+        err, size = self._preview_size(index, width, height)
+        if err is not None or self.pv_man.find(index, width, height) is not None or self.pv_man.find_larger(index, size[2], size[3]) is not None:
+            return False
+        admission = self._admission('calc_preview', index, size[2] * size[3])
+        if not self.admission.try_acquire(admission):
+            return False
+        try:
+            err, res = self._preview(index, width, height)
+        finally:
+            self.admission.release(admission)
+        if err is not None or session != self._session:
+            return False
+        self.pv_man.add(res[0], index, width, height, res[1])
+        return True
+
+    def _schedule_prefetch(self) -> None:
+        """Schedules prefetching of the configured previews and indices for the current session: natural colour first, then every index followed by its preview."""
+
+        session, tasks = self._session, []
+        if 'nat_col' in self.prefetch_previews:
+            tasks.append(lambda: self._prefetch_preview('nat_col', session))
+        for index in self.prefetch_indices:
+            tasks.append(lambda index=index: self._prefetch_index(index, session))
+            if index in self.prefetch_previews:
+                tasks.append(lambda index=index: self._prefetch_preview(index, session))
+        for index in self.prefetch_previews:
+            if index != 'nat_col' and index not in self.prefetch_indices:
+                tasks.append(lambda index=index: self._prefetch_preview(index, session))
+        if len(tasks) > 0:
+            self.prefetcher.schedule(tasks)
+
     def _index(self, index: str) -> (IndexErr, (tuple[float], str, np.ma.MaskedArray, gdal.GDT_Float32, float | int, str, str)):
         """Returns (None, (...)) on success and (err, ()) on failure."""
 
@@ -334,26 +1463,27 @@ class GdalExecutor:
                 ds = self.ds_man.get(id_)
                 inp = self.ds_man.read_band(id_, 1)
                 if len(projection) <= 0:
-                    geotransform = ds.dataset.GetGeoTransform()
+                    geotransform = self.ds_man.get_geotransform(id_)
                     projection = ds.dataset.GetProjection()
-                if self.satellite == 'Landsat 8/9':
-                    if self.proc_level == 'L1TP':
-                        if convert_to =='toa_rad':
-                            inp = indcal.landsat_l1_dn_to_toa_radiance(inp, ds.radio_mult, ds.radio_add, nodata)
-                            notes = 'Рассчитано по излучению верхнего слоя атмосферы.'
-                        if convert_to == 'toa_refl':
-                            sun_elev, es_dist = self.ds_man.get_sun_elevation(), self.ds_man.get_earth_sun_distance()
-                            inp = indcal.landsat_l1_dn_to_toa_reflectance(inp, ds.radio_mult, ds.radio_add, sun_elev, es_dist, ds.rad_max, ds.refl_max, nodata)
-                            notes = 'Рассчитано по отражательной способности верхнего слоя атмосферы.'
-                        # if convert_to == 'ls_rad':
-                        if convert_to == 'ls_refl':
-                            sun_elev, es_dist = self.ds_man.get_sun_elevation(), self.ds_man.get_earth_sun_distance()
-                            inp = indcal.landsat_l1_dn_to_dos1_reflectance(inp, ds.radio_mult, ds.radio_add, sun_elev, es_dist, ds.rad_max, ds.refl_max, nodata)
-                            notes = 'Рассчитано по отражательной способности поверхности Земли, корректировка влияния атмосферы методом DOS1.'
-                    if self.proc_level == 'L2SP':
-                        if convert_to == 'ls_refl':
-                            inp = indcal.landsat_l2_dn_to_ls_reflectance(inp, nodata)
-                            notes = 'Рассчитано по отражательной способности поверхности Земли.'
+                with timing.span('convert'):
+                    if self.satellite == 'Landsat 8/9':
+                        if self.proc_level == 'L1TP':
+                            if convert_to =='toa_rad':
+                                inp = indcal.landsat_l1_dn_to_toa_radiance(inp, ds.radio_mult, ds.radio_add, nodata)
+                                notes = 'Рассчитано по излучению верхнего слоя атмосферы.'
+                            if convert_to == 'toa_refl':
+                                sun_elev, es_dist = self.ds_man.get_sun_elevation(), self.ds_man.get_earth_sun_distance()
+                                inp = indcal.landsat_l1_dn_to_toa_reflectance(inp, ds.radio_mult, ds.radio_add, sun_elev, es_dist, ds.rad_max, ds.refl_max, nodata)
+                                notes = 'Рассчитано по отражательной способности верхнего слоя атмосферы.'
+                            # if convert_to == 'ls_rad':
+                            if convert_to == 'ls_refl':
+                                sun_elev, es_dist = self.ds_man.get_sun_elevation(), self.ds_man.get_earth_sun_distance()
+                                inp = indcal.landsat_l1_dn_to_dos1_reflectance(inp, ds.radio_mult, ds.radio_add, sun_elev, es_dist, ds.rad_max, ds.refl_max, nodata)
+                                notes = 'Рассчитано по отражательной способности поверхности Земли, корректировка влияния атмосферы методом DOS1.'
+                        if self.proc_level == 'L2SP':
+                            if convert_to == 'ls_refl':
+                                inp = indcal.landsat_l2_dn_to_ls_reflectance(inp, nodata)
+                                notes = 'Рассчитано по отражательной способности поверхности Земли.'
                 # if self.satellite == 'Sentinel 2':
                 inputs.append(inp)
             return None, (geotransform, projection, notes, inputs)
@@ -525,7 +1655,7 @@ class GdalExecutor:
                 if id_ is None:
                     return IndexErr(20502, f"unable to calculate index '{index}': {self.satellite} band number 10 is needed"), ()
                 ds = self.ds_man.get(id_)
-                geotransform = ds.dataset.GetGeoTransform()
+                geotransform = self.ds_man.get_geotransform(id_)
                 projection = ds.dataset.GetProjection()
                 result = self.ds_man.read_band(id_, 1)
                 result = indcal.landsat_l2_dn_to_ls_temperature(result, nodata, 'C')
@@ -545,10 +1675,325 @@ class GdalExecutor:
             result = indcal.ndbi(*inputs, nodata)
         return None, (geotransform, projection, result, data_type, nodata, ph_unit, notes)
 
+    def _preview_size(self, index: str, width: int, height: int) -> (IndexErr, (list[int], float, int, int)):
+        """Finds datasets needed for a preview of 'index' for a 'width' x 'height' request and the preview's actual size.
+        Returns (None, (dataset ids, resolution percent, width, height)) on success and (err, None) on failure."""
+
+        ids = []
+        if index == 'nat_col':
+            if self.satellite == 'Landsat 8/9':
+                ids.append(self.ds_man.find("4"))
+                ids.append(self.ds_man.find("3"))
+                ids.append(self.ds_man.find("2"))
+                for num, id_ in zip((4, 3, 2), ids):
+                    if id_ is None:
+                        return IndexErr(20401, f"{self.satellite} band number '{num}' is not loaded but needed for preview generation"), None
+        else:
+            ids.append(self.ds_man.find(index))
+            if ids[0] is None:
+                return IndexErr(20401, f"index '{index}' is not calculated but needed for preview generation"), None
+        # error 20402
+
+        _, _, x_size, y_size = self.ds_man.get_window(ids[0])
+        res = 0
+        if height <= width:
+            res = height / y_size * 100
+        else:
+            res = width / x_size * 100
+
+        pv_width = max(1, int(x_size * res / 100))
+        pv_height = max(1, int(y_size * res / 100))
+        return None, (ids, res, pv_width, pv_height)
+
+    def _preview(self, index: str, width: int, height: int) -> (IndexErr, (np.ndarray, np.typing.NDArray[bool])):
+        """Renders a preview of 'index' for a 'width' x 'height' request: a grayscale array for indices or an RGB array for 'nat_col', and an alpha mask where False=transparent. Reuses a larger cached preview of the same index if there is one.
+        Returns (None, (array, alpha)) on success and (err, None) on failure."""
+
+        err, size = self._preview_size(index, width, height)
+        if err is not None:
+            return err, None
+        ids, res, pv_width, pv_height = size
+
+        larger = self.pv_man.find_larger(index, pv_width, pv_height)
+        metrics.cache_lookup('preview_downscale', larger is not None)
+        if larger is not None:
+            try:
+                pv = self.pv_man.get(larger)
+            except (KeyError, PreviewBusyError):
+                pv = None
+            if pv is not None:
+                if pv.width == pv_width and pv.height == pv_height:
+                    return None, (pv.array, pv.get_alpha())
+                array = np.asarray(pv.image().resize((pv_width, pv_height), Image.Resampling.BOX))
+                return None, (array[..., 0] if array.shape[2] == 2 else array[..., :3], array[..., -1] > 127)
+
+        r, g, b = 0, 0, 0
+        if index != 'nat_col':
+            r = self.ds_man.read_band(ids[0], 1, resolution_percent=res)
+            with timing.span('stretch'):
+                r = indcal.map_to_8bit(r)
+            return None, (np.ma.getdata(r), ~np.ma.getmaskarray(r))
+        # channels are separate datasets with their own locks, so they are read concurrently
+        r, g, b = self._channel_pool.map(timing.bind(lambda id_: self.ds_man.read_band(id_, 1, resolution_percent=res, dtype=None)), ids)
+        with timing.span('stretch'):
+            r, g, b = indcal.map_rgb_to_8bit(r, g, b, self.NAT_COL_CLIP_PERCENT, normalize_brightness=True)
+        alpha = ~(np.ma.getmaskarray(r) | np.ma.getmaskarray(g) | np.ma.getmaskarray(b))
+        return None, (np.dstack((np.ma.getdata(r), np.ma.getdata(g), np.ma.getdata(b))), alpha)
+
+    def _calc_preview(self, index: str, width: int, height: int) -> (IndexErr, int):
+        """Returns (None, id) of an existing or a newly rendered preview of 'index' for a 'width' x 'height' request and (err, None) on failure.
+        A preview much larger than COARSE_PREVIEW_SIZE is first stored as a coarse one and refined to the requested size in the background, see 'PreviewManager.refine'."""
+
+        existing = self.pv_man.find(index, width, height)
+        metrics.cache_lookup('preview', existing is not None)
+        if existing is not None:
+            return None, existing
+
+        err, size = self._preview_size(index, width, height)
+        if err is not None:
+            return err, None
+        pv_width, pv_height = size[2:]
+        scale = self.COARSE_PREVIEW_SIZE / max(pv_width, pv_height)
+        if scale > 0.5 or self.pv_man.find_larger(index, pv_width, pv_height) is not None:
+            admission = self._admission('calc_preview', index, pv_width * pv_height)
+            if not self.admission.acquire(admission):
+                return IndexErr(20200, f"server is busy: not enough memory to render a preview of '{index}'"), None
+            try:
+                err, res = self._preview(index, width, height)
+            finally:
+                self.admission.release(admission)
+            if err is not None:
+                return err, None
+            array, alpha = res
+            return None, self.pv_man.add(array, index, width, height, alpha)
+
+        # large previews are answered with a coarse one first and refined under the same id in the background
+        err, res = self._preview(index, max(1, int(width * scale)), max(1, int(height * scale)))
+        if err is not None:
+            return err, None
+        array, alpha = res
+        pv_id = self.pv_man.add(array, index, width, height, alpha, final=False)
+        self._preview_pool.submit(self._refine_preview, pv_id, index, width, height)
+        return None, pv_id
+
+    def _regenerate_preview(self, index: str, width: int, height: int) -> 'tuple[np.ndarray, np.typing.NDArray[bool]] | None':
+        """Renderer of 'pv_man': renders an evicted preview again under admission, like '_calc_preview' does. Returns (array, alpha) or None on failure and raises 'PreviewBusyError' if memory is not available."""
+
+        err, size = self._preview_size(index, width, height)
+        if err is not None:
+            return None
+        admission = self._admission('calc_preview', index, size[2] * size[3])
+        if not self.admission.acquire(admission):
+            raise PreviewBusyError(self.admission.retry_after())
+        try:
+            err, res = self._preview(index, width, height)
+        finally:
+            self.admission.release(admission)
+        return res if err is None else None
+
+    def _refine_preview(self, id_: int, index: str, width: int, height: int) -> None:
+        """Renders the final preview in the background. If it fails or memory is not available in REFINE_WAIT seconds, the coarse preview is kept and marked final, see 'PreviewManager.finalize'."""
+
+        try:
+            err, size = self._preview_size(index, width, height)
+            if err is None:
+                admission = self._admission('calc_preview', index, size[2] * size[3])
+                if self.admission.acquire(admission, self.REFINE_WAIT):
+                    try:
+                        err, res = self._preview(index, width, height)
+                    finally:
+                        self.admission.release(admission)
+                    if err is None:
+                        self.pv_man.refine(id_, *res)
+                        return
+        except Exception as e:
+            print(f'Preview refinement failed: {e}')
+        self.pv_man.finalize(id_)
+
+    def _zone_labels(self, dataset_id: int, zones: dict | str) -> (IndexErr, (np.typing.NDArray[np.uint32], int)):
+        """Rasterizes 'zones' onto the grid of dataset 'dataset_id' and returns (None, (labels, number of zones)) on success and (err, None) on failure. In the label grid 0 is no zone and 1..N are zones.
+        'zones' is a GeoJSON FeatureCollection, where zone i is the i-th feature, or 'water_mask' for connected water bodies of the water mask.
+        Label grids are cached for the last ZONE_CACHE_SIZE (zones, grid) pairs, so several indices are summarized without rasterizing again."""
+
+        ds = self.ds_man.get(dataset_id).dataset
+        _, _, x_size, y_size = self.ds_man.get_window(dataset_id)
+        grid = (x_size, y_size, self.ds_man.get_geotransform(dataset_id), ds.GetProjection())
+        water_id = None
+        if zones == 'water_mask':
+            water_id = self.ds_man.find('water_mask')
+            if water_id is None:
+                return IndexErr(21301, "water mask is not calculated but needed for 'water_mask' zones"), None
+            key = ('water_mask', water_id, grid)
+        else:
+            key = (json.dumps(zones, sort_keys=True), grid)
+        with self._zones_lock:
+            hit = key in self._zones
+            metrics.cache_lookup('zones', hit)
+            if hit:
+                ret = self._zones.pop(key)
+                self._zones[key] = ret
+                return None, ret
+
+        vectors = ogr.GetDriverByName('Memory').CreateDataSource('')
+        if water_id is not None:
+            err, res = self._label_water_bodies(0)
+            if err is not None:
+                return err, None
+            _, labels, count, _ = res
+            water = self.ds_man.get(water_id).dataset
+            if grid == (water.RasterXSize, water.RasterYSize, water.GetGeoTransform(), water.GetProjection()):
+                ret = (labels, count)
+                with self._zones_lock:
+                    self._zones[key] = ret
+                    if len(self._zones) > self.ZONE_CACHE_SIZE:
+                        self._zones.pop(next(iter(self._zones)))
+                return None, ret
+            # water bodies are numbered as in 'water_bodies', polygons of a body keep its number
+            src = gdal.GetDriverByName('MEM').Create('', water.RasterXSize, water.RasterYSize, 1, gdal.GDT_UInt32)
+            src.SetGeoTransform(water.GetGeoTransform())
+            src.SetProjection(water.GetProjection())
+            src.GetRasterBand(1).WriteArray(labels)
+            layer = vectors.CreateLayer('zones', srs=water.GetSpatialRef())
+            layer.CreateField(ogr.FieldDefn('zone', ogr.OFTInteger))
+            gdal.Polygonize(src.GetRasterBand(1), src.GetRasterBand(1), layer, 0, ['8CONNECTED=8'])
+        else:
+            try:
+                source = gdal.OpenEx(json.dumps(zones), gdal.OF_VECTOR)
+            except RuntimeError:
+                return IndexErr(21302, "invalid GeoJSON in 'zones' key"), None
+            layer = vectors.CopyLayer(source.GetLayer(0), 'zones')
+            layer.CreateField(ogr.FieldDefn('zone', ogr.OFTInteger))
+            count = 0
+            for feature in layer:
+                count += 1
+                feature.SetField('zone', count)
+                layer.SetFeature(feature)
+            layer.ResetReading()
+
+        target = gdal.GetDriverByName('MEM').Create('', x_size, y_size, 1, gdal.GDT_UInt32)
+        target.SetGeoTransform(grid[2])
+        target.SetProjection(ds.GetProjection())
+        gdal.RasterizeLayer(target, [1], layer, options=['ATTRIBUTE=zone'])
+        ret = (target.GetRasterBand(1).ReadAsArray(), count)
+
+        with self._zones_lock:
+            self._zones[key] = ret
+            if len(self._zones) > self.ZONE_CACHE_SIZE:
+                self._zones.pop(next(iter(self._zones)))
+        return None, ret
+
+    def _label_water_bodies(self, min_area: int) -> (IndexErr, (int, np.typing.NDArray[np.uint32], int, dict)):
+        """Labels connected water bodies of the water mask, dropping bodies smaller than 'min_area' pixels, see 'indcal.label_components'.
+        Returns (None, (water mask id, labels, number of bodies, table)) on success and (err, None) on failure, where table is 'indcal.component_table' of the labels. Results are cached for the last WATER_BODY_CACHE_SIZE (water mask, 'min_area') pairs."""
+
+        water_id = self.ds_man.find('water_mask')
+        if water_id is None:
+            return IndexErr(21500, "water mask is not calculated but needed for water body labeling"), None
+        key = (water_id, min_area)
+        with self._water_bodies_lock:
+            hit = key in self._water_bodies
+            metrics.cache_lookup('water_bodies', hit)
+            if hit:
+                ret = self._water_bodies.pop(key)
+                self._water_bodies[key] = ret
+                return None, ret
+
+        _, _, x_size, y_size = self.ds_man.get_window(water_id)
+        admission = self._admission('water_bodies', 'water_mask', x_size * y_size)
+        if not self.admission.acquire(admission):
+            return IndexErr(20200, 'server is busy: not enough memory to label water bodies'), None
+        try:
+            water = self.ds_man.read_band(water_id, 1, dtype=None)
+            labels, count = indcal.label_components((water == 2).filled(False), min_area)
+            ret = (water_id, labels, count, indcal.component_table(labels, count))
+        finally:
+            self.admission.release(admission)
+        with self._water_bodies_lock:
+            self._water_bodies[key] = ret
+            if len(self._water_bodies) > self.WATER_BODY_CACHE_SIZE:
+                self._water_bodies.pop(next(iter(self._water_bodies)))
+        return None, ret
+
+    def _reset_session(self) -> None:
+        self._session += 1
+        self.prefetcher.cancel()
+        self.ds_man.close_all()
+        self.pv_man.remove_all()
+        with self._mask_lock:
+            self._mask_overlays = {}
+        with self._zones_lock:
+            self._zones = {}
+        with self._water_bodies_lock:
+            self._water_bodies = {}
+        self.satellite = None
+        self.proc_level = None
+
+    def save_session(self, directory: str) -> (IndexErr, dict):
+        """Saves the session to 'directory': satellite, processing level and the state of the dataset manager, see 'DatasetManager.snapshot'. Data files go to a new generation subdirectory and SNAPSHOT_FILE is replaced last, so an interrupted save leaves the previous snapshot valid. Previous generations are removed afterwards.
+        Returns (None, summary) on success and (err, None) on failure."""
+
+        state = None
+        try:
+            state = self.ds_man.snapshot(directory)
+            state['version'] = self.SNAPSHOT_VERSION
+            state['satellite'] = self.satellite
+            state['proc_level'] = self.proc_level
+            path = os.path.join(directory, self.SNAPSHOT_FILE)
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(state, f)
+            os.replace(path + '.tmp', path)
+        except (OSError, RuntimeError) as e:
+            if state is not None:
+                shutil.rmtree(os.path.join(directory, state['generation']), ignore_errors=True)
+            return IndexErr(21600, f"failed to save session to '{directory}': {e}"), None
+        self.ds_man.discard_snapshots(directory, keep=state['generation'])
+        size = sum(os.path.getsize(os.path.join(directory, f['file'])) for f in state['indices'] + ([state['cloud_mask']] if state['cloud_mask'] is not None else []))
+        return None, {
+            'bands': [band['band'] for band in state['bands']],
+            'indices': [index['index'] for index in state['indices']],
+            'bytes': size + os.path.getsize(path)
+        }
+
+    def load_session(self, directory: str) -> (IndexErr, dict):
+        """Replaces the current session with the one saved to 'directory' by 'save_session'. On failure the session is left empty.
+        Returns (None, summary) on success and (err, None) on failure."""
+
+        try:
+            with open(os.path.join(directory, self.SNAPSHOT_FILE), 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return IndexErr(21700, f"no valid session snapshot in '{directory}'"), None
+        if state.get('version') != self.SNAPSHOT_VERSION or state.get('satellite') not in self.SUPPORTED_SATELLITES:
+            return IndexErr(21700, f"no valid session snapshot in '{directory}'"), None
+
+        self._reset_session()
+        try:
+            self.ds_man.restore(directory, state)
+        except (RuntimeError, ValueError) as e:
+            self._reset_session()
+            return IndexErr(21701, f"failed to restore session from '{directory}': {e}"), None
+        except (OSError, KeyError, TypeError):
+            self._reset_session()
+            return IndexErr(21700, f"no valid session snapshot in '{directory}'"), None
+        self.satellite = state['satellite']
+        self.proc_level = state['proc_level']
+        return None, {
+            'satellite': self.satellite,
+            'proc_level': self.proc_level,
+            'bands': [band['band'] for band in state['bands']],
+            'indices': [index['index'] for index in state['indices']]
+        }
+
     def execute(self, request: dict) -> dict:
         """Processes the request and returns a dictionary to be used by Protocol.send method.
         Must be called after 'Protocol.validate'."""
 
+        if request['operation'] in self.PREFETCH_IGNORED:
+            return self._execute(request)
+        with self.prefetcher.foreground():
+            return self._execute(request)
+
+    def _execute(self, request: dict) -> dict:
         proto_version = request['proto_version']
         server_version = request['server_version']
         id_ = request['id']
@@ -558,6 +2003,8 @@ class GdalExecutor:
         result = {}
 
         def _response(status: int, result: dict) -> dict:
+            if status == 20200:
+                result['retry_after'] = self.admission.retry_after()
             return {
                 'proto_version': proto_version,
                 'server_version': self.VERSION,
@@ -601,9 +2048,7 @@ class GdalExecutor:
                 return _response(20300, {"error": f"provided file '{file}' is not a GeoTiff image"})
 
             if self.satellite == 'Landsat 8/9' and band == 'QA_PIXEL':
-                cloud_mask = self.ds_man.read_band(dataset_id, 1).astype(np.uint16)
-                cloud_mask = indcal.cloud_mask(cloud_mask, 3)
-                self.ds_man.add_cloud_mask(cloud_mask)
+                self.ds_man.set_cloud_source(dataset_id)
             
             geotransform = dataset.GetGeoTransform()
             result = {
@@ -626,53 +2071,32 @@ class GdalExecutor:
             index, width, height = parameters['index'], parameters['width'], parameters['height']
             if index not in self.SUPPORTED_INDICES and index != 'nat_col':
                 return _response(20400, {"error": f"index '{index}' is not supported or unknown"})
-            ids = []
-            if index == 'nat_col':
-                if self.satellite == 'Landsat 8/9':
-                    ids.append(self.ds_man.find("4"))
-                    ids.append(self.ds_man.find("3"))
-                    ids.append(self.ds_man.find("2"))
-                    for num, id__ in zip((4, 3, 2), ids):
-                        if id__ is None:
-                            return _response(20401, {"error": f"{self.satellite} band number '{num}' is not loaded but needed for preview generation"})
-            else:
-                ids.append(self.ds_man.find(index))
-                if ids[0] is None:
-                    return _response(20401, {"error": f"index '{index}' is not calculated but needed for preview generation"})
-            # error 20402
-
-            existing = self.pv_man.find(index, width, height)
-            if existing is not None:
-                return _response(0, {
-                    "url": existing
-                })
-
-            ds = self.ds_man.get(ids[0])
-            res = 0
-            if height <= width:
-                res = height / ds.dataset.RasterYSize * 100
-            else:
-                res = width / ds.dataset.RasterXSize * 100
-            r, g, b, a = 0, 0, 0, 0
-            r = self.ds_man.read_band(ids[0], 1, resolution_percent=res)
-            r = indcal.map_to_8bit(r)
-            a = r.mask
-            if index == 'nat_col':
-                g = self.ds_man.read_band(ids[1], 1, resolution_percent=res)
-                b = self.ds_man.read_band(ids[2], 1, resolution_percent=res)
-                g = indcal.map_to_8bit(g)
-                b = indcal.map_to_8bit(b)
-                a = a | g.mask | b.mask
-            else:
-                g = r
-                b = r
-            a = np.array(np.where(a, 0, 255), dtype=np.uint8)
 
-            pv_id = self.pv_man.add(np.transpose(np.stack((r, g, b, a)), (1, 2, 0)), index)
+            err, pv_id = self._calc_preview(index, width, height)
+            if err is not None:
+                return _response(err.code, {"error": err.msg})
             return _response(0, {
                 "url": pv_id
             })
 
+        if operation == 'calc_previews':
+            if self.satellite is None or self.proc_level is None:
+                return _response(20003, {"error": "request 'calc_previews' was received before 'set_satellite' request"})
+            indices, width, height = list(dict.fromkeys(parameters['indices'])), parameters['width'], parameters['height']
+            for index in indices:
+                if index not in self.SUPPORTED_INDICES and index != 'nat_col':
+                    return _response(21100, {"error": f"index '{index}' is not supported or unknown"})
+
+            urls = {}
+            for index, (err, pv_id) in zip(indices, self._preview_pool.map(timing.bind(lambda index: self._calc_preview(index, width, height)), indices)):
+                if err is not None:
+                    return _response(20200 if err.code == 20200 else 21101, {"error": err.msg})
+                urls[index] = pv_id
+            # error 21102
+            return _response(0, {
+                "urls": urls
+            })
+
         if operation == 'calc_index':
             if self.satellite is None or self.proc_level is None:
                 return _response(20003, {"error": "request 'calc_index' was received before 'set_satellite' request"})
@@ -681,68 +2105,29 @@ class GdalExecutor:
                 return _response(20500, {"error": f"index '{index}' is not supported or unknown"})
             # error 20502
 
-            existing = self.ds_man.find(index)
-            if existing is not None:
-                dataset = self.ds_man.get(existing)
-                ind = dataset.dataset
-                geotransform = ind.GetGeoTransform()
-                return _response(0, {
-                    'url': existing,
-                    'index': index,
-                    'info': {
-                        'width': ind.RasterXSize,
-                        'height': ind.RasterYSize,
-                        'projection': '{}:{}'.format(ind.GetSpatialRef().GetAuthorityName(None), ind.GetSpatialRef().GetAuthorityCode(None)),
-                        'unit': ind.GetSpatialRef().GetAttrValue('UNIT', 0),
-                        'origin': [geotransform[0], geotransform[3]],
-                        'pixel_size': [geotransform[1], geotransform[5]],
-                        'min': dataset.stats['min'],
-                        'max': dataset.stats['max'],
-                        'mean': dataset.stats['mean'],
-                        'stdev': dataset.stats['stdev'],
-                        'ph_unit': dataset.stats['ph_unit']
-                    }
-                })
-
-            err, res = self._index(index)
+            err, dataset_id = self._calc_index(index)
             if err is not None:
                 return _response(err.code, {"error": err.msg})
-            else:
-                geotransform, projection, result, data_type, nodata, ph_unit, notes_ = res
-
-            res_ds = gdal.GetDriverByName('MEM').Create('', result.shape[1], result.shape[0], 1, data_type)
-            res_ds.SetGeoTransform(geotransform)
-            res_ds.SetProjection(projection)
-            res_ds.GetRasterBand(1).SetNoDataValue(nodata)
-            res_ds.GetRasterBand(1).WriteArray(result)
-            stats = {
-                'min': np.nanmin(result).item(),
-                'max': np.nanmax(result).item(),
-                'mean': np.nanmean(result).item(),
-                'stdev': np.nanstd(result).item(),
-                'ph_unit': ph_unit
-            }
-            dataset_id = self.ds_man.add_index(res_ds, index, nodata, stats)
-            self.ds_man.add_description(dataset_id, notes=notes_)
-
-            result = {
+            dataset = self.ds_man.get(dataset_id)
+            ind = dataset.dataset
+            geotransform = ind.GetGeoTransform()
+            return _response(0, {
                 'url': dataset_id,
                 'index': index,
                 'info': {
-                    'width': res_ds.RasterXSize,
-                    'height': res_ds.RasterYSize,
-                    'projection': '{}:{}'.format(res_ds.GetSpatialRef().GetAuthorityName(None), res_ds.GetSpatialRef().GetAuthorityCode(None)),
-                    'unit': res_ds.GetSpatialRef().GetAttrValue('UNIT', 0),
+                    'width': ind.RasterXSize,
+                    'height': ind.RasterYSize,
+                    'projection': '{}:{}'.format(ind.GetSpatialRef().GetAuthorityName(None), ind.GetSpatialRef().GetAuthorityCode(None)),
+                    'unit': ind.GetSpatialRef().GetAttrValue('UNIT', 0),
                     'origin': [geotransform[0], geotransform[3]],
                     'pixel_size': [geotransform[1], geotransform[5]],
-                    'min': stats['min'],
-                    'max': stats['max'],
-                    'mean': stats['mean'],
-                    'stdev': stats['stdev'],
-                    'ph_unit': stats['ph_unit']
+                    'min': dataset.stats['min'],
+                    'max': dataset.stats['max'],
+                    'mean': dataset.stats['mean'],
+                    'stdev': dataset.stats['stdev'],
+                    'ph_unit': dataset.stats['ph_unit']
                 }
-            }
-            return _response(0, result)
+            })
 
         if operation == 'set_satellite':
             satellite, proc_level = parameters['satellite'], parameters['proc_level']
@@ -757,12 +2142,186 @@ class GdalExecutor:
 
         if operation == 'end_session':
             # 20700 !!! TBA with overall cancel mechanism !!!
-            self.ds_man.close_all()
-            self.pv_man.remove_all()
-            self.satellite = None
-            self.proc_level = None
+            self._reset_session()
             return _response(0, {})
 
+        if operation == 'query_pixels':
+            index, points, crs = parameters['index'], parameters['points'], parameters['crs']
+            dataset_id = self.ds_man.find(index)
+            if dataset_id is None:
+                return _response(21200, {"error": f"index or band '{index}' is not calculated or loaded"})
+
+            points = np.array(points, dtype=np.float64)
+            if crs == 'EPSG:4326':
+                dst = self.ds_man.get(dataset_id).dataset.GetSpatialRef()
+                if dst is None:
+                    return _response(21201, {"error": f"unable to transform points to the coordinate system of '{index}': it has no spatial reference"})
+                src = osr.SpatialReference()
+                src.ImportFromEPSG(4326)
+                src.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+                dst = dst.Clone()
+                dst.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+                try:
+                    points = np.array(osr.CoordinateTransformation(src, dst).TransformPoints(points.tolist()))
+                except RuntimeError as e:
+                    return _response(21201, {"error": f"unable to transform points to the coordinate system of '{index}': {e}"})
+            values = self.ds_man.query_pixels(dataset_id, 1, points[:, 0], points[:, 1])
+            return _response(0, {
+                "index": index,
+                "values": [None if masked else value for value, masked in zip(values.data.tolist(), np.ma.getmaskarray(values).tolist())]
+            })
+
+        if operation == 'zonal_stats':
+            index, zones = parameters['index'], parameters['zones']
+            dataset_id = self.ds_man.find(index)
+            if dataset_id is None:
+                return _response(21300, {"error": f"index or band '{index}' is not calculated or loaded"})
+            err, res = self._zone_labels(dataset_id, zones)
+            if err is not None:
+                return _response(err.code, {"error": err.msg})
+            labels, count = res
+            # error 21303
+
+            gt = self.ds_man.get(dataset_id).dataset.GetGeoTransform()
+            pixel_area = abs(gt[1] * gt[5] - gt[2] * gt[4])
+            stats = indcal.zonal_statistics(self.ds_man.read_band(dataset_id, 1), labels, count)
+            stats = {k: v.tolist() for k, v in stats.items()}
+            return _response(0, {
+                "index": index,
+                "zones": [{
+                    "zone": zone,
+                    "count": stats['count'][zone],
+                    "area": stats['count'][zone] * pixel_area,
+                    "min": None if stats['count'][zone] == 0 else stats['min'][zone],
+                    "max": None if stats['count'][zone] == 0 else stats['max'][zone],
+                    "mean": None if stats['count'][zone] == 0 else stats['mean'][zone],
+                    "stdev": None if stats['count'][zone] == 0 else stats['stdev'][zone]
+                } for zone in range(1, count + 1)]
+            })
+
+        if operation == 'set_aoi':
+            aoi, crs = parameters['aoi'], parameters['crs']
+            if aoi is not None:
+                dst = self.ds_man.get_band_spatial_ref()
+                if dst is None:
+                    return _response(21400, {"error": "request 'set_aoi' was received before any band was imported"})
+                dst = dst.Clone()
+                dst.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+                src = osr.SpatialReference()
+                src.ImportFromEPSG(4326)
+                src.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+                geometry = None
+                if type(aoi) is list:
+                    bounds = aoi
+                    if crs == 'EPSG:4326':
+                        corners = osr.CoordinateTransformation(src, dst).TransformPoints([[x, y] for x in (aoi[0], aoi[2]) for y in (aoi[1], aoi[3])])
+                        bounds = [min(c[0] for c in corners), min(c[1] for c in corners), max(c[0] for c in corners), max(c[1] for c in corners)]
+                else:
+                    try:
+                        geometry = ogr.CreateGeometryFromJson(json.dumps(aoi))
+                    except RuntimeError:
+                        geometry = None
+                    if geometry is None or not geometry.IsValid():
+                        return _response(21401, {"error": "invalid GeoJSON geometry in 'aoi' key"})
+                    geometry.AssignSpatialReference(src if crs == 'EPSG:4326' else dst)
+                    if crs == 'EPSG:4326':
+                        geometry.TransformTo(dst)
+                    xmin, xmax, ymin, ymax = geometry.GetEnvelope()
+                    bounds = [xmin, ymin, xmax, ymax]
+                try:
+                    self.ds_man.set_aoi(bounds, geometry)
+                except ValueError:
+                    return _response(21402, {"error": "'aoi' does not overlap the imported bands"})
+            elif self.ds_man.get_aoi() is None:
+                return _response(0, {"aoi": None})
+            else:
+                self.ds_man.set_aoi(None)
+
+            # indices and previews of the previous area are not valid anymore
+            self.ds_man.close_indices()
+            self.pv_man.remove_all()
+            with self._mask_lock:
+                self._mask_overlays = {}
+            with self._zones_lock:
+                self._zones = {}
+            with self._water_bodies_lock:
+                self._water_bodies = {}
+            return _response(0, {"aoi": self.ds_man.get_aoi()})
+
+        if operation == 'water_bodies':
+            min_area = parameters['min_area']
+            water_id = self.ds_man.find('water_mask')
+            if water_id is None:
+                return _response(21500, {"error": "water mask is not calculated but needed for water body labeling"})
+            water = self.ds_man.get(water_id).dataset
+            gt = water.GetGeoTransform()
+            pixel_area = abs(gt[1] * gt[5] - gt[2] * gt[4])
+            err, res = self._label_water_bodies(ceil(min_area / pixel_area - 1e-9))
+            if err is not None:
+                return _response(err.code, {"error": err.msg})
+            _, labels, count, table = res
+            # error 21501
+
+            res_ds = gdal.GetDriverByName('MEM').Create('', water.RasterXSize, water.RasterYSize, 1, gdal.GDT_UInt32)
+            res_ds.SetGeoTransform(gt)
+            res_ds.SetProjection(water.GetProjection())
+            res_ds.GetRasterBand(1).SetNoDataValue(0)
+            res_ds.GetRasterBand(1).WriteArray(labels)
+            existing = self.ds_man.find('water_bodies')
+            if existing is not None:
+                self.ds_man.close(existing)
+            dataset_id = self.ds_man.add_index(res_ds, 'water_bodies', 0, {
+                'min': 1 if count > 0 else 0,
+                'max': count,
+                'mean': None,
+                'stdev': None,
+                'ph_unit': '--'
+            })
+
+            def _map(x, y):
+                return [gt[0] + x * gt[1] + y * gt[2], gt[3] + x * gt[4] + y * gt[5]]
+
+            def _bbox(body):
+                corners = [_map(x, y) for x in (table['xmin'][body], table['xmax'][body] + 1) for y in (table['ymin'][body], table['ymax'][body] + 1)]
+                return [min(c[0] for c in corners), min(c[1] for c in corners), max(c[0] for c in corners), max(c[1] for c in corners)]
+
+            table = {k: v.tolist() for k, v in table.items()}
+            return _response(0, {
+                "url": dataset_id,
+                "bodies": [{
+                    "body": body,
+                    "pixels": table['area'][body],
+                    "area": table['area'][body] * pixel_area,
+                    "bbox": _bbox(body),
+                    "centroid": _map(table['x'][body] + 0.5, table['y'][body] + 0.5)
+                } for body in range(1, count + 1)]
+            })
+
+        if operation == 'save_session':
+            if self.satellite is None or self.proc_level is None:
+                return _response(20003, {"error": "request 'save_session' was received before 'set_satellite' request"})
+            err, res = self.save_session(parameters['dir'])
+            if err is not None:
+                return _response(err.code, {"error": err.msg})
+            return _response(0, res)
+
+        if operation == 'load_session':
+            err, res = self.load_session(parameters['dir'])
+            if err is not None:
+                return _response(err.code, {"error": err.msg})
+            return _response(0, res)
+
+        if operation == 'gdal_diagnostics':
+            return _response(0, self.get_gdal_diagnostics())
+
+        if operation == 'session_stats':
+            return _response(0, {
+                "datasets": self.ds_man.get_memory_stats(),
+                "previews": self.pv_man.get_memory_stats(),
+                "admission": self.admission.get_stats(),
+                "prefetch": self.prefetcher.get_stats()
+            })
+
         if operation == 'import_metafile':
             if self.satellite is None or self.proc_level is None:
                 return _response(20003, {"error": "request 'import_metafile' was received before 'set_satellite' request"})
@@ -880,6 +2439,7 @@ class GdalExecutor:
                             continue
                 if count + count_1_9 + count_10_11 == 0:
                     return _response(20800, {"error": f"metadata file '{filename}' is either invalid or does not contain calibration coefficients"})
+            self._schedule_prefetch()
             return _response(0, {
                 "loaded": count_1_9 / 4 + count_10_11 / 5
             })
@@ -938,6 +2498,36 @@ class GdalExecutor:
         return ret
         # return np.ma.array(mask, dtype=np.bool)
 
+    def get_mask_overlay(self, width: int, height: int) -> Image.Image | None:
+        """Returns an RGBA image where water pixels are filled with MASK_OVERLAY_COLOR and the rest is transparent, sized as 'get_water_mask' with the same arguments. Returns None if water mask was not created.
+        Overlays are cached per (water mask version, width, height) for the last MASK_OVERLAY_CACHE_SIZE sizes. The version is the id of the water mask dataset, so a newly calculated mask never hits a stale overlay."""
+
+        version = self.ds_man.find('water_mask')
+        if version is None:
+            return None
+
+        key = (version, width, height)
+        with self._mask_lock:
+            hit = key in self._mask_overlays
+            metrics.cache_lookup('mask_overlay', hit)
+            if hit:
+                ret = self._mask_overlays.pop(key)
+                self._mask_overlays[key] = ret
+                return ret
+
+        water = self.get_water_mask(width, height)
+        if water is None:
+            return None
+        overlay = np.zeros((water.shape[0], water.shape[1], 4), dtype=np.uint8)
+        overlay[water.filled(False)] = self.MASK_OVERLAY_COLOR
+        ret = Image.fromarray(overlay)
+
+        with self._mask_lock:
+            self._mask_overlays[key] = ret
+            if len(self._mask_overlays) > self.MASK_OVERLAY_CACHE_SIZE:
+                self._mask_overlays.pop(next(iter(self._mask_overlays)))
+        return ret
+
     def get_version(self) -> str:
         return self.VERSION
 
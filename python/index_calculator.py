@@ -2,17 +2,108 @@ import numpy as np
 
 FLOAT_PRECISION = 1e-6
 
-def map_to_8bit(array: np.ma.MaskedArray) -> np.ma.MaskedArray[np.uint8]:
-    """Fits 'array's values into [0; 255] range and returns a new masked array of uint8 type.
+COLORMAPS = {
+    'viridis': ((68, 1, 84), (59, 82, 139), (33, 145, 140), (94, 201, 98), (253, 231, 37)),
+    'blues': ((247, 251, 255), (198, 219, 239), (107, 174, 214), (33, 113, 181), (8, 48, 107)),
+    'rdylbu': ((165, 0, 38), (244, 109, 67), (255, 255, 191), (116, 173, 209), (49, 54, 149))
+}
+
+def colormap_lut(name: str) -> np.typing.NDArray[np.uint8]:
+    """Returns a (256, 3) lookup table mapping 8 bit values to RGB colors of colormap 'name' from COLORMAPS."""
+
+    if name not in COLORMAPS:
+        raise ValueError(f'Unknown colormap "{name}"')
+    anchors = np.array(COLORMAPS[name], dtype=np.float32)
+    x = np.linspace(0, 255, len(anchors))
+    return np.stack([np.interp(np.arange(256), x, anchors[:, i]) for i in range(3)], axis=1).round().astype(np.uint8)
+
+def _stretch(array: np.ma.MaskedArray, clip_percent: float | int, nbins: int) -> (np.typing.NDArray[np.float32] | None, np.typing.NDArray[np.int32], np.ndarray, np.typing.NDArray[bool]):
+    """Builds a histogram of 'array' once and returns (lut, index, hist, mask) for 'map_to_8bit'.
+    'index' holds the histogram bin of every value, masked and NaN values point to the last entry of 'lut' (nbins + 1 entries).
+    'lut' stretches bins between 'clip_percent' and 100 - 'clip_percent' percentiles into [0; 255]. It is None if 'array's range is 0."""
+
+    data = np.ma.getdata(array)
+    mask = np.ma.getmaskarray(array)
+    if data.dtype in (np.uint8, np.uint16):
+        nbins = np.iinfo(data.dtype).max + 1
+        hist = np.bincount(data[~mask], minlength=nbins)
+        index = data.astype(np.int32)
+        np.putmask(index, mask, nbins)
+    else:
+        data = data.astype(np.float32, copy=False)
+        mask = mask | np.isnan(data)
+        valid = data[~mask]
+        if valid.size == 0 or np.isclose(valid.min(), valid.max(), atol=FLOAT_PRECISION):
+            return None, None, None, mask
+        min_, max_ = valid.min(), valid.max()
+        hist, _ = np.histogram(valid, nbins, (min_, max_))
+        index = (data - min_) * np.float32(nbins / (max_ - min_))
+        np.clip(index, 0, nbins - 1, out=index)
+        np.putmask(index, mask, nbins)
+        index = index.astype(np.int32)
+
+    cum_sum = np.cumsum(hist)
+    total = cum_sum[-1]
+    low = np.searchsorted(cum_sum, total * clip_percent / 100, side='right')
+    high = np.searchsorted(cum_sum, total * (1 - clip_percent / 100), side='left')
+    if total == 0 or high <= low:
+        return None, None, None, mask
+    # dividing last keeps the high percentile at exactly 255
+    lut = np.clip((np.arange(nbins + 1, dtype=np.float32) - low) * np.float32(255) / np.float32(high - low), 0, 255)
+    return lut, index, hist, mask
+
+def _apply_lut(lut: np.typing.NDArray[np.float32] | None, index: np.typing.NDArray[np.int32], mask: np.typing.NDArray[bool], gain: float=1) -> np.ma.MaskedArray[np.uint8]:
+    """Maps 'index' through 'lut' multiplied by 'gain' and returns a masked uint8 array where masked values are 0. If 'lut' is None, all values are 0."""
+
+    if lut is None:
+        return np.ma.array(np.zeros(mask.shape, dtype=np.uint8), mask=mask)
+    lut = np.clip(lut * np.float32(gain), 0, 255).astype(np.uint8)
+    lut[-1] = 0
+    return np.ma.array(lut[index], mask=mask)
+
+def _brightness_gain(mean: float) -> float:
+    """Returns a gain that brings an 8 bit image with 'mean' brightness closer to mid-gray."""
+
+    if mean < FLOAT_PRECISION:
+        return 1
+    if mean < 80:
+        return 128 / mean * 0.4
+    if mean > 170:
+        return mean / 128 * 0.6
+    return 1
+
+def normalize_brightness(array: np.typing.NDArray[np.uint8], valid: np.typing.NDArray[bool]=None) -> np.typing.NDArray[np.uint8]:
+    """Scales 8 bit 'array' by the gain used by 'map_rgb_to_8bit' so that the mean brightness of 'valid' pixels (all if None) is neither too dark nor too bright.
+    Returns a new array or 'array' itself if no scaling is needed."""
+
+    values = array if valid is None else array[valid]
+    if values.size == 0:
+        return array
+    gain = _brightness_gain(values.mean())
+    if gain == 1:
+        return array
+    lut = np.clip(np.arange(256, dtype=np.float32) * np.float32(gain), 0, 255).astype(np.uint8)
+    return lut[array]
+
+def map_to_8bit(array: np.ma.MaskedArray, clip_percent: float | int=0, nbins: int=4096) -> np.ma.MaskedArray[np.uint8]:
+    """Fits 'array's values into [0; 255] range and returns a new masked array of uint8 type. Masked and NaN values are set to 0.
+    Values below 'clip_percent' and above 100 - 'clip_percent' percentiles are clipped to 0 and 255. The percentiles are taken from a histogram built once: 'nbins' bins for float arrays and one bin per value for uint8/uint16 arrays. Every value is then mapped through a lookup table built from the histogram.
     If 'array's range is 0, i.e. array.min() == array.max(), all values are set to 0."""
 
-    mask_ = array.mask
-    arr = np.ma.array(np.nan_to_num(array.data, nan=0), mask=mask_)
-    min_, max_ = arr.min(), arr.max()
-    if np.isclose(min_, max_, atol=FLOAT_PRECISION):
-        return np.ma.array(np.zeros(array.shape), mask=mask_, dtype=np.uint8)
-    else:
-        return np.ma.array((arr - min_) / (max_ - min_) * 255, mask=mask_, dtype=np.uint8)
+    lut, index, _, mask = _stretch(array, clip_percent, nbins)
+    return _apply_lut(lut, index, mask)
+
+def map_rgb_to_8bit(red: np.ma.MaskedArray, green: np.ma.MaskedArray, blue: np.ma.MaskedArray, clip_percent: float | int=0, normalize_brightness: bool=False, nbins: int=4096) -> (np.ma.MaskedArray[np.uint8], np.ma.MaskedArray[np.uint8], np.ma.MaskedArray[np.uint8]):
+    """Same as 'map_to_8bit' for each of 'red', 'green' and 'blue' channels.
+    If 'normalize_brightness' is True, all channels are scaled by the same gain so that the mean brightness is neither too dark nor too bright. The mean is taken from the histograms, so no extra pass over the image is needed."""
+
+    channels = [_stretch(c, clip_percent, nbins) for c in (red, green, blue)]
+    gain = 1
+    if normalize_brightness:
+        means = [(hist * lut[:-1]).sum() / hist.sum() for lut, _, hist, _ in channels if lut is not None]
+        if len(means) > 0:
+            gain = _brightness_gain(np.clip(np.mean(means), 0, 255))
+    return tuple(_apply_lut(lut, index, mask, gain) for lut, index, _, mask in channels)
 
 def _otsu_threshold(array: np.ma.MaskedArray, nbins: int) -> float:
     """Using Otsu method, calculates threshold that best divides 'array's values into 2 classes and returns it.
@@ -62,11 +153,155 @@ def cloud_mask(array: np.ma.MaskedArray, bit_pos: int) -> np.ma.MaskedArray[np.b
     if bit_pos < 0 or bit_pos > 15:
         raise ValueError(f'Cloud mask is 16 bit, but bit position {bit_pos} provided')
 
-    ret = np.ma.empty(array.shape, dtype=np.bool)
-    mask = array.mask
-    ret[~mask] = ((array[~mask] & (1 << bit_pos)) >> bit_pos) != 0
-    ret.mask = mask
-    return ret
+    data = np.ma.getdata(array)
+    if not np.issubdtype(data.dtype, np.integer):
+        data = data.astype(np.uint16)
+    return np.ma.array(((data >> bit_pos) & 1).astype(np.bool), mask=np.ma.getmaskarray(array))
+
+def downsample_mask(mask: np.typing.NDArray[bool], shape: tuple[int, int]) -> np.typing.NDArray[bool]:
+    """Resamples boolean 'mask' to 'shape' and returns a new array. A resulting pixel is True if any pixel of the block it covers is True (max pooling).
+    Along an axis where 'shape' is bigger than 'mask's shape, nearest neighbour is used instead."""
+
+    rows = np.arange(shape[0]) * mask.shape[0] // shape[0]
+    cols = np.arange(shape[1]) * mask.shape[1] // shape[1]
+    ret = np.logical_or.reduceat(mask, rows, axis=0)
+    return np.logical_or.reduceat(ret, cols, axis=1)
+
+def zonal_statistics(array: np.ma.MaskedArray, labels: np.typing.NDArray[np.integer], zones: int) -> dict[str, np.ndarray]:
+    """Computes statistics of 'array' for every zone of 'labels' grid of the same shape, where 0 is no zone and 1..'zones' are zone labels. Masked pixels are ignored.
+    Returns a dictionary of 'count', 'min', 'max', 'mean' and 'stdev' arrays of length 'zones' + 1 indexed by zone label. Statistics of empty zones are NaN."""
+
+    valid = ~np.ma.getmaskarray(array) & (labels > 0)
+    lab = labels[valid].astype(np.intp)
+    val = np.ma.getdata(array)[valid].astype(np.float64)
+
+    count = np.bincount(lab, minlength=zones + 1)
+    total = np.bincount(lab, weights=val, minlength=zones + 1)
+    squares = np.bincount(lab, weights=val * val, minlength=zones + 1)
+    min_ = np.full(zones + 1, np.inf)
+    max_ = np.full(zones + 1, -np.inf)
+    np.minimum.at(min_, lab, val)
+    np.maximum.at(max_, lab, val)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+        stdev = np.sqrt(np.maximum(squares / count - mean * mean, 0))
+    empty = count == 0
+    min_[empty], max_[empty], mean[empty], stdev[empty] = np.nan, np.nan, np.nan, np.nan
+    return {'count': count, 'min': min_, 'max': max_, 'mean': mean, 'stdev': stdev}
+
+def _union_find(nodes: int, a: np.typing.NDArray[np.intp], b: np.typing.NDArray[np.intp]) -> np.typing.NDArray[np.intp]:
+    """Resolves equivalences between pairs of nodes 'a' and 'b' out of 0..'nodes' and returns an array that maps every node to the smallest node of its set.
+    Every round hooks all roots to the smallest root they are connected to and then compresses paths by pointer jumping, so the number of rounds is logarithmic in the size of the largest set."""
+
+    parent = np.arange(nodes + 1)
+    while len(a) > 0:
+        ra, rb = parent[a], parent[b]
+        differ = ra != rb
+        if not differ.any():
+            break
+        ra, rb = ra[differ], rb[differ]
+        low = np.minimum(ra, rb)
+        np.minimum.at(parent, ra, low)
+        np.minimum.at(parent, rb, low)
+        while True:
+            jumped = parent[parent]
+            if np.array_equal(jumped, parent):
+                break
+            parent = jumped
+    return parent
+
+def _neighbour_pairs(upper: np.ndarray, lower: np.ndarray, connectivity: int) -> (np.ndarray, np.ndarray):
+    """Returns labels of adjacent foreground pixels of two neighbouring rows (or row blocks) 'upper' and 'lower'. Diagonal neighbours are included for 'connectivity'=8."""
+
+    pairs = [(upper, lower)]
+    if connectivity == 8:
+        pairs.append((upper[..., :-1], lower[..., 1:]))
+        pairs.append((upper[..., 1:], lower[..., :-1]))
+    a = np.concatenate([u[(u > 0) & (l > 0)] for u, l in pairs])
+    b = np.concatenate([l[(u > 0) & (l > 0)] for u, l in pairs])
+    return a, b
+
+def _label_tile(mask: np.typing.NDArray[bool], connectivity: int) -> (np.typing.NDArray[np.uint32], int):
+    """Labels connected components of a single tile, see 'label_components'. Returns (labels, number of components) with labels 1..N not necessarily consecutive."""
+
+    # first pass: every horizontal run of foreground pixels is a node
+    starts = mask.copy()
+    starts[:, 1:] &= ~mask[:, :-1]
+    runs = np.cumsum(starts, dtype=np.uint32).reshape(mask.shape)
+    runs *= mask
+    nodes = int(runs.max()) if runs.size > 0 else 0
+    # second pass: merge runs touching runs of the next row
+    a, b = _neighbour_pairs(runs[:-1], runs[1:], connectivity)
+    if len(a) > 0:
+        keys = np.unique(a.astype(np.int64) * (nodes + 1) + b)
+        a, b = keys // (nodes + 1), keys % (nodes + 1)
+    roots = _union_find(nodes, a, b)
+    return roots.astype(np.uint32)[runs], nodes
+
+def label_components(mask: np.typing.NDArray[bool], min_area: int=0, connectivity: int=8, tile_size: int=1024) -> (np.typing.NDArray[np.uint32], int):
+    """Labels connected components of True pixels of 'mask' and returns (labels, number of components). In the label grid 0 is background and 1..N are components numbered consecutively.
+    'connectivity' is 4 or 8. Components smaller than 'min_area' pixels are removed to background.
+    The mask is labeled in 'tile_size' x 'tile_size' tiles with a two-pass run-based union-find, then components touching across tile borders are merged with one more union-find over the tile labels, so memory for equivalences depends on the tile size, not the raster size."""
+
+    if connectivity not in (4, 8):
+        raise ValueError(f'Connectivity must be 4 or 8, but {connectivity} provided')
+
+    mask = np.asarray(mask, dtype=np.bool)
+    labels = np.zeros(mask.shape, dtype=np.uint32)
+    total = 0
+    for y in range(0, mask.shape[0], tile_size):
+        for x in range(0, mask.shape[1], tile_size):
+            tile, count = _label_tile(mask[y:y + tile_size, x:x + tile_size], connectivity)
+            tile[tile > 0] += total
+            labels[y:y + tile_size, x:x + tile_size] = tile
+            total += count
+
+    # merge across tile borders: only the rows and columns along the seams are compared
+    a, b = [np.empty(0, dtype=np.uint32)], [np.empty(0, dtype=np.uint32)]
+    for y in range(tile_size, mask.shape[0], tile_size):
+        pa, pb = _neighbour_pairs(labels[y - 1], labels[y], connectivity)
+        a.append(pa)
+        b.append(pb)
+    for x in range(tile_size, mask.shape[1], tile_size):
+        pa, pb = _neighbour_pairs(labels[:, x - 1], labels[:, x], connectivity)
+        a.append(pa)
+        b.append(pb)
+    roots = _union_find(total, np.concatenate(a).astype(np.intp), np.concatenate(b).astype(np.intp))
+
+    # consecutive numbering of roots and area filtering through a single lookup table
+    area = np.bincount(roots[labels.ravel()], minlength=total + 1)
+    keep = (roots == np.arange(total + 1)) & (area >= max(min_area, 1))
+    keep[0] = False
+    numbers = np.zeros(total + 1, dtype=np.uint32)
+    numbers[keep] = np.arange(1, np.count_nonzero(keep) + 1, dtype=np.uint32)
+    return numbers[roots][labels], int(np.count_nonzero(keep))
+
+def component_table(labels: np.typing.NDArray[np.integer], count: int, tile_size: int=1024) -> dict[str, np.ndarray]:
+    """Computes the area in pixels, the bounding box and the centroid of every component of 'labels', where 0 is background and 1..'count' are components.
+    Returns a dictionary of 'area', 'xmin', 'ymin', 'xmax', 'ymax' (inclusive pixel offsets), 'x' and 'y' (centroid pixel offsets) arrays of length 'count' + 1 indexed by label. The grid is processed in row tiles of 'tile_size' rows."""
+
+    area = np.zeros(count + 1, dtype=np.int64)
+    sum_x, sum_y = np.zeros(count + 1), np.zeros(count + 1)
+    xmin = np.full(count + 1, np.iinfo(np.int64).max)
+    ymin = np.full(count + 1, np.iinfo(np.int64).max)
+    xmax = np.full(count + 1, -1)
+    ymax = np.full(count + 1, -1)
+    for y in range(0, labels.shape[0], tile_size):
+        rows, cols = np.nonzero(labels[y:y + tile_size])
+        lab = labels[y:y + tile_size][rows, cols].astype(np.intp)
+        rows += y
+        area += np.bincount(lab, minlength=count + 1)
+        sum_x += np.bincount(lab, weights=cols, minlength=count + 1)
+        sum_y += np.bincount(lab, weights=rows, minlength=count + 1)
+        np.minimum.at(xmin, lab, cols)
+        np.minimum.at(ymin, lab, rows)
+        np.maximum.at(xmax, lab, cols)
+        np.maximum.at(ymax, lab, rows)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x, y = sum_x / area, sum_y / area
+    return {'area': area, 'xmin': xmin, 'ymin': ymin, 'xmax': xmax, 'ymax': ymax, 'x': x, 'y': y}
 
 def _full_mask(array: np.ma.MaskedArray, *arrays: np.ma.MaskedArray) -> np.typing.NDArray[bool]:
     """Combines masks from every array into one preserving invalid bits from each mask and returns it."""
@@ -1,6 +1,6 @@
 class Protocol:
     VERSION = '3.2.1'
-    SUPPORTED_OPERATIONS = ('PING', 'SHUTDOWN', 'import_gtiff', 'calc_preview', 'calc_index', 'set_satellite', 'end_session', 'import_metafile', 'generate_description')
+    SUPPORTED_OPERATIONS = ('PING', 'SHUTDOWN', 'import_gtiff', 'calc_preview', 'calc_index', 'set_satellite', 'end_session', 'import_metafile', 'generate_description', 'session_stats', 'calc_previews', 'query_pixels', 'zonal_stats', 'set_aoi', 'water_bodies', 'save_session', 'load_session', 'gdal_diagnostics')
 
     def __init__(self):
         print(f'Using protocol version {self.VERSION}')
@@ -171,6 +171,99 @@ class Protocol:
                 return _response(10901, {"error": "invalid 'lang' key: must be of string type"})
             return _response(0, {})
         
+        if operation == 'session_stats':
+            if len(parameters) != 0:
+                return _response(11000, {"error": "'parameters' must be an empty JSON object for 'session_stats' request"})
+            return _response(0, {})
+        
+        if operation == 'calc_previews':
+            params_check = _check_param_keys('calc_previews', ['indices', 'width', 'height'], list(parameters.keys()))
+            if len(params_check) != 0:
+                return params_check
+            indices, width, height = parameters['indices'], parameters['width'], parameters['height']
+            if type(indices) is not list or len(indices) == 0 or any(type(index) is not str for index in indices):
+                return _response(11100, {"error": "invalid 'indices' key: must be a non-empty array of strings"})
+            if type(width) is not int:
+                return _response(11101, {"error": "invalid 'width' key: must be of integer type"})
+            if type(height) is not int:
+                return _response(11101, {"error": "invalid 'height' key: must be of integer type"})
+            if width <= 0:
+                return _response(11102, {"error": f"invalid width '{width}' in 'width' key: must be > 0"})
+            if height <= 0:
+                return _response(11102, {"error": f"invalid height '{height}' in 'height' key: must be > 0"})
+            return _response(0, {})
+        
+        if operation == 'query_pixels':
+            params_check = _check_param_keys('query_pixels', ['index', 'points', 'crs'], list(parameters.keys()))
+            if len(params_check) != 0:
+                return params_check
+            index, points, crs = parameters['index'], parameters['points'], parameters['crs']
+            if type(index) is not str:
+                return _response(11200, {"error": "invalid 'index' key: must be of string type"})
+            if type(points) is not list or len(points) == 0 or any(
+                type(point) is not list or len(point) != 2 or any(type(c) not in (int, float) for c in point) for point in points
+            ):
+                return _response(11201, {"error": "invalid 'points' key: must be a non-empty array of [x, y] number pairs"})
+            if crs not in ('dataset', 'EPSG:4326'):
+                return _response(11202, {"error": f"invalid crs '{crs}' in 'crs' key: must be 'dataset' or 'EPSG:4326'"})
+            return _response(0, {})
+
+        if operation == 'zonal_stats':
+            params_check = _check_param_keys('zonal_stats', ['index', 'zones'], list(parameters.keys()))
+            if len(params_check) != 0:
+                return params_check
+            index, zones = parameters['index'], parameters['zones']
+            if type(index) is not str:
+                return _response(11300, {"error": "invalid 'index' key: must be of string type"})
+            if not (zones == 'water_mask' or (type(zones) is dict and zones.get('type') == 'FeatureCollection' and type(zones.get('features')) is list)):
+                return _response(11301, {"error": "invalid 'zones' key: must be 'water_mask' or a GeoJSON FeatureCollection"})
+            return _response(0, {})
+
+        if operation == 'set_aoi':
+            params_check = _check_param_keys('set_aoi', ['aoi', 'crs'], list(parameters.keys()))
+            if len(params_check) != 0:
+                return params_check
+            aoi, crs = parameters['aoi'], parameters['crs']
+            if not (
+                aoi is None or
+                (type(aoi) is list and len(aoi) == 4 and all(type(c) in (int, float) for c in aoi) and aoi[0] < aoi[2] and aoi[1] < aoi[3]) or
+                (type(aoi) is dict and aoi.get('type') in ('Polygon', 'MultiPolygon') and type(aoi.get('coordinates')) is list)
+            ):
+                return _response(11400, {"error": "invalid 'aoi' key: must be null, an array [xmin, ymin, xmax, ymax] or a GeoJSON Polygon or MultiPolygon geometry"})
+            if crs not in ('dataset', 'EPSG:4326'):
+                return _response(11401, {"error": f"invalid crs '{crs}' in 'crs' key: must be 'dataset' or 'EPSG:4326'"})
+            return _response(0, {})
+
+        if operation == 'water_bodies':
+            params_check = _check_param_keys('water_bodies', ['min_area'], list(parameters.keys()))
+            if len(params_check) != 0:
+                return params_check
+            min_area = parameters['min_area']
+            if type(min_area) not in (int, float) or min_area < 0:
+                return _response(11500, {"error": "invalid 'min_area' key: must be a number >= 0"})
+            return _response(0, {})
+
+        if operation == 'save_session':
+            params_check = _check_param_keys('save_session', ['dir'], list(parameters.keys()))
+            if len(params_check) != 0:
+                return params_check
+            if type(parameters['dir']) is not str or len(parameters['dir']) == 0:
+                return _response(11600, {"error": "invalid 'dir' key: must be a non-empty string"})
+            return _response(0, {})
+
+        if operation == 'load_session':
+            params_check = _check_param_keys('load_session', ['dir'], list(parameters.keys()))
+            if len(params_check) != 0:
+                return params_check
+            if type(parameters['dir']) is not str or len(parameters['dir']) == 0:
+                return _response(11700, {"error": "invalid 'dir' key: must be a non-empty string"})
+            return _response(0, {})
+
+        if operation == 'gdal_diagnostics':
+            if len(parameters) != 0:
+                return _response(11800, {"error": "'parameters' must be an empty JSON object for 'gdal_diagnostics' request"})
+            return _response(0, {})
+
         return _response(-1, {"error": "how's this even possible?"})
 
     def match(self, request: dict, result: dict) -> dict:
@@ -0,0 +1,209 @@
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Iterable
+
+# Metrics are exposed in the Prometheus text format, see 'render'. Every update is a single uncontended lock
+# acquisition and a few dict operations, so collection is left always on.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+LOCK_WAIT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+_metrics = []
+_collectors = []
+_locks = []
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _labels(names: tuple[str], values: tuple, extra: str='') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _number(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    def __init__(self, name: str, help_: str, labels: tuple[str]=()):
+        self.name = name
+        self.help = help_
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, *label_values, amount: int | float=1) -> None:
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def get(self, *label_values) -> int | float:
+        return self._values.get(label_values, 0)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._values = {}
+
+    def collect(self) -> list[str]:
+        with self._lock:
+            values = list(self._values.items())
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for label_values, value in sorted(values, key=lambda kv: tuple(map(str, kv[0]))):
+            lines.append(f'{self.name}{_labels(self.labels, label_values)} {_number(value)}')
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, help_: str, labels: tuple[str]=(), buckets: tuple[float]=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value: float, *label_values) -> None:
+        """Adds 'value' to the bucket of the smallest upper bound that is >= 'value'. Cumulative counts are only computed on 'collect'."""
+
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                # counts per bucket, the last one is +Inf, then sum
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[i] += 1
+            counts[-1] += value
+
+    def get_count(self, *label_values) -> int:
+        with self._lock:
+            counts = self._values.get(label_values)
+            return 0 if counts is None else sum(counts[:-1])
+
+    def reset(self) -> None:
+        with self._lock:
+            self._values = {}
+
+    def collect(self) -> list[str]:
+        with self._lock:
+            values = [(k, list(v)) for k, v in self._values.items()]
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for label_values, counts in sorted(values, key=lambda kv: tuple(map(str, kv[0]))):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts[:-1]):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_labels(self.labels, label_values, f'le="{_number(bound)}"')} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labels, label_values)} {_number(counts[-1])}')
+            lines.append(f'{self.name}_count{_labels(self.labels, label_values)} {cumulative}')
+        return lines
+
+class TimedLock:
+    """A drop-in replacement for threading.Lock that counts acquisitions and records how long threads waited for it.
+    Uncontended acquisitions are not timed. Statistics are updated while the lock is held, so they need no lock of their own."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._acquisitions = 0
+        self._contentions = 0
+        self._wait = [0] * (len(LOCK_WAIT_BUCKETS) + 1) + [0.0]
+        _locks.append(self)
+
+    def acquire(self, blocking: bool=True, timeout: float=-1) -> bool:
+        if self._lock.acquire(False):
+            self._acquisitions += 1
+            return True
+        if not blocking:
+            return False
+        start = time.perf_counter()
+        if not self._lock.acquire(True, timeout):
+            return False
+        waited = time.perf_counter() - start
+        self._acquisitions += 1
+        self._contentions += 1
+        self._wait[bisect_left(LOCK_WAIT_BUCKETS, waited)] += 1
+        self._wait[-1] += waited
+        return True
+
+    def release(self) -> None:
+        self._lock.release()
+
+    def locked(self) -> bool:
+        return self._lock.locked()
+
+    def __enter__(self) -> bool:
+        return self.acquire()
+
+    def __exit__(self, *exc) -> bool:
+        self._lock.release()
+        return False
+
+    def get_stats(self) -> dict:
+        return {
+            'acquisitions': self._acquisitions,
+            'contentions': self._contentions,
+            'wait_seconds': self._wait[-1]
+        }
+
+def _collect_locks() -> list[str]:
+    lines = [
+        '# HELP lock_acquisitions_total Number of acquisitions of the lock.',
+        '# TYPE lock_acquisitions_total counter'
+    ]
+    for lock in _locks:
+        lines.append(f'lock_acquisitions_total{_labels(('lock',), (lock.name,))} {lock._acquisitions}')
+    lines += [
+        '# HELP lock_wait_seconds Time spent waiting for the lock by acquisitions that found it taken.',
+        '# TYPE lock_wait_seconds histogram'
+    ]
+    for lock in _locks:
+        wait = list(lock._wait)
+        cumulative = 0
+        for bound, count in zip(LOCK_WAIT_BUCKETS + (float('inf'),), wait[:-1]):
+            cumulative += count
+            lines.append(f'lock_wait_seconds_bucket{_labels(('lock',), (lock.name,), f'le="{_number(bound)}"')} {cumulative}')
+        lines.append(f'lock_wait_seconds_sum{_labels(('lock',), (lock.name,))} {_number(wait[-1])}')
+        lines.append(f'lock_wait_seconds_count{_labels(('lock',), (lock.name,))} {cumulative}')
+    return lines
+
+def _samples(name: str, help_: str, type_: str, samples: Iterable[tuple[dict, float]]) -> list[str]:
+    lines = [f'# HELP {name} {help_}', f'# TYPE {name} {type_}']
+    for labels, value in samples:
+        lines.append(f'{name}{_labels(tuple(labels.keys()), tuple(labels.values()))} {_number(value)}')
+    return lines
+
+def gauge(name: str, help_: str, samples: Iterable[tuple[dict, float]]) -> list[str]:
+    """Formats a gauge for a collector, see 'register_collector'. 'samples' are (labels, value) pairs."""
+
+    return _samples(name, help_, 'gauge', samples)
+
+def counter(name: str, help_: str, samples: Iterable[tuple[dict, float]]) -> list[str]:
+    """Formats a counter for a collector from values that are already counted elsewhere, see 'gauge'."""
+
+    return _samples(name, help_, 'counter', samples)
+
+def register_collector(collector: 'Callable[[], list[str]]') -> None:
+    """Registers 'collector' to be called on every 'render'. It must return lines in the Prometheus text format, e.g. made with 'gauge'.
+    Collectors are meant for values that are cheaper to read when scraped than to track on every change, such as memory held by datasets."""
+
+    _collectors.append(collector)
+
+def render() -> str:
+    """Returns all metrics in the Prometheus text exposition format, version 0.0.4."""
+
+    lines = []
+    for metric in list(_metrics):
+        lines += metric.collect()
+    if len(_locks) > 0:
+        lines += _collect_locks()
+    for collector in list(_collectors):
+        lines += collector()
+    return '\n'.join(lines) + '\n'
+
+REQUESTS = Counter('http_requests_total', 'Number of HTTP requests by endpoint and HTTP status.', ('endpoint', 'target', 'status'))
+LATENCY = Histogram('http_request_duration_seconds', 'Time to produce the response, excluding streamed bodies, by endpoint.', ('endpoint', 'target'))
+PROTOCOL_STATUS = Counter('protocol_responses_total', 'Number of JSON responses by command and protocol status code.', ('command', 'code'))
+CACHE = Counter('cache_requests_total', 'Number of cache lookups by cache and result.', ('cache', 'result'))
+
+def cache_lookup(cache: str, hit: bool) -> None:
+    CACHE.inc(cache, 'hit' if hit else 'miss')
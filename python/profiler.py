@@ -0,0 +1,240 @@
+import os
+import sys
+import threading
+import time
+import cProfile
+import pstats
+import marshal
+from io import StringIO
+
+# Profiles are only captured if the server is started with SERVER_PROFILING=1 or after 'enable' is called.
+# Without a running capture, 'profile' returns a shared no-op context manager.
+MODES = ('cprofile', 'sample')
+DEFAULT_TARGETS = ('calc_index', 'calc_preview')
+DEFAULT_INTERVAL = 0.005
+MAX_SECONDS = 600
+# a thread whose innermost frame is in one of these files is waiting for work and is not sampled
+IDLE_FILES = ('threading.py', 'queue.py', 'selectors.py', 'socketserver.py', 'socket.py', 'thread.py')
+_enabled = os.environ.get('SERVER_PROFILING', '0') == '1'
+_capture = None
+_lock = threading.Lock()
+
+class _NullProfile:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_PROFILE = _NullProfile()
+
+class Capture:
+    """A profile of the next 'requests' requests to 'targets' (command names or resource types) or of a 'seconds' long window, whichever ends first.
+    'cprofile' mode profiles targeted requests with cProfile on the threads that handle them, one request at a time: a request that starts while another one is profiled runs unprofiled instead of waiting.
+    'sample' mode samples stacks of all busy threads, including thread pools, every 'interval' seconds while a targeted request is in flight, or all the time in a window without 'requests'."""
+
+    def __init__(self, mode: str, targets: tuple[str], requests: int=None, seconds: float=None, interval: float=DEFAULT_INTERVAL):
+        self.mode = mode
+        self.targets = frozenset(targets)
+        self.requests = requests
+        self.seconds = seconds
+        self.interval = interval
+        self.started = time.time()
+        self.finished = None
+        self.profiled = 0
+        self.skipped = 0
+        self.samples = 0
+        self._deadline = time.perf_counter() + seconds if seconds is not None else None
+        self._in_flight = 0
+        self._stats = None
+        self._stacks = {}
+        self._cprofile_lock = threading.Lock()
+        self._done = threading.Event()
+        if mode == 'sample':
+            threading.Thread(target=self._sample, name='profiler', daemon=True).start()
+        elif seconds is not None:
+            timer = threading.Timer(seconds, self.stop)
+            timer.daemon = True
+            timer.start()
+
+    def is_running(self) -> bool:
+        return not self._done.is_set()
+
+    def stop(self) -> None:
+        with _lock:
+            if self.finished is None:
+                self.finished = time.time()
+        self._done.set()
+
+    def _expired(self) -> bool:
+        return self._deadline is not None and time.perf_counter() >= self._deadline
+
+    def _begin(self) -> bool:
+        """Registers a targeted request. Returns False if the capture does not take it."""
+
+        with _lock:
+            if self._done.is_set() or self._expired():
+                return False
+            if self.requests is not None and self.profiled + self._in_flight >= self.requests:
+                return False
+            self._in_flight += 1
+            return True
+
+    def _end(self, profiled: bool) -> None:
+        with _lock:
+            self._in_flight -= 1
+            if profiled:
+                self.profiled += 1
+            else:
+                self.skipped += 1
+            done = self.requests is not None and self.profiled >= self.requests
+        if done:
+            self.stop()
+
+    def _add_stats(self, profile: cProfile.Profile) -> None:
+        with _lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+
+    def _sample(self) -> None:
+        own = threading.get_ident()
+        while not self._done.wait(self.interval):
+            if self._expired():
+                self.stop()
+                break
+            if self.requests is not None and self._in_flight == 0:
+                continue
+            keys = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own or os.path.basename(frame.f_code.co_filename) in IDLE_FILES:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                keys.append(';'.join(reversed(stack)))
+            with _lock:
+                for key in keys:
+                    self._stacks[key] = self._stacks.get(key, 0) + 1
+                self.samples += 1
+
+    def pstats_text(self, sort: str='cumulative', limit: int=100) -> str:
+        """Returns the cProfile result as printed by pstats, sorted by 'sort' and limited to 'limit' functions."""
+
+        with _lock:
+            if self._stats is None:
+                return ''
+            out = StringIO()
+            self._stats.stream = out
+            self._stats.sort_stats(sort).print_stats(limit)
+            return out.getvalue()
+
+    def pstats_dump(self) -> bytes:
+        """Returns the cProfile result in the binary format of 'pstats.Stats.dump_stats', to be opened with pstats, snakeviz and the like."""
+
+        with _lock:
+            return marshal.dumps(self._stats.stats) if self._stats is not None else marshal.dumps({})
+
+    def collapsed(self) -> str:
+        """Returns sampled stacks in the collapsed format of flamegraph.pl and speedscope: 'outer;...;inner count' per line."""
+
+        with _lock:
+            stacks = sorted(self._stacks.items())
+        return ''.join(f'{stack} {count}\n' for stack, count in stacks)
+
+    def to_dict(self) -> dict:
+        with _lock:
+            return {
+                'mode': self.mode,
+                'targets': sorted(self.targets),
+                'requests': self.requests,
+                'seconds': self.seconds,
+                'interval': self.interval if self.mode == 'sample' else None,
+                'running': not self._done.is_set(),
+                'started': self.started,
+                'finished': self.finished,
+                'profiled': self.profiled,
+                'skipped': self.skipped,
+                'samples': self.samples
+            }
+
+class _Profile:
+    __slots__ = ('_capture', '_profile', '_locked')
+
+    def __init__(self, capture: Capture):
+        self._capture = capture
+        self._profile = None
+        self._locked = False
+
+    def __enter__(self):
+        if self._capture.mode == 'cprofile' and self._capture._cprofile_lock.acquire(False):
+            self._locked = True
+            self._profile = cProfile.Profile()
+            try:
+                self._profile.enable()
+            except ValueError:
+                # another profiler or debugger is active
+                self._profile = None
+        return self
+
+    def __exit__(self, *exc):
+        capture = self._capture
+        if self._profile is not None:
+            self._profile.disable()
+            capture._add_stats(self._profile)
+        if self._locked:
+            capture._cprofile_lock.release()
+        capture._end(capture.mode == 'sample' or self._profile is not None)
+        return False
+
+def enable(enabled: bool=True) -> None:
+    global _enabled
+    _enabled = enabled
+
+def is_enabled() -> bool:
+    return _enabled
+
+def start(mode: str, targets: tuple[str]=DEFAULT_TARGETS, requests: int=None, seconds: float=None, interval: float=DEFAULT_INTERVAL) -> Capture:
+    """Starts a new capture, see 'Capture', and returns it. At least one of 'requests' and 'seconds' must be given.
+    Raises RuntimeError if profiling is disabled or another capture is running and ValueError on invalid arguments."""
+
+    global _capture
+    if not _enabled:
+        raise RuntimeError('Profiling is disabled')
+    if mode not in MODES:
+        raise ValueError(f'mode must be one of {MODES}')
+    if requests is None and seconds is None:
+        raise ValueError("one of 'requests' and 'seconds' must be given")
+    if requests is not None and requests <= 0:
+        raise ValueError("'requests' must be > 0")
+    if seconds is not None and not 0 < seconds <= MAX_SECONDS:
+        raise ValueError(f"'seconds' must be in (0, {MAX_SECONDS}]")
+    if not 0.001 <= interval <= 1:
+        raise ValueError("'interval' must be in [0.001, 1]")
+    if len(targets) == 0:
+        raise ValueError('at least one target must be given')
+    with _lock:
+        if _capture is not None and not _capture._done.is_set():
+            raise RuntimeError('Another capture is running')
+        _capture = None
+    capture = Capture(mode, targets, requests, seconds, interval)
+    with _lock:
+        _capture = capture
+    return capture
+
+def get() -> Capture | None:
+    """Returns the running or the last finished capture, None if there were none."""
+
+    return _capture
+
+def profile(target: str) -> '_Profile | _NullProfile':
+    """Returns a context manager to wrap the handling of a request to 'target' (a command name or a resource type) with.
+    Never blocks: if no capture is running or it does not take the request, the request runs unprofiled."""
+
+    capture = _capture
+    if capture is None or target not in capture.targets or not capture._begin():
+        return _NULL_PROFILE
+    return _Profile(capture)
@@ -1,22 +1,52 @@
-from typing import Union
-import os, time, threading
-from flask import Flask, request, make_response
-import tempfile
+from typing import Union, Iterator
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from PIL import Image, ImageDraw, ImageFont, ImageEnhance
+import os, time, threading, queue
+from flask import Flask, request, make_response, g
+import tempfile
+from PIL import Image, ImageDraw, ImageFont
 import numpy as np
 import json
 from json_proto import Protocol
-from gdal_executor import GdalExecutor
+from gdal_executor import GdalExecutor, PreviewBusyError
 import index_calculator as indcal
+import timing
+import metrics
+import profiler
 
 proto = Protocol()
 executor = GdalExecutor(proto)
 if not executor:
     raise ValueError(f'Unsupproted protocol version passed to {GdalExecutor} constructor.')
+if os.environ.get('SESSION_SNAPSHOT'):
+    err, res = executor.load_session(os.environ['SESSION_SNAPSHOT'])
+    if err is not None:
+        print(f'Session was not restored: {err.msg}')
+    else:
+        print(f"Session restored from {os.environ['SESSION_SNAPSHOT']}: {len(res['bands'])} bands, {len(res['indices'])} indices")
 _max_content_length = 1024
+# commands whose bodies may be larger than '_max_content_length'
+_max_content_lengths = {
+    'query_pixels': 4 * 1024 * 1024,
+    'zonal_stats': 4 * 1024 * 1024,
+    'set_aoi': 4 * 1024 * 1024
+}
 server = Flask(__name__)
 
+# Accept header value -> PIL format and save parameters
+PREVIEW_ENCODERS = {
+    'image/png': ('PNG', {'compress_level': 1}),
+    'image/webp': ('WEBP', {'lossless': True, 'method': 0}),
+    'image/jpeg': ('JPEG', {'quality': 90})
+}
+_encode_pool = ThreadPoolExecutor(4, thread_name_prefix='encode')
+_encode_stats = {}
+_encode_lock = threading.Lock()
+RESOURCE_TYPES = ('preview', 'index', 'array')
+ARRAY_FORMATS = ('application/octet-stream', 'application/x-npy')
+ARRAY_PARAMETERS = ('id', 'x', 'y', 'w', 'h', 'step')
+
 def _http_response(request: request, body: str, status: int, **headers: str) -> 'Response':
     """In 'headers' arguments underscore '_' is replaced with hyphen '-'."""
 
@@ -52,7 +82,7 @@ def check_http_headers(request: request, request_type: str) -> Union['Response',
         if hdr_list is not None:
             return hdr_list
     elif request_type == 'resource':
-        if request.base_url.rpartition('/')[2] not in ('preview', 'index'):
+        if request.base_url.rpartition('/')[2] not in ('preview', 'index', 'array'):
             raise ValueError('Resource request with invalid resource type "{}" passed to "check_http_headers" function'.format(request.base_url.rpartition('/')[2]))
         mandatory_headers = ['Accept', 'Protocol-Version', 'Request-ID']
         hdr_list = _check_header_list(mandatory_headers, headers)
@@ -90,18 +120,22 @@ def check_http_headers(request: request, request_type: str) -> Union['Response',
             content_length = int(headers['Content-Length'])
         except ValueError:
             return _http_response(request, '', 400, Reason='Invalid type for "Content-Length" header: must be of integer type.')
+        max_content_length = _max_content_lengths.get(request.path.rpartition('/')[2], _max_content_length)
         if content_length < 2:
-            return _http_response(request, '', 400, Reason=f'Invalid value "{content_length}" for "Content-Length" header: must be in [2, {_max_content_length}] for {request.path} request.')
-        if content_length > _max_content_length:
-            return _http_response(request, '', 413, Reason=f'Invalid value "{content_length}" for "Content-Length" header: must be in [2, {_max_content_length}] for {request.path} request.')
+            return _http_response(request, '', 400, Reason=f'Invalid value "{content_length}" for "Content-Length" header: must be in [2, {max_content_length}] for {request.path} request.')
+        if content_length > max_content_length:
+            return _http_response(request, '', 413, Reason=f'Invalid value "{content_length}" for "Content-Length" header: must be in [2, {max_content_length}] for {request.path} request.')
     if request_type == 'resource':
         accept = headers['Accept']
         if request.base_url.rpartition('/')[2] == 'preview':
-            if accept != 'image/png':
-                return _http_response(request, '', 400, Reason=f'Invalid value "{accept}" of "Accept" header: must be "image/png" for /resource/preview request.')            
+            if accept not in PREVIEW_ENCODERS:
+                return _http_response(request, '', 400, Reason=f'Invalid value "{accept}" of "Accept" header: must be one of {list(PREVIEW_ENCODERS.keys())} for /resource/preview request.')
         elif request.base_url.rpartition('/')[2] == 'index':
             if accept != 'image/tiff':
                 return _http_response(request, '', 400, Reason=f'Invalid value "{accept}" of "Accept" header: must be "image/tiff" for /resource/index request.')
+        elif request.base_url.rpartition('/')[2] == 'array':
+            if accept not in ARRAY_FORMATS:
+                return _http_response(request, '', 400, Reason=f'Invalid value "{accept}" of "Accept" header: must be one of {list(ARRAY_FORMATS)} for /resource/array request.')
 
     return None
 
@@ -142,7 +176,16 @@ def generate_http_response(request: request, response_json: dict) -> 'Response':
         code == 10500 or code == 20500 or
         code in range(10600, 10601+1) or code == 20601 or
         code == 10700 or
-        code in range(10900, 10901+1) or code in range(20900, 20901+1)
+        code in range(10900, 10901+1) or code in range(20900, 20901+1) or
+        code == 11000 or
+        code in range(11100, 11102+1) or code == 21100 or
+        code in range(11200, 11202+1) or
+        code in range(11300, 11301+1) or code == 21302 or
+        code in range(11400, 11401+1) or code in range(21401, 21402+1) or
+        code == 11500 or
+        code == 11600 or
+        code == 11700 or
+        code == 11800
     ):
         http_status = 400
     elif (
@@ -153,7 +196,14 @@ def generate_http_response(request: request, response_json: dict) -> 'Response':
         code in range(20501, 20504+1) or
         code == 20600 or
         code in range (20800, 20801+1) or
-        code == 20902
+        code == 20902 or
+        code in range(21101, 21102+1) or
+        code in range(21200, 21201+1) or
+        code in range(21300, 21301+1) or code == 21303 or
+        code == 21400 or
+        code in range(21500, 21501+1) or
+        code == 21600 or
+        code in range(21700, 21701+1)
     ):
         http_status = 500
     elif code == 20200:
@@ -163,6 +213,11 @@ def generate_http_response(request: request, response_json: dict) -> 'Response':
     else:
         raise ValueError(f'Unknown status code in JSON response: {code}')
 
+    command = (request.view_args or {}).get('command')
+    metrics.PROTOCOL_STATUS.inc(command if command in executor.get_supported_operations() else 'unknown', code)
+
+    if code == 20200 and 'retry_after' in response_json['result']:
+        return _http_response(request, response_json, http_status, Content_Type='application/json; charset=utf-8', Retry_After=str(response_json['result']['retry_after']))
     return _http_response(request, response_json, http_status, Content_Type='application/json; charset=utf-8')
 
 def shutdown():
@@ -170,63 +225,256 @@ def shutdown():
     time.sleep(3)
     os._exit(0)
 
-def normalize_brightness(img: Image) -> Image:
-    """Tweaks 'img's brightness based on its mean brightness and returns a new Image. Assumes 'img' is 8 bit and of 'RGB' or 'RGBA' format."""
+@lru_cache(maxsize=1)
+def _scalebar_font() -> ImageFont.FreeTypeFont:
+    return ImageFont.load_default(14)
 
-    rgb = np.asarray(img)[..., :3].astype(np.float32)
-    mean = rgb.mean(axis=(0, 1)).mean()
+@lru_cache(maxsize=32)
+def _scalebar_panel(height: int, bar_width: int, labels: tuple[str, str, str], colormap: str=None) -> np.ndarray:
+    """Renders the part of a scalebar image to the right of the preview: the gradient bar with its outline and 'labels' (max, mid, min) next to it.
+    Returns a read-only RGBA array of shape (height, width, 4), cached per arguments so repeated requests of the same preview only blit it."""
 
-    if mean < 80:
-        return ImageEnhance.Brightness(img).enhance(128 / mean * 0.4)
-    elif mean > 170:
-        return ImageEnhance.Brightness(img).enhance(mean / 128 * 0.6)
-    else:
-        return img
+    font = _scalebar_font()
+    draw = ImageDraw.Draw(Image.new('1', (0, 0)))
+    text_w = int(max(draw.textlength(label, font) for label in labels))
+
+    panel = Image.new('RGBA', (bar_width + text_w + 3, height), (0, 0, 0, 0))
+    line = np.linspace(255, 0, height, dtype=np.uint8).reshape(height, 1)
+    if colormap is not None:
+        line = indcal.colormap_lut(colormap)[line]
+    panel.paste(Image.fromarray(line).resize((bar_width, height)))
+
+    draw = ImageDraw.Draw(panel)
+    draw.rectangle([(0, 0), (bar_width - 1, height - 1)], outline=(128, 128, 128, 255), width=2)
+    draw.text((bar_width + 3, 0), labels[0], fill=(0, 0, 0, 255), font=font, anchor='lt')
+    draw.text((bar_width + 3, height // 2), labels[1], fill=(0, 0, 0, 255), font=font, anchor='lm')
+    draw.text((bar_width + 3, height), labels[2], fill=(0, 0, 0, 255), font=font, anchor='lb')
+
+    ret = np.asarray(panel)
+    ret.flags.writeable = False
+    return ret
 
-def image_with_scalebar(src_image: Image, gap: int, values: np.ma.MaskedArray) -> Image:
-    """Generates a scalebar (bar diagram flled with gradient) with min and max values from 'values' array and returns a new PIL.Image with 'src_image', the scalebar and a 'gap' in between."""
+def image_with_scalebar(src_image: Image, gap: int, min_: float, max_: float, colormap: str=None) -> Image:
+    """Generates a scalebar (bar diagram flled with gradient) labeled with 'min_' and 'max_' values and returns a new PIL.Image with 'src_image', the scalebar and a 'gap' in between.
+    The gradient is grayscale or, if 'colormap' is set, colorized with it the same way as the preview."""
 
-    scalebar_w, scalebar_h = max(25, src_image.width // 20), src_image.height
-    total_w, total_h = src_image.width + gap + scalebar_w, src_image.height
-    min_ = round(np.nanmin(values), 2)
-    mid = round(np.nanmin(values) + (np.nanmax(values) - np.nanmin(values)) / 2, 2)
-    max_ = round(np.nanmax(values), 2)
-    
-    gradient = Image.new('L', (1, scalebar_h))
-    line = np.linspace(255, 0, scalebar_h, dtype=np.uint8)
-    gradient.putdata(line)
-    gradient = gradient.resize((scalebar_w, scalebar_h))
+    labels = (str(round(max_, 2)), str(round(min_ + (max_ - min_) / 2, 2)), str(round(min_, 2)))
+    panel = _scalebar_panel(src_image.height, max(25, src_image.width // 20), labels, colormap)
 
-    draw = ImageDraw.Draw(Image.new('1', (0, 0)))
-    font = ImageFont.load_default(14)
-    str_max = draw.textlength(str(max_), font)
-    str_mid = draw.textlength(str(mid), font)
-    str_min = draw.textlength(str(min_), font)
+    x = src_image.width + gap - 1
+    ret = np.zeros((src_image.height, x + panel.shape[1], 4), dtype=np.uint8)
+    ret[:, :src_image.width] = np.asarray(src_image.convert('RGBA'))
+    ret[:, x:] = panel
+    return Image.fromarray(ret)
 
-    ret = Image.new('RGBA', (total_w + int(max(str_min, str_mid, str_max)) + 2, total_h), (0, 0, 0, 0))
-    ret.paste(src_image)
-    ret.paste(gradient, (src_image.width + gap - 1, 0))
-    draw = ImageDraw.Draw(ret)
+class _ChunkWriter:
+    """A file-like object for PIL.Image.save that hands every written chunk to 'chunks' queue."""
 
-    draw.rectangle([(src_image.width + gap - 1, 0), (total_w - 2, total_h - 1)], outline=(128, 128, 128, 255), width=2)
-    draw.text((total_w + 2, 0), str(max_), fill=(0, 0, 0, 255), font=font, anchor='lt')
-    draw.text((total_w + 2, scalebar_h // 2), str(mid), fill=(0, 0, 0, 255), font=font, anchor='lm')
-    draw.text((total_w + 2, scalebar_h), str(min_), fill=(0, 0, 0, 255), font=font, anchor='lb')
+    def __init__(self, chunks: queue.Queue):
+        self.chunks = chunks
+        self.nbytes = 0
 
-    return ret
+    def write(self, data: bytes) -> int:
+        self.chunks.put(bytes(data))
+        self.nbytes += len(data)
+        return len(data)
+
+    def flush(self) -> None:
+        pass
 
-def image_with_mask(src_image: Image, mask: np.ma.MaskedArray[np.bool], color: tuple[int]=(255, 0, 0, 165)) -> Image:
-    """Draws a mask overlay with 'color' onto 'src_image' according to 'mask' pixels."""
+def encode_image(img: Image, mime: str) -> Iterator[bytes]:
+    """Encodes 'img' to 'mime' format (one of PREVIEW_ENCODERS) on the encoding thread pool and returns an iterator that yields the encoded chunks as soon as the encoder writes them.
+    Waits for the first chunk before returning, so that an encoder failing before any output raises here, before the response headers are sent. A failure later is logged and re-raised by the iterator, so that the server aborts the response instead of ending a truncated body cleanly.
+    Encoding time and size are added to the per format statistics, see 'get_encode_stats'. As encoding ends after the response headers are sent, its 'encode' span is only seen in 'timing.recent'."""
 
-    overlay = np.ma.zeros((mask.shape[0], mask.shape[1], 4), dtype=np.uint8)
-    overlay[mask] = color
-    overlay = Image.fromarray(overlay)
-    ret = src_image.copy()
+    fmt, params = PREVIEW_ENCODERS[mime]
+    if fmt == 'JPEG':
+        img = img.convert('RGB')
+    chunks = queue.Queue()
+
+    @timing.bind
+    def _encode():
+        writer = _ChunkWriter(chunks)
+        start = time.perf_counter()
+        try:
+            with timing.span('encode'):
+                img.save(writer, format=fmt, **params)
+        except Exception as e:
+            print(f'Encoding {mime} image failed after {writer.nbytes} bytes: {e}')
+            raise
+        finally:
+            chunks.put(None)
+        elapsed = time.perf_counter() - start
+        with _encode_lock:
+            stats = _encode_stats.setdefault(mime, {'count': 0, 'seconds': 0.0, 'bytes': 0})
+            stats['count'] += 1
+            stats['seconds'] += elapsed
+            stats['bytes'] += writer.nbytes
+
+    future = _encode_pool.submit(_encode)
+    first = chunks.get()
+    if first is None:
+        future.result()
+
+    def _stream():
+        chunk = first
+        while chunk is not None:
+            yield chunk
+            chunk = chunks.get()
+        future.result()
+    return _stream()
+
+def get_encode_stats() -> dict:
+    """Returns {mime: {'count', 'seconds', 'bytes'}} for every format previews were encoded to."""
+
+    with _encode_lock:
+        return {k: dict(v) for k, v in _encode_stats.items()}
+
+def image_with_mask(src_image: Image, overlay: Image) -> Image:
+    """Draws a ready RGBA mask 'overlay' (see GdalExecutor.get_mask_overlay) onto 'src_image'."""
+
+    ret = src_image.convert('RGBA')
     ret.alpha_composite(overlay)
     return ret
 
+@server.before_request
+def begin_timing():
+    timing.begin(request.path)
+
+@server.after_request
+def finish_timing(response: 'Response') -> 'Response':
+    recorder = timing.finish(response.status_code)
+    if recorder is not None:
+        response.headers['Server-Timing'] = recorder.header()
+    return response
+
+def _metrics_target() -> tuple[str, str] | None:
+    """Returns (endpoint, target) labels of the current request for request metrics, or None if the request is not counted. Unknown commands and resource types share one label to keep the number of series bounded."""
+
+    args = request.view_args or {}
+    if 'command' in args:
+        return 'api', args['command'] if args['command'] in executor.get_supported_operations() else 'unknown'
+    if 'res_type' in args:
+        return 'resource', args['res_type'] if args['res_type'] in RESOURCE_TYPES else 'unknown'
+    return None
+
+@server.before_request
+def begin_metrics():
+    g.metrics_start = time.perf_counter()
+
+@server.after_request
+def finish_metrics(response: 'Response') -> 'Response':
+    target = _metrics_target()
+    if target is not None and 'metrics_start' in g:
+        metrics.LATENCY.observe(time.perf_counter() - g.metrics_start, *target)
+        metrics.REQUESTS.inc(*target, response.status_code)
+    return response
+
+def _collect_memory() -> list[str]:
+    datasets, previews = executor.ds_man.get_memory_stats(), executor.pv_man.get_memory_stats()
+    encoding, admission = get_encode_stats(), executor.admission.get_stats()
+    return (
+        metrics.gauge('datasets_held', 'Number of open datasets.', [({}, datasets['datasets'])]) +
+        metrics.gauge('datasets_in_memory', 'Number of in-memory datasets (calculated indices).', [({}, datasets['in_memory'])]) +
+        metrics.gauge('datasets_bytes', 'Bytes held by in-memory datasets and the cloud mask.', [({}, datasets['bytes'])]) +
+        metrics.gauge('previews_held', 'Number of previews, including evicted ones.', [({}, previews['previews'])]) +
+        metrics.gauge('previews_resident', 'Number of previews whose arrays are in memory.', [({}, previews['resident'])]) +
+        metrics.gauge('previews_bytes', 'Bytes held by preview arrays.', [({}, previews['bytes'])]) +
+        metrics.gauge('previews_budget_bytes', 'Maximum number of bytes held by preview arrays.', [({}, previews['budget'])]) +
+        metrics.gauge('previews_evictions', 'Number of preview evictions in this session.', [({}, previews['evictions'])]) +
+        metrics.gauge('previews_regenerations', 'Number of evicted previews rendered again in this session.', [({}, previews['regenerations'])]) +
+        metrics.counter('preview_encodes_total', 'Number of encoded previews by format.', [({'format': mime}, stats['count']) for mime, stats in encoding.items()]) +
+        metrics.counter('preview_encoded_bytes_total', 'Bytes of encoded previews by format.', [({'format': mime}, stats['bytes']) for mime, stats in encoding.items()]) +
+        metrics.counter('preview_encode_seconds_total', 'Time spent encoding previews by format.', [({'format': mime}, stats['seconds']) for mime, stats in encoding.items()]) +
+        metrics.gauge('admission_budget_bytes', 'Memory budget for heavy operations.', [({}, admission['budget'])]) +
+        metrics.gauge('admission_in_use_bytes', 'Estimated peak memory of running heavy operations.', [({}, admission['in_use'])]) +
+        metrics.gauge('admission_running', 'Number of running heavy operations.', [({}, admission['running'])]) +
+        metrics.gauge('admission_waiting', 'Number of heavy operations waiting for memory.', [({}, admission['waiting'])]) +
+        metrics.counter('admission_admitted_total', 'Number of admitted heavy operations.', [({}, admission['admitted'])]) +
+        metrics.counter('admission_queued_total', 'Number of heavy operations that had to wait for memory.', [({}, admission['queued'])]) +
+        metrics.counter('admission_rejected_total', 'Number of heavy operations rejected with status 20200.', [({}, admission['rejected'])]) +
+        metrics.gauge('admission_estimate_factor', 'Observed peak / estimated peak memory by operation.', [({'operation': kind}, factor) for kind, factor in admission['factors'].items()])
+    )
+
+metrics.register_collector(_collect_memory)
+
+@server.get('/metrics')
+def handle_metrics():
+    return _http_response(request, metrics.render(), 200, Content_Type='text/plain; version=0.0.4; charset=utf-8')
+
+@server.get('/timings')
+def handle_timings():
+    """Returns spans of the last 'timing.RECENT_SIZE' requests. Only available if timing is enabled."""
+
+    if not timing.is_enabled():
+        return _http_response(request, '', 404, Reason='Timing is disabled. Start the server with SERVER_TIMING=1 to enable it.')
+    return _http_response(request, json.dumps(timing.recent()), 200, Content_Type='application/json; charset=utf-8')
+
+@server.post('/profile')
+def handle_profile_start():
+    """Starts a profile capture, see 'profiler.Capture'. Only available if profiling is enabled."""
+
+    if not profiler.is_enabled():
+        return _http_response(request, '', 404, Reason='Profiling is disabled. Start the server with SERVER_PROFILING=1 to enable it.')
+    unknown = set(request.args.keys()) - {'mode', 'targets', 'requests', 'seconds', 'interval'}
+    if len(unknown) > 0:
+        return _http_response(request, '', 400, Reason='Unknown parameter in query string for profile request: must be one of mode, targets, requests, seconds, interval.')
+    try:
+        requests_ = request.args.get('requests', type=int)
+        seconds = request.args.get('seconds', type=float)
+        interval = request.args.get('interval', profiler.DEFAULT_INTERVAL, type=float)
+        targets = request.args.get('targets')
+        targets = profiler.DEFAULT_TARGETS if targets is None else tuple(t for t in targets.split(',') if len(t) > 0)
+        capture = profiler.start(request.args.get('mode', 'sample'), targets, requests_, seconds, interval)
+    except ValueError as e:
+        return _http_response(request, '', 400, Reason=f'Invalid profile request: {e}.')
+    except RuntimeError as e:
+        return _http_response(request, '', 409, Reason=f'{e}.')
+    return _http_response(request, json.dumps(capture.to_dict()), 202, Content_Type='application/json; charset=utf-8')
+
+@server.get('/profile')
+def handle_profile_get():
+    """Returns the result of the last capture or its progress if it is running."""
+
+    if not profiler.is_enabled():
+        return _http_response(request, '', 404, Reason='Profiling is disabled. Start the server with SERVER_PROFILING=1 to enable it.')
+    capture = profiler.get()
+    if capture is None:
+        return _http_response(request, '', 404, Reason='No profile was captured.')
+    if capture.is_running():
+        return _http_response(request, json.dumps(capture.to_dict()), 202, Content_Type='application/json; charset=utf-8')
+
+    fmt = request.args.get('format', 'collapsed' if capture.mode == 'sample' else 'text')
+    if capture.mode == 'sample' and fmt == 'collapsed':
+        return _http_response(request, capture.collapsed(), 200, Content_Type='text/plain; charset=utf-8')
+    if capture.mode == 'cprofile' and fmt == 'text':
+        try:
+            text = capture.pstats_text(request.args.get('sort', 'cumulative'), request.args.get('limit', 100, type=int))
+        except KeyError:
+            return _http_response(request, '', 400, Reason=f'Unknown sort key "{request.args.get("sort")}" for profile request.')
+        return _http_response(request, text, 200, Content_Type='text/plain; charset=utf-8')
+    if capture.mode == 'cprofile' and fmt == 'pstats':
+        return _http_response(request, capture.pstats_dump(), 200, Content_Type='application/octet-stream', Content_Disposition='attachment; filename="profile.pstats"')
+    return _http_response(request, '', 400, Reason=f'Format "{fmt}" is not available for {capture.mode} profiles.')
+
+@server.delete('/profile')
+def handle_profile_stop():
+    """Stops the running capture early, keeping what was captured so far."""
+
+    if not profiler.is_enabled():
+        return _http_response(request, '', 404, Reason='Profiling is disabled. Start the server with SERVER_PROFILING=1 to enable it.')
+    capture = profiler.get()
+    if capture is None:
+        return _http_response(request, '', 404, Reason='No profile was captured.')
+    capture.stop()
+    return _http_response(request, json.dumps(capture.to_dict()), 200, Content_Type='application/json; charset=utf-8')
+
 @server.get('/resource/<res_type>')
 def handle_resource(res_type):
+    with profiler.profile(res_type):
+        return _handle_resource(res_type)
+
+def _handle_resource(res_type):
     if len(request.query_string) == 0:
         return _http_response(request, '', 400, Reason='Query string must be provided for resource requests.')
 
@@ -240,7 +488,7 @@ def handle_resource(res_type):
     if id_ < 0:
         return _http_response(request, '', 400, Reason=f'Invalid value "{id_}" for "id" parameter of the query string: must be >= 0.')
 
-    if res_type not in ('preview', 'index'):
+    if res_type not in RESOURCE_TYPES:
         return _http_response(request, '', 400, Reason=f'The requested resource type "{res_type}" is not supported.')
 
     if res_type == 'preview':
@@ -259,6 +507,16 @@ def handle_resource(res_type):
         if len(request.args) != 1:
             return _http_response(request, '', 400, Reason='Query string must only include "id" parameter for index requests.')
 
+    window = {}
+    if res_type == 'array':
+        for key in request.args:
+            if key not in ARRAY_PARAMETERS:
+                return _http_response(request, '', 400, Reason=f'Unknown parameter in query string for array request: must be one of {list(ARRAY_PARAMETERS)}.')
+        try:
+            window = {k: int(v) for k, v in request.args.items() if k != 'id'}
+        except ValueError:
+            return _http_response(request, '', 400, Reason='Parameters of the query string must be of integer type for array requests.')
+
     response = check_http_headers(request, 'resource')
     if response is not None:
         return response
@@ -269,36 +527,48 @@ def handle_resource(res_type):
 
     if res_type == 'preview':
         try:
-            rgba = executor.pv_man.get(id_)
+            with timing.span('render'):
+                rgba = executor.pv_man.get(id_)
         except KeyError:
             return _http_response(request, '', 404, Reason=f'Requested preview "{id_}" does not exist.')
+        except PreviewBusyError as e:
+            return _http_response(request, '', 503, Reason='Server is busy: not enough memory to regenerate the preview.', Retry_After=str(e.retry_after))
         
         if scalebar == '1':
             if rgba.index == 'nat_col':
                     return _http_response(request, '', 400, Reason='Unable to generate a scalebar for non-grayscale preview.')
+            index_id = executor.ds_man.find(rgba.index)
+            try:
+                stats = executor.ds_man.get(index_id).stats if index_id is not None else None
+            except KeyError:
+                stats = None
+            if stats is None:
+                return _http_response(request, '', 404, Reason=f'Unable to generate a scalebar: index "{rgba.index}" of the preview does not exist.')
+        accept = request.headers['Accept']
+        if accept == 'image/jpeg' and rgba.index != 'nat_col':
+            return _http_response(request, '', 400, Reason='JPEG encoding is only available for natural color previews.')
         if mask == '1':
-            water = executor.get_water_mask(rgba.width, rgba.height)
-            if water is None:
+            with timing.span('mask'):
+                overlay = executor.get_mask_overlay(rgba.width, rgba.height)
+            if overlay is None:
                 return _http_response(request, '', 500, Reason='Unable to generate a water mask. Probably, water index was not created for the scene.')
 
-        buf = BytesIO()
-        img = Image.fromarray(rgba.array)
+        colormap = executor.preview_colormaps.get(rgba.index)
+        with timing.span('colorize'):
+            # a scalebar must match the stretched values, so only previews without one are brightness normalized
+            img = rgba.image(colormap, normalize_brightness=scalebar != '1')
         if scalebar == '1':
-            id__ = executor.ds_man.find(rgba.index)
-            ds = executor.ds_man.get(id__).dataset
-            if rgba.height <= rgba.width:
-                res = rgba.height / ds.RasterYSize * 100
-            else:
-                res = rgba.width / ds.RasterXSize * 100
-            img = image_with_scalebar(img, 10, executor.ds_man.read_band(id__, 1, resolution_percent=res))
-        else:
-            img = normalize_brightness(img)
+            with timing.span('scalebar'):
+                img = image_with_scalebar(img, 10, stats['min'], stats['max'], colormap)
         if mask == '1':
-            img = image_with_mask(img, water)
-        img.save(buf, format='PNG')
-        buf.seek(0)
-        
-        return _http_response(request, buf, 200, Content_Type='image/png', Width=img.width, Height=img.height)
+            with timing.span('mask'):
+                img = image_with_mask(img, overlay)
+
+        try:
+            body = encode_image(img, accept)
+        except Exception as e:
+            return _http_response(request, '', 500, Reason=f'Unable to encode the preview as {accept}: {e}')
+        return _http_response(request, body, 200, Content_Type=accept, Width=img.width, Height=img.height, Preview_Final='1' if rgba.final else '0')
         
     if res_type == 'index':
         try:
@@ -307,14 +577,52 @@ def handle_resource(res_type):
             return _http_response(request, '', 404, Reason=f'Requested index "{id_}" does not exist.')
 
         with tempfile.NamedTemporaryFile(mode='w+b', delete=True, delete_on_close=True) as tmp:
-            executor.geotiff.CreateCopy(tmp.name, dataset, strict=False)
-            tmp.seek(0)
-            data = tmp.read()
+            with timing.span('encode'):
+                executor.geotiff.CreateCopy(tmp.name, dataset, strict=False)
+                tmp.seek(0)
+                data = tmp.read()
             
             return _http_response(request, data, 200, Content_Type='image/tiff')
 
+    if res_type == 'array':
+        try:
+            dataset = executor.ds_man.get(id_)
+        except KeyError:
+            return _http_response(request, '', 404, Reason=f'Requested array "{id_}" does not exist.')
+
+        ds = dataset.dataset
+        x, y, step = window.get('x', 0), window.get('y', 0), window.get('step', 1)
+        w, h = window.get('w', ds.RasterXSize - x), window.get('h', ds.RasterYSize - y)
+        try:
+            with timing.span('decode'):
+                data = executor.ds_man.read_window(id_, 1, x, y, w, h, step)
+        except ValueError:
+            return _http_response(request, '', 400, Reason=f'Requested window {w}x{h} at ({x}, {y}) with step {step} does not fit into {ds.RasterXSize}x{ds.RasterYSize} raster.')
+        data = data.astype(data.dtype.newbyteorder('<'), copy=False)
+
+        accept = request.headers['Accept']
+        with timing.span('encode'):
+            if accept == 'application/x-npy':
+                buf = BytesIO()
+                np.save(buf, data, allow_pickle=False)
+                body = buf.getvalue()
+            else:
+                body = data.tobytes()
+        gt = ds.GetGeoTransform()
+        geotransform = (gt[0] + x * gt[1] + y * gt[2], gt[1] * step, gt[2] * step, gt[3] + x * gt[4] + y * gt[5], gt[4] * step, gt[5] * step)
+        response = _http_response(request, body, 200, Content_Type=accept,
+            Array_Shape=','.join(str(n) for n in data.shape),
+            Array_Dtype=data.dtype.str,
+            Array_Nodata=str(dataset.no_data),
+            Array_Geotransform=','.join(str(n) for n in geotransform))
+        return response.make_conditional(request, accept_ranges=True, complete_length=len(body))
+
 @server.post('/api/<command>')
 def handle_command(command):
+    with profiler.profile(command):
+        return _handle_command(command)
+
+def _handle_command(command):
     if len(request.query_string) != 0:
         return _http_response(request, '', 400, Reason='No query strings allowed for command execution requests.')
 
@@ -354,7 +662,12 @@ def handle_command(command):
         threading.Thread(target=shutdown).start()
     if command == 'calc_preview':
         response_json['result']['url'] = f'/resource/preview?id={response_json['result']['url']}'
-    if command == 'calc_index':
+    if command == 'calc_previews':
+        for index, url in response_json['result']['urls'].items():
+            response_json['result']['urls'][index] = f'/resource/preview?id={url}'
+    if command == 'session_stats':
+        response_json['result']['encoding'] = get_encode_stats()
+    if command in ('calc_index', 'water_bodies'):
         response_json['result']['url'] = f'/resource/index?id={response_json['result']['url']}'
 
     return generate_http_response(request, response_json)
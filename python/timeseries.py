@@ -0,0 +1,236 @@
+# Time series of an index over co-registered Landsat 8/9 scenes of the same WRS path/row.
+# The index (and the water mask for water frequency) of every date is calculated by 'batch.run_batch' into OUTPUT/scenes, the dates are stacked into a VRT per path/row
+# and per-pixel temporal statistics are computed tile by tile, so memory is bounded by dates x tile size and never holds whole scenes of all dates:
+#   OUTPUT/<path><row>/<index>_stack.vrt, water_mask_stack.vrt  - one band per date, band descriptions are dates
+#   OUTPUT/<path><row>/<index>_mean.tif, _median.tif, _trend.tif  - trend is the least-squares slope in index units per year
+#   OUTPUT/<path><row>/<index>_count.tif                          - number of valid (cloud-free, non-NoData) dates
+#   OUTPUT/<path><row>/water_frequency.tif                        - share of valid dates classified as water
+# Run from this directory:
+#   python timeseries.py '/data/landsat/LC0*_L2SP_179021_*' --index oc3_concentration -o /data/ts --workers 8
+
+import argparse
+import datetime
+import os
+import time
+import warnings
+import numpy as np
+from osgeo import gdal
+import batch
+from gdal_executor import GdalExecutor, DatasetManager
+
+gdal.UseExceptions()
+
+DEFAULT_TILE = 512
+MIN_TREND_DATES = 3
+# classes of 'water_mask': 0 is NoData, 1 is land
+WATER_CLASS = 2
+STACK_DIR = 'scenes'
+
+def scene_key(scene: dict) -> (str, datetime.date):
+    """Returns the WRS path/row and the acquisition date of 'scene' from 'batch.find_scene', parsed from the Landsat product id of its MTL file."""
+
+    parts = os.path.basename(scene['mtl']).split('_')
+    try:
+        return parts[2], datetime.datetime.strptime(parts[3], '%Y%m%d').date()
+    except (IndexError, ValueError):
+        raise ValueError(f"'{scene['mtl']}' is not named as a Landsat product: <sensor>_<level>_<path><row>_<date>_...") from None
+
+def group_scenes(scenes: list[dict]) -> (dict, list[str]):
+    """Groups 'scenes' by path/row, one scene per date sorted by date. Returns ({path/row: [(date, scene), ...]}, errors)."""
+
+    groups, errors = {}, []
+    for scene in scenes:
+        try:
+            path_row, date = scene_key(scene)
+        except ValueError as e:
+            errors.append(str(e))
+            continue
+        dates = groups.setdefault(path_row, {})
+        if date in dates:
+            errors.append(f"{path_row} {date}: '{scene['name']}' is ignored, '{dates[date]['name']}' is used")
+            continue
+        dates[date] = scene
+    return {path_row: sorted(dates.items()) for path_row, dates in sorted(groups.items())}, errors
+
+def scene_indices(index: str, water_index: str=None) -> list[str]:
+    """Returns the indices to calculate for every scene in order: 'index' and, if 'water_index' is given, the water mask calculated from it.
+    The executor takes the water mask from the first calculated water extraction index it finds, so 'water_index' and the water mask go before 'index', which may be another water extraction index."""
+
+    if water_index is None:
+        return [index]
+    return list(dict.fromkeys([water_index, 'water_mask', index]))
+
+def build_stack(files: list[str], dates: list[datetime.date], vrt: str) -> gdal.Dataset:
+    """Stacks single-band rasters 'files' of 'dates' into 'vrt', one band per date over the union of their extents. Pixels a date does not cover are NoData.
+    Raises ValueError if the rasters are not on the same grid."""
+
+    first = gdal.Open(files[0])
+    srs, geotransform = first.GetSpatialRef(), first.GetGeoTransform()
+    for file in files[1:]:
+        ds = gdal.Open(file)
+        other = ds.GetGeoTransform()
+        if not srs.IsSame(ds.GetSpatialRef()) or not np.allclose(other[1:3] + other[4:], geotransform[1:3] + geotransform[4:]):
+            raise ValueError(f"'{file}' is not co-registered with '{files[0]}': the scenes must share the projection and the pixel size")
+        # origins must be on the same pixel grid, otherwise the VRT would resample
+        shift = ((other[0] - geotransform[0]) / geotransform[1], (other[3] - geotransform[3]) / geotransform[5])
+        if not all(abs(s - round(s)) < 1e-6 for s in shift):
+            raise ValueError(f"'{file}' is shifted against '{files[0]}' by a fraction of a pixel")
+    stack = gdal.BuildVRT(vrt, files, options=gdal.BuildVRTOptions(separate=True, resolution='highest'))
+    for i, date in enumerate(dates):
+        stack.GetRasterBand(i + 1).SetDescription(date.isoformat())
+    stack.FlushCache()
+    return stack
+
+def _read_tile(stack: gdal.Dataset, x0: int, y0: int, width: int, height: int) -> np.ndarray:
+    """Reads a tile of every band of 'stack' into a (dates, height, width) float32 array with NaN for NoData."""
+
+    tile = np.empty((stack.RasterCount, height, width), dtype=np.float32)
+    for i in range(stack.RasterCount):
+        band = stack.GetRasterBand(i + 1)
+        tile[i] = band.ReadAsArray(x0, y0, width, height)
+        nodata = band.GetNoDataValue()
+        if nodata is not None and not np.isnan(nodata):
+            tile[i][tile[i] == nodata] = np.nan
+    return tile
+
+def tile_statistics(tile: np.ndarray, years: np.ndarray) -> dict:
+    """Returns per-pixel 'mean', 'median', 'trend' (least-squares slope per year of 'years', NaN for less than MIN_TREND_DATES dates) and 'count' of valid dates of a (dates, height, width) 'tile' with NaN for NoData."""
+
+    valid = ~np.isnan(tile)
+    count = valid.sum(axis=0)
+    values = np.where(valid, tile, 0)
+    with np.errstate(invalid='ignore', divide='ignore'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        mean = values.sum(axis=0) / count
+        median = np.nanmedian(tile, axis=0)
+        t = years.reshape(-1, 1, 1).astype(np.float32)
+        t_mean = (t * valid).sum(axis=0) / count
+        dt = np.where(valid, t - t_mean, 0)
+        variance = (dt * dt).sum(axis=0)
+        trend = (dt * (values - mean)).sum(axis=0) / variance
+    trend[(count < MIN_TREND_DATES) | (variance == 0)] = np.nan
+    return {
+        'mean': mean.astype(np.float32),
+        'median': median.astype(np.float32),
+        'trend': trend.astype(np.float32),
+        'count': count.astype(np.uint16)
+    }
+
+def water_frequency(tile: np.ndarray) -> np.ndarray:
+    """Returns the share of dates classified as water among dates with data of a (dates, height, width) 'water_mask' tile, NaN where no date has data."""
+
+    observed = (tile != 0).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return ((tile == WATER_CLASS).sum(axis=0) / observed).astype(np.float32)
+
+def _create(file: str, like: gdal.Dataset, data_type: int, nodata: float | int, description: str) -> gdal.Dataset:
+    predictor = 'PREDICTOR=3' if data_type == gdal.GDT_Float32 else 'PREDICTOR=2'
+    ds = gdal.GetDriverByName('GTiff').Create(file, like.RasterXSize, like.RasterYSize, 1, data_type, DatasetManager.SNAPSHOT_GTIFF_OPTIONS + [predictor])
+    ds.SetGeoTransform(like.GetGeoTransform())
+    ds.SetProjection(like.GetProjection())
+    band = ds.GetRasterBand(1)
+    band.SetNoDataValue(nodata)
+    band.SetDescription(description)
+    return ds
+
+def temporal_statistics(stack: gdal.Dataset, water_stack: gdal.Dataset | None, dates: list[datetime.date], index: str, directory: str, tile_size: int=DEFAULT_TILE) -> list[str]:
+    """Computes temporal statistics of 'stack' of 'index' and water frequency of 'water_stack' (if given) tile by tile into GeoTiffs in 'directory'. Returns the written files.
+    Outputs are written to temporary files and renamed when complete."""
+
+    years = np.array([(date - dates[0]).days / 365.25 for date in dates])
+    outputs = {name: os.path.join(directory, f'{index}_{name}.tif') for name in ('mean', 'median', 'trend', 'count')}
+    if water_stack is not None:
+        outputs['water_frequency'] = os.path.join(directory, 'water_frequency.tif')
+    datasets = {}
+    for name, file in outputs.items():
+        if name == 'count':
+            datasets[name] = _create(file + '.tmp', stack, gdal.GDT_UInt16, 0, f'{index} valid dates')
+        else:
+            datasets[name] = _create(file + '.tmp', stack, gdal.GDT_Float32, float('nan'), f'{index} {name}' if name != 'water_frequency' else 'water frequency')
+        datasets[name].SetMetadataItem('DATES', ' '.join(date.isoformat() for date in dates))
+    datasets['trend'].GetRasterBand(1).SetUnitType(f'{index} per year')
+
+    width, height = stack.RasterXSize, stack.RasterYSize
+    for y0 in range(0, height, tile_size):
+        for x0 in range(0, width, tile_size):
+            w, h = min(tile_size, width - x0), min(tile_size, height - y0)
+            statistics = tile_statistics(_read_tile(stack, x0, y0, w, h), years)
+            for name, array in statistics.items():
+                datasets[name].GetRasterBand(1).WriteArray(array, x0, y0)
+            if water_stack is not None:
+                tile = np.empty((water_stack.RasterCount, h, w), dtype=np.uint8)
+                for i in range(water_stack.RasterCount):
+                    tile[i] = water_stack.GetRasterBand(i + 1).ReadAsArray(x0, y0, w, h)
+                datasets['water_frequency'].GetRasterBand(1).WriteArray(water_frequency(tile), x0, y0)
+        print(f'{index}: {min(y0 + tile_size, height)}/{height} rows', end='\r')
+    print()
+
+    for name, ds in datasets.items():
+        ds.FlushCache()
+        datasets[name] = None
+    for file in outputs.values():
+        os.replace(file + '.tmp', file)
+    return list(outputs.values())
+
+def main():
+    supported = tuple(i for i in GdalExecutor.SUPPORTED_INDICES if i not in ('test', 'water_mask'))
+    parser = argparse.ArgumentParser(description='Calculate per-pixel temporal statistics of an index over Landsat 8/9 scenes of the same path/row.')
+    parser.add_argument('scenes', nargs='*', help='scene directories or glob patterns of them (quote patterns to keep them from the shell)')
+    parser.add_argument('--list', default=None, help='file with scene directories or glob patterns, one per line')
+    parser.add_argument('--index', required=True, choices=supported, help='index to analyse')
+    parser.add_argument('--water-index', default='ndwi', choices=GdalExecutor.WATER_EXTRACTION_INDICES, help='index the water mask is calculated from, default: ndwi')
+    parser.add_argument('--no-water', action='store_true', help='do not calculate water masks and water frequency')
+    parser.add_argument('-o', '--output', required=True, help='output directory')
+    parser.add_argument('--tile', type=int, default=DEFAULT_TILE, help=f'tile size in pixels, default: {DEFAULT_TILE}')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='number of worker processes calculating indices, default: number of CPUs')
+    parser.add_argument('--memory-limit', type=int, default=None, help='memory limit of a worker process calculating indices in MB, see --memory-limit of batch.py')
+    parser.add_argument('--force', action='store_true', help='calculate indices of complete scenes again instead of resuming')
+    args = parser.parse_args()
+
+    if args.workers <= 0:
+        parser.error('--workers must be > 0')
+    if args.tile <= 0:
+        parser.error('--tile must be > 0')
+    if args.memory_limit is not None and args.memory_limit <= 0:
+        parser.error('--memory-limit must be > 0')
+    if len(args.scenes) == 0 and args.list is None:
+        parser.error('no scenes given')
+
+    scenes, errors = batch.find_scenes(args.scenes, args.list)
+    groups, group_errors = group_scenes(scenes)
+    errors += group_errors
+    for error in errors:
+        print(f'Skipped: {error}')
+    indices = scene_indices(args.index, None if args.no_water else args.water_index)
+    scenes = [scene for dates in groups.values() for _, scene in dates]
+    markers, failed = batch.run_batch(scenes, indices, os.path.join(args.output, STACK_DIR), args.workers, args.memory_limit, args.force)
+    markers = {marker['scene']: marker for marker in markers}
+
+    for path_row, dates in groups.items():
+        dates = [(date, markers[scene['name']]) for date, scene in dates if scene['name'] in markers]
+        if len(dates) < 2:
+            print(f'{path_row}: {len(dates)} processed dates, at least 2 are needed')
+            failed.append({'scene': path_row, 'error': 'not enough dates'})
+            continue
+        directory = os.path.join(args.output, path_row)
+        os.makedirs(directory, exist_ok=True)
+        start = time.perf_counter()
+        def files(index: str) -> list[str]:
+            return [os.path.join(args.output, STACK_DIR, marker['scene'], marker['indices'][index]['file']) for _, marker in dates]
+        try:
+            stack = build_stack(files(args.index), [date for date, _ in dates], os.path.join(directory, f'{args.index}_stack.vrt'))
+            water_stack = None if args.no_water else build_stack(files('water_mask'), [date for date, _ in dates], os.path.join(directory, 'water_mask_stack.vrt'))
+            print(f'{path_row}: {len(dates)} dates from {dates[0][0]} to {dates[-1][0]}, {stack.RasterXSize}x{stack.RasterYSize} pixels, '
+                  f'about {len(dates) * args.tile * args.tile * 16 // (1024 * 1024)} MB per tile')
+            temporal_statistics(stack, water_stack, [date for date, _ in dates], args.index, directory, args.tile)
+        except (RuntimeError, ValueError, OSError) as e:
+            print(f'{path_row}: failed: {e}')
+            failed.append({'scene': path_row, 'error': str(e)})
+            continue
+        print(f'{path_row}: statistics written to {directory} in {time.perf_counter() - start:.1f} s')
+
+    if len(failed) > 0 or len(errors) > 0:
+        raise SystemExit(1)
+
+if __name__ == '__main__':
+    main()
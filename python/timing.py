@@ -0,0 +1,164 @@
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable
+
+# Spans are only recorded if the server is started with SERVER_TIMING=1 or after 'enable' is called.
+# Disabled, 'span' returns a shared no-op context manager and nothing is allocated or timed.
+RECENT_SIZE = 64
+_enabled = os.environ.get('SERVER_TIMING', '0') == '1'
+_local = threading.local()
+_recent = deque(maxlen=RECENT_SIZE)
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class Recorder:
+    """Collects spans of one request. Spans of the same name are summed up: count, total time and own time, i.e. total time minus the time covered by nested spans, including spans run for it on other threads with 'bind'."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.time()
+        self.seconds = None
+        self.status = None
+        self.spans = {}
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add(self, name: str, total: float, own: float) -> None:
+        with self._lock:
+            span = self.spans.setdefault(name, [0, 0.0, 0.0])
+            span[0] += 1
+            span[1] += total
+            span[2] += own
+
+    def finish(self, status: int) -> None:
+        self.seconds = time.perf_counter() - self._start
+        self.status = status
+
+    def header(self) -> str:
+        """Returns the value of the Server-Timing header: own time of every span in milliseconds and the total time of the request."""
+
+        with self._lock:
+            spans = [f'{name};dur={own * 1000:.1f};desc="{count}x"' for name, (count, _, own) in self.spans.items()]
+        seconds = self.seconds if self.seconds is not None else time.perf_counter() - self._start
+        return ', '.join(spans + [f'total;dur={seconds * 1000:.1f}'])
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            spans = {name: {'count': count, 'seconds': total, 'own_seconds': own} for name, (count, total, own) in self.spans.items()}
+        return {
+            'request': self.name,
+            'started': self.started,
+            'seconds': self.seconds,
+            'status': self.status,
+            'spans': spans
+        }
+
+def _covered(intervals: list[tuple[float, float]], start: float, end: float) -> float:
+    """Returns how much of [start; end] is covered by the union of 'intervals'. Nested spans run in parallel on a thread pool overlap and are counted once."""
+
+    covered, last = 0.0, start
+    for a, b in sorted(intervals):
+        a, b = max(a, last), min(b, end)
+        if b > a:
+            covered += b - a
+            last = b
+    return covered
+
+class _Span:
+    __slots__ = ('_recorder', '_name', '_parent', '_children', '_start')
+
+    def __init__(self, recorder: Recorder, name: str):
+        self._recorder = recorder
+        self._name = name
+
+    def __enter__(self):
+        self._parent = getattr(_local, 'span', None)
+        self._children = []
+        _local.span = self
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        total = end - self._start
+        _local.span = self._parent
+        if self._parent is not None:
+            # the parent may be on another thread, see 'bind'; list.append is atomic
+            self._parent._children.append((self._start, end))
+        self._recorder.add(self._name, total, total - _covered(list(self._children), self._start, end))
+        return False
+
+def enable(enabled: bool=True) -> None:
+    global _enabled
+    _enabled = enabled
+
+def is_enabled() -> bool:
+    return _enabled
+
+def begin(name: str) -> Recorder | None:
+    """Starts recording spans of request 'name' on the calling thread. Returns the recorder or None if timing is disabled."""
+
+    if not _enabled:
+        return None
+    recorder = Recorder(name)
+    _local.recorder = recorder
+    _local.span = None
+    return recorder
+
+def finish(status: int) -> Recorder | None:
+    """Stops recording spans on the calling thread, stores the recorder among the last RECENT_SIZE requests and returns it. Returns None if nothing was recorded.
+    Spans that are bound to the request with 'bind' and end later, e.g. streaming encoders, are still added to the stored recorder."""
+
+    recorder = getattr(_local, 'recorder', None)
+    if recorder is None:
+        return None
+    _local.recorder = None
+    _local.span = None
+    recorder.finish(status)
+    _recent.append(recorder)
+    return recorder
+
+def current() -> Recorder | None:
+    return getattr(_local, 'recorder', None) if _enabled else None
+
+def span(name: str) -> '_Span | _NullSpan':
+    """Returns a context manager that adds the time spent inside it to span 'name' of the current request."""
+
+    if not _enabled:
+        return _NULL_SPAN
+    recorder = getattr(_local, 'recorder', None)
+    if recorder is None:
+        return _NULL_SPAN
+    return _Span(recorder, name)
+
+def bind(func: Callable) -> Callable:
+    """Wraps 'func' to record its spans into the current request when it is run on another thread, e.g. in a thread pool. Returns 'func' itself if nothing is recorded.
+    Spans of 'func' are nested into the span that is open when 'bind' is called, so the time they cover is excluded from its own time once, however many threads run them."""
+
+    recorder = current()
+    if recorder is None:
+        return func
+    parent = getattr(_local, 'span', None)
+
+    def _bound(*args, **kwargs):
+        prev_recorder, prev_span = getattr(_local, 'recorder', None), getattr(_local, 'span', None)
+        _local.recorder, _local.span = recorder, parent
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.recorder, _local.span = prev_recorder, prev_span
+    return _bound
+
+def recent() -> list[dict]:
+    """Returns spans of the last RECENT_SIZE requests, oldest first."""
+
+    return [recorder.to_dict() for recorder in list(_recent)]
@@ -3,10 +3,27 @@
 # 3. Test both together
 
 import unittest
+import os
+import json
+import io
+import tempfile
+import datetime
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
+import numpy as np
+from PIL import Image
+from osgeo import gdal, osr
 from time import sleep
 from werkzeug.test import EnvironBuilder
-from server import server, proto, executor, generate_http_response
+from server import server, proto, executor, generate_http_response, encode_image
+import profiler
+import timing
+import index_calculator as indcal
+from gdal_executor import GdalExecutor, Preview, AdmissionController, Prefetcher, PreviewManager, PreviewBusyError
+import benchmark
+import batch
+import timeseries
+from flask import request
 
 server.testing = True
 client = server.test_client()
@@ -70,6 +87,21 @@ http_headers = {
         'Protocol-Version': proto_version,
         'Request-ID': 0
     },
+    'get_preview_webp': {
+        'Accept': 'image/webp',
+        'Protocol-Version': proto_version,
+        'Request-ID': 0
+    },
+    'get_preview_jpeg': {
+        'Accept': 'image/jpeg',
+        'Protocol-Version': proto_version,
+        'Request-ID': 0
+    },
+    'get_array_ok': {
+        'Accept': 'application/octet-stream',
+        'Protocol-Version': proto_version,
+        'Request-ID': 0
+    },
     'get_index_ok': {
         'Accept': 'image/tiff',
         'Protocol-Version': proto_version,
@@ -951,6 +983,360 @@ requests_json = {
             "index": "ndbi",
             "lang": "body"
         }
+    },
+    'session_stats_ok': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "session_stats",
+        "parameters": {}
+    },
+    'session_stats_non_empty_params': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "session_stats",
+        "parameters": {
+            "rule34": 42069
+        }
+    },
+    'calc_previews_ok': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "calc_previews",
+        "parameters": {
+            "indices": ["test"],
+            "width": 100,
+            "height": 100
+        }
+    },
+    'calc_previews_no_indices': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "calc_previews",
+        "parameters": {
+            "width": 100,
+            "height": 100
+        }
+    },
+    'calc_previews_empty_indices': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "calc_previews",
+        "parameters": {
+            "indices": [],
+            "width": 100,
+            "height": 100
+        }
+    },
+    'calc_previews_inv_indices_type': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "calc_previews",
+        "parameters": {
+            "indices": ["test", 69],
+            "width": 100,
+            "height": 100
+        }
+    },
+    'calc_previews_inv_width_type': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "calc_previews",
+        "parameters": {
+            "indices": ["test"],
+            "width": 'abc',
+            "height": 100
+        }
+    },
+    'calc_previews_inv_height': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "calc_previews",
+        "parameters": {
+            "indices": ["test"],
+            "width": 100,
+            "height": -10
+        }
+    },
+    'calc_previews_unsupported_index': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "calc_previews",
+        "parameters": {
+            "indices": ["test", "rule34"],
+            "width": 100,
+            "height": 100
+        }
+    },
+    'calc_previews_index_not_created': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "calc_previews",
+        "parameters": {
+            "indices": ["test", "oc3"],
+            "width": 100,
+            "height": 100
+        }
+    },
+    'query_pixels_ok': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "query_pixels",
+        "parameters": {
+            "index": "test",
+            "points": [[0, 0]],
+            "crs": "dataset"
+        }
+    },
+    'query_pixels_no_points': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "query_pixels",
+        "parameters": {
+            "index": "test",
+            "crs": "dataset"
+        }
+    },
+    'query_pixels_inv_index_type': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "query_pixels",
+        "parameters": {
+            "index": 69,
+            "points": [[0, 0]],
+            "crs": "dataset"
+        }
+    },
+    'query_pixels_inv_points': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "query_pixels",
+        "parameters": {
+            "index": "test",
+            "points": [[0, 0], [1]],
+            "crs": "dataset"
+        }
+    },
+    'query_pixels_inv_crs': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "query_pixels",
+        "parameters": {
+            "index": "test",
+            "points": [[0, 0]],
+            "crs": "EPSG:3857"
+        }
+    },
+    'query_pixels_not_created': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "query_pixels",
+        "parameters": {
+            "index": "oc3",
+            "points": [[0, 0]],
+            "crs": "EPSG:4326"
+        }
+    },
+    'zonal_stats_ok': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "zonal_stats",
+        "parameters": {
+            "index": "test",
+            "zones": {
+                "type": "FeatureCollection",
+                "features": []
+            }
+        }
+    },
+    'zonal_stats_no_zones': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "zonal_stats",
+        "parameters": {
+            "index": "test"
+        }
+    },
+    'zonal_stats_inv_index_type': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "zonal_stats",
+        "parameters": {
+            "index": 69,
+            "zones": "water_mask"
+        }
+    },
+    'zonal_stats_inv_zones': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "zonal_stats",
+        "parameters": {
+            "index": "test",
+            "zones": "rule34"
+        }
+    },
+    'zonal_stats_not_created': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "zonal_stats",
+        "parameters": {
+            "index": "oc3",
+            "zones": "water_mask"
+        }
+    },
+    'zonal_stats_no_water_mask': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "zonal_stats",
+        "parameters": {
+            "index": "test",
+            "zones": "water_mask"
+        }
+    },
+    'set_aoi_ok': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "set_aoi",
+        "parameters": {
+            "aoi": None,
+            "crs": "dataset"
+        }
+    },
+    'set_aoi_no_crs': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "set_aoi",
+        "parameters": {
+            "aoi": None
+        }
+    },
+    'set_aoi_inv_aoi': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "set_aoi",
+        "parameters": {
+            "aoi": [10, 10, 0, 0],
+            "crs": "dataset"
+        }
+    },
+    'set_aoi_inv_crs': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "set_aoi",
+        "parameters": {
+            "aoi": None,
+            "crs": "EPSG:3857"
+        }
+    },
+    'set_aoi_outside': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "set_aoi",
+        "parameters": {
+            "aoi": [-1e9, -1e9, -1e9 + 1, -1e9 + 1],
+            "crs": "dataset"
+        }
+    },
+    'water_bodies_ok': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "water_bodies",
+        "parameters": {
+            "min_area": 900
+        }
+    },
+    'water_bodies_no_min_area': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "water_bodies",
+        "parameters": {}
+    },
+    'water_bodies_inv_min_area': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "water_bodies",
+        "parameters": {
+            "min_area": -1
+        }
+    },
+    'save_session_no_dir': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "save_session",
+        "parameters": {}
+    },
+    'save_session_inv_dir': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "save_session",
+        "parameters": {
+            "dir": ""
+        }
+    },
+    'load_session_inv_dir': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "load_session",
+        "parameters": {
+            "dir": 1
+        }
+    },
+    'load_session_no_snapshot': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "load_session",
+        "parameters": {
+            "dir": "/nonexistent/session"
+        }
+    },
+    'gdal_diagnostics_ok': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "gdal_diagnostics",
+        "parameters": {}
+    },
+    'gdal_diagnostics_non_empty_params': {
+        "proto_version": proto_version,
+        "server_version": server_version,
+        "id": 0,
+        "operation": "gdal_diagnostics",
+        "parameters": {
+            "rule34": 42069
+        }
     }
 }
 
@@ -991,6 +1377,26 @@ def check_json(request_json):
     response = proto.match(request_json, response)
     return response['status']
 
+def execute(ex, operation, **parameters):
+    return ex.execute({
+        'proto_version': proto.get_version(),
+        'server_version': ex.get_version(),
+        'id': 0,
+        'operation': operation,
+        'parameters': parameters
+    })
+
+# A separate executor with a synthetic scene from 'benchmark.generate_scene', so that the shared session is not touched.
+def scene_executor(directory, proc_level='L2SP', width=240, height=160):
+    ex = GdalExecutor(proto)
+    scene = benchmark.generate_scene(directory, proc_level, width, height)
+    execute(ex, 'set_satellite', satellite='Landsat 8/9', proc_level=proc_level)
+    for band, file in scene['bands'].items():
+        execute(ex, 'import_gtiff', file=file, band=band)
+    if proc_level == 'L1TP':
+        execute(ex, 'import_metafile', file=scene['mtl'])
+    return ex
+
 def check_all(endpoint, headers, body):
     res = POST(endpoint, headers, body)
     return res.status_code, \
@@ -1075,6 +1481,9 @@ class Test(unittest.TestCase):
         index = POST('/api/calc_index', http_headers['ok'], requests_json['calc_index_ok1'])
         url_ind = index.get_json()['result']['url']
         self.assertIsNone(GET(url_pr, http_headers['get_preview_ok'], '').headers.get('Reason'))
+        self.assertEqual('1', GET(url_pr, http_headers['get_preview_ok'], '').headers.get('Preview-Final'))
+        self.assertEqual('image/webp', GET(url_pr, http_headers['get_preview_webp'], '').headers.get('Content-Type'))
+        self.assertEqual(400, GET(url_pr, http_headers['get_preview_jpeg'], '').status_code)
         self.assertIsNone(GET(url_ind, http_headers['get_index_ok'], '').headers.get('Reason'))
         self.assertIsNone(POST('/api/set_satellite', http_headers['ok'], requests_json['set_satellite_ok']).headers.get('Reason'))
         self.assertIsNone(POST('/api/end_session', http_headers['ok'], requests_json['end_session_ok']).headers.get('Reason'))
@@ -1109,6 +1518,7 @@ class Test(unittest.TestCase):
         prev = POST('/api/calc_preview', http_headers['ok'], req)
         url_pr = prev.get_json()['result']['url'] + '&sb=1&mask=0'
         self.assertEqual(400, GET(url_pr, http_headers['get_preview_ok'], '').status_code)
+        self.assertEqual(200, GET(url_pr.replace('&sb=1', '&sb=0'), http_headers['get_preview_jpeg'], '').status_code)
         self.assertEqual(400, GET('/resource/index', http_headers['ok'], '').status_code)
         self.assertEqual(400, GET('/resource/index?a=1', http_headers['ok'], '').status_code)
         self.assertEqual(400, GET('/resource/index?id=abc', http_headers['ok'], '').status_code)
@@ -1213,6 +1623,120 @@ class Test(unittest.TestCase):
 
         self.assertTrue(http_reason['get_preview_cant_water_mask'] in GET('/resource/preview?id=0&sb=0&mask=1', http_headers['get_preview_ok'], '').headers.get('Reason'))
 
+    def test_http_array(self):
+        self.prepare()
+        index = POST('/api/calc_index', http_headers['ok'], requests_json['calc_index_ok1'])
+        url_arr = index.get_json()['result']['url'].replace('/resource/index', '/resource/array')
+        arr = GET(url_arr, http_headers['get_array_ok'], '')
+        self.assertEqual(200, arr.status_code)
+        shape = [int(n) for n in arr.headers.get('Array-Shape').split(',')]
+        self.assertEqual(np.prod(shape) * np.dtype(arr.headers.get('Array-Dtype')).itemsize, len(arr.data))
+        full = GET(url_arr + '&x=1&y=1&w=10&h=10', http_headers['get_array_ok'], '')
+        arr = GET(url_arr + '&x=1&y=1&w=10&h=10&step=3', http_headers['get_array_ok'], '')
+        self.assertEqual(200, arr.status_code)
+        self.assertEqual('4,4', arr.headers.get('Array-Shape'))
+        full_data = np.frombuffer(full.data, dtype=full.headers.get('Array-Dtype')).reshape(10, 10)
+        data = np.frombuffer(arr.data, dtype=arr.headers.get('Array-Dtype')).reshape(4, 4)
+        self.assertTrue(np.array_equal(full_data[::3, ::3], data))
+        full_gt = [float(n) for n in full.headers.get('Array-Geotransform').split(',')]
+        gt = [float(n) for n in arr.headers.get('Array-Geotransform').split(',')]
+        self.assertEqual((full_gt[0], full_gt[3]), (gt[0], gt[3]))
+        for i in range(4):  # sample i of the decimated array is pixel 3 * i of the window
+            self.assertAlmostEqual(full_gt[0] + 3 * i * full_gt[1], gt[0] + i * gt[1])
+            self.assertAlmostEqual(full_gt[3] + 3 * i * full_gt[5], gt[3] + i * gt[5])
+        hdrs = http_headers['get_array_ok'].copy()
+        hdrs['Range'] = 'bytes=0-3'
+        arr = GET(url_arr, hdrs, '')
+        self.assertEqual(206, arr.status_code)
+        self.assertEqual(4, len(arr.data))
+        self.assertEqual(400, GET(url_arr + '&step=0', http_headers['get_array_ok'], '').status_code)
+        self.assertEqual(400, GET(url_arr + '&x=abc', http_headers['get_array_ok'], '').status_code)
+        self.assertEqual(400, GET(url_arr + '&a=1', http_headers['get_array_ok'], '').status_code)
+        self.assertEqual(404, GET('/resource/array?id=4206934', http_headers['get_array_ok'], '').status_code)
+
+    def test_http_metrics(self):
+        POST('/api/PING', http_headers['ok'], requests_json['ping_ok'])
+        res = client.get('/metrics')
+        self.assertEqual(200, res.status_code)
+        self.assertTrue(res.headers.get('Content-Type').startswith('text/plain; version=0.0.4'))
+        body = res.get_data(as_text=True)
+        self.assertTrue('http_requests_total{endpoint="api",target="PING",status="200"}' in body)
+        self.assertTrue('http_request_duration_seconds_count{endpoint="api",target="PING"}' in body)
+        self.assertTrue('protocol_responses_total{command="PING",code="0"}' in body)
+        self.assertTrue('lock_wait_seconds_count{lock="dataset_manager"}' in body)
+        self.assertTrue('datasets_held ' in body)
+
+    def test_http_profile(self):
+        profiler.enable(False)
+        self.assertEqual(404, client.post('/profile?mode=cprofile&requests=1').status_code)
+        profiler.enable()
+        self.assertEqual(400, client.post('/profile?mode=cprofile').status_code)
+        self.assertEqual(400, client.post('/profile?mode=unknown&requests=1').status_code)
+        self.assertEqual(202, client.post('/profile?mode=cprofile&requests=1&targets=PING').status_code)
+        self.assertEqual(409, client.post('/profile?mode=sample&seconds=1').status_code)
+        self.assertEqual(202, client.get('/profile').status_code)
+        POST('/api/PING', http_headers['ok'], requests_json['ping_ok'])
+        res = client.get('/profile')
+        self.assertEqual(200, res.status_code)
+        self.assertTrue('_handle_command' in res.get_data(as_text=True))
+        self.assertEqual(200, client.get('/profile?format=pstats').status_code)
+        self.assertEqual(400, client.get('/profile?format=collapsed').status_code)
+        profiler.enable(False)
+
+    def test_http_scalebar_no_index(self):
+        # the preview outlives its index, e.g. the index was closed
+        id_ = executor.pv_man.add(np.zeros((10, 10), dtype=np.uint8), 'nsmi', 10, 10)
+        res = GET(f'/resource/preview?id={id_}&sb=1&mask=0', http_headers['get_preview_ok'], '')
+        self.assertEqual(404, res.status_code)
+        self.assertEqual('Unable to generate a scalebar: index "nsmi" of the preview does not exist.', res.headers.get('Reason'))
+        self.assertEqual(200, GET(f'/resource/preview?id={id_}&sb=0&mask=0', http_headers['get_preview_ok'], '').status_code)
+        executor.pv_man.remove(id_)
+
+    def test_http_timing(self):
+        url_pr = POST('/api/calc_preview', http_headers['ok'], requests_json['calc_preview_ok']).get_json()['result']['url'] + '&sb=0&mask=0'
+        url_ind = POST('/api/calc_index', http_headers['ok'], requests_json['calc_index_ok1']).get_json()['result']['url']
+        timing.enable(False)
+        self.assertIsNone(GET(url_pr, http_headers['get_preview_ok'], '').headers.get('Server-Timing'))
+        self.assertIsNone(GET(url_ind, http_headers['get_index_ok'], '').headers.get('Server-Timing'))
+        self.assertEqual(404, client.get('/timings').status_code)
+
+        timing.enable()
+        header = r'^([a-z_]+;dur=\d+\.\d;desc="\d+x", )*total;dur=\d+\.\d$'
+        for url, hdrs, stage in ((url_pr, http_headers['get_preview_ok'], 'colorize'), (url_ind, http_headers['get_index_ok'], 'encode')):
+            res = GET(url, hdrs, '')
+            self.assertEqual(200, res.status_code)
+            value = res.headers.get('Server-Timing')
+            self.assertIsNotNone(value)
+            self.assertRegex(value, header)
+            names = [entry.split(';')[0] for entry in value.split(', ')]
+            self.assertEqual(len(names), len(set(names)))
+            self.assertIn(stage, names)
+        self.assertEqual(200, client.get('/timings').status_code)
+        timing.enable(False)
+
+    def test_http_admission(self):
+        admission = AdmissionController(budget=1024 * 1024, wait=0.1)
+        first, second = admission.estimate('calc_index', 1), admission.estimate('calc_index', 1)
+        self.assertTrue(admission.acquire(first))
+        self.assertFalse(admission.acquire(second))
+        admission.release(first)
+        self.assertTrue(admission.acquire(second))
+        admission.release(second)
+        self.assertEqual(1, admission.get_stats()['rejected'])
+        huge = admission.estimate('calc_index', 2 * 1024 * 1024)
+        self.assertTrue(admission.acquire(huge))  # alone it is admitted despite the budget
+        admission.release(huge)
+        strict = AdmissionController(budget=1024 * 1024, wait=10, strict=True)
+        self.assertFalse(strict.acquire(strict.estimate('calc_index', 2 * 1024 * 1024)))
+        self.assertEqual(1, strict.get_stats()['rejected'])
+
+        response_json = deepcopy(requests_json['ping_ok'])
+        response_json['status'], response_json['result'] = 20200, {'error': 'server is busy', 'retry_after': 3}
+        with server.test_request_context('/api/calc_index', method='POST', headers=http_headers['ok']):
+            res = generate_http_response(request, response_json)
+        self.assertEqual(503, res.status_code)
+        self.assertEqual('3', res.headers.get('Retry-After'))
+
     ### JSON ONLY ###
     
     ### Common ###
@@ -1364,6 +1888,168 @@ class Test(unittest.TestCase):
         # self.assertEqual(20901, check_json(requests_json['generate_description_unsupported_lang']))
         self.assertEqual(20902, check_json(requests_json['generate_description_index_not_calced']))
 
+    def test_json_session_stats(self):
+        self.assertEqual(0, check_json(requests_json['session_stats_ok']))
+        self.assertEqual(11000, check_json(requests_json['session_stats_non_empty_params']))
+
+    def test_json_calc_previews(self):
+        self.assertEqual(0, check_json(requests_json['calc_previews_ok']))
+        self.assertEqual(10007, check_json(requests_json['calc_previews_no_indices']))
+        self.assertEqual(11100, check_json(requests_json['calc_previews_empty_indices']))
+        self.assertEqual(11100, check_json(requests_json['calc_previews_inv_indices_type']))
+        self.assertEqual(11101, check_json(requests_json['calc_previews_inv_width_type']))
+        self.assertEqual(11102, check_json(requests_json['calc_previews_inv_height']))
+        self.assertEqual(21100, check_json(requests_json['calc_previews_unsupported_index']))
+        self.assertEqual(21101, check_json(requests_json['calc_previews_index_not_created']))
+        # 21102
+
+    def test_json_query_pixels(self):
+        info = executor.execute(requests_json['calc_index_ok1'])['result']['info']
+        req = deepcopy(requests_json['query_pixels_ok'])
+        req['parameters']['points'] = [[info['origin'][0] + info['pixel_size'][0] / 2, info['origin'][1] + info['pixel_size'][1] / 2], [0, 0]]
+        res = executor.execute(req)
+        self.assertEqual(0, res['status'])
+        self.assertEqual(2, len(res['result']['values']))
+        self.assertIsNone(res['result']['values'][1])
+        self.assertEqual(0, check_json(requests_json['query_pixels_ok']))
+        self.assertEqual(10007, check_json(requests_json['query_pixels_no_points']))
+        self.assertEqual(11200, check_json(requests_json['query_pixels_inv_index_type']))
+        self.assertEqual(11201, check_json(requests_json['query_pixels_inv_points']))
+        self.assertEqual(11202, check_json(requests_json['query_pixels_inv_crs']))
+        self.assertEqual(21200, check_json(requests_json['query_pixels_not_created']))
+        with tempfile.TemporaryDirectory() as directory:
+            ex = scene_executor(directory)
+            self.assertEqual(0, execute(ex, 'calc_index', index='ndwi')['status'])
+            ex.ds_man.get(ex.ds_man.find('ndwi')).dataset.SetProjection('')
+            self.assertEqual(21201, execute(ex, 'query_pixels', index='ndwi', points=[[37.6, 55.7]], crs='EPSG:4326')['status'])
+            execute(ex, 'end_session')
+
+    def test_json_zonal_stats(self):
+        info = executor.execute(requests_json['calc_index_ok1'])['result']['info']
+        x0, y0 = info['origin']
+        x1, y1 = x0 + info['width'] * info['pixel_size'][0], y0 + info['height'] * info['pixel_size'][1]
+        req = deepcopy(requests_json['zonal_stats_ok'])
+        req['parameters']['zones']['crs'] = {"type": "name", "properties": {"name": info['projection']}}
+        req['parameters']['zones']['features'].append({
+            "type": "Feature",
+            "properties": {},
+            "geometry": {"type": "Polygon", "coordinates": [[[x0, y0], [x1, y0], [x1, y1], [x0, y1], [x0, y0]]]}
+        })
+        res = executor.execute(req)
+        self.assertEqual(0, res['status'])
+        self.assertEqual(1, len(res['result']['zones']))
+        self.assertTrue(res['result']['zones'][0]['count'] > 0)
+        self.assertEqual(0, check_json(requests_json['zonal_stats_ok']))
+        self.assertEqual(10007, check_json(requests_json['zonal_stats_no_zones']))
+        self.assertEqual(11300, check_json(requests_json['zonal_stats_inv_index_type']))
+        self.assertEqual(11301, check_json(requests_json['zonal_stats_inv_zones']))
+        self.assertEqual(21300, check_json(requests_json['zonal_stats_not_created']))
+        self.assertEqual(21301, check_json(requests_json['zonal_stats_no_water_mask']))
+        # 21302, 21303
+
+    def test_json_set_aoi(self):
+        info = executor.execute(requests_json['calc_index_ok1'])['result']['info']
+        x0, y0 = info['origin']
+        x1, y1 = x0 + info['width'] // 2 * info['pixel_size'][0], y0 + info['height'] // 2 * info['pixel_size'][1]
+        req = deepcopy(requests_json['set_aoi_ok'])
+        req['parameters']['aoi'] = [min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)]
+        self.assertEqual(0, executor.execute(req)['status'])
+        res = executor.execute(requests_json['calc_index_ok1'])
+        self.assertEqual(0, res['status'])
+        self.assertEqual(info['width'] // 2, res['result']['info']['width'])
+        self.assertEqual(info['height'] // 2, res['result']['info']['height'])
+        self.assertEqual(info['origin'], res['result']['info']['origin'])
+        req['parameters']['aoi'] = {"type": "Polygon", "coordinates": [[[x0, y0], [x1, y0], [x1, y1], [x0, y0]]]}
+        self.assertEqual(0, executor.execute(req)['status'])
+        self.assertEqual(info['width'] // 2, executor.execute(requests_json['calc_index_ok1'])['result']['info']['width'])
+        self.assertEqual(0, check_json(requests_json['set_aoi_ok']))
+        self.assertEqual(info['width'], executor.execute(requests_json['calc_index_ok1'])['result']['info']['width'])
+        self.assertEqual(10007, check_json(requests_json['set_aoi_no_crs']))
+        self.assertEqual(11400, check_json(requests_json['set_aoi_inv_aoi']))
+        self.assertEqual(11401, check_json(requests_json['set_aoi_inv_crs']))
+        self.assertEqual(21402, check_json(requests_json['set_aoi_outside']))
+        # 21400, 21401
+
+    def test_json_water_bodies(self):
+        self.assertEqual(10007, check_json(requests_json['water_bodies_no_min_area']))
+        self.assertEqual(11500, check_json(requests_json['water_bodies_inv_min_area']))
+        self.assertEqual(21500, check_json(requests_json['water_bodies_ok']))
+        # 21501
+
+    def test_json_save_session(self):
+        self.assertEqual(10007, check_json(requests_json['save_session_no_dir']))
+        self.assertEqual(11600, check_json(requests_json['save_session_inv_dir']))
+        # 21600
+
+    def test_json_load_session(self):
+        self.assertEqual(11700, check_json(requests_json['load_session_inv_dir']))
+        self.assertEqual(21700, check_json(requests_json['load_session_no_snapshot']))
+        # 21701
+
+    def test_json_session_round_trip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            ex = scene_executor(os.path.join(directory, 'scene'), 'L1TP')
+            self.assertEqual(0, execute(ex, 'calc_index', index='ndwi')['status'])
+            self.assertEqual(0, execute(ex, 'calc_index', index='water_mask')['status'])
+            cloud = ex.ds_man.get_cloud_mask().copy()
+            self.assertTrue(cloud.any())
+            saved = {}
+            for index in ('ndwi', 'water_mask'):
+                ds = ex.ds_man.get(ex.ds_man.find(index))
+                saved[index] = (ds.stats, ds.dataset.GetRasterBand(1).ReadAsArray())
+
+            response = execute(ex, 'save_session', dir=os.path.join(directory, 'session'))
+            self.assertEqual(0, response['status'])
+            self.assertEqual(['ndwi', 'water_mask'], sorted(response['result']['indices']))
+            session = os.path.join(directory, 'session')
+            generations = lambda: sorted(name for name in os.listdir(session) if name.startswith('snapshot_'))
+            self.assertEqual(1, len(generations()))
+            self.assertEqual(0, execute(ex, 'save_session', dir=session)['status'])
+            saved_generations = generations()
+            self.assertEqual(1, len(saved_generations))
+            # a failed save neither touches the previous snapshot nor leaves its files behind
+            def _fail(directory, generation):
+                open(os.path.join(directory, generation, 'index_ndwi.tif'), 'wb').close()
+                raise OSError('disk full')
+            ex.ds_man._snapshot = _fail
+            self.assertEqual(21600, execute(ex, 'save_session', dir=session)['status'])
+            del ex.ds_man._snapshot
+            self.assertEqual(saved_generations, generations())
+            self.assertEqual(0, execute(ex, 'end_session')['status'])
+            self.assertIsNone(ex.ds_man.find('ndwi'))
+            self.assertIsNone(ex.ds_man.get_cloud_mask())
+
+            response = execute(ex, 'load_session', dir=os.path.join(directory, 'session'))
+            self.assertEqual(0, response['status'])
+            self.assertEqual(('Landsat 8/9', 'L1TP'), (response['result']['satellite'], response['result']['proc_level']))
+            self.assertEqual(['ndwi', 'water_mask'], sorted(response['result']['indices']))
+            for index, (stats, array) in saved.items():
+                id_ = ex.ds_man.find(index)
+                self.assertIsNotNone(id_)
+                ds = ex.ds_man.get(id_)
+                self.assertEqual(stats, ds.stats)
+                self.assertTrue(np.array_equal(array, ds.dataset.GetRasterBand(1).ReadAsArray(), equal_nan=True))
+            # the cloud mask is restored from the snapshot, not built from the QA band again
+            self.assertIsNotNone(ex.ds_man._cloud_bits)
+            self.assertTrue(np.array_equal(cloud, ex.ds_man.get_cloud_mask()))
+            self.assertEqual(0, execute(ex, 'calc_preview', index='ndwi', width=100, height=100)['status'])
+            execute(ex, 'end_session')
+
+    def test_json_gdal_diagnostics(self):
+        self.assertEqual(0, check_json(requests_json['gdal_diagnostics_ok']))
+        self.assertEqual(11800, check_json(requests_json['gdal_diagnostics_non_empty_params']))
+
+    def test_json_prefetch(self):
+        prefetcher, done = Prefetcher(idle_delay=0.05), []
+        with prefetcher.foreground():
+            prefetcher.schedule([lambda: done.append(1) or True, lambda: False])
+            self.assertFalse(prefetcher.wait_idle(0.2))
+            self.assertEqual([], done)
+        self.assertTrue(prefetcher.wait_idle(2))
+        self.assertEqual([1], done)
+        self.assertEqual({'pending': 0, 'scheduled': 2, 'completed': 1, 'skipped': 1}, prefetcher.get_stats())
+        self.assertIn('prefetch', executor.execute(requests_json['session_stats_ok'])['result'])
+
     ### BOTH ###
    
     def test_cross(self):
@@ -1518,6 +2204,483 @@ class Test(unittest.TestCase):
         # self.assertEqual((400, 20901), _codes(POST('api/generate_description', http_headers['ok'], requests_json['generate_description_unsupported_lang'])))
         self.assertEqual((500, 20902), _codes(POST('api/generate_description', http_headers['ok'], requests_json['generate_description_index_not_calced'])))
 
+        self.assertEqual((200, 0), _codes(POST('/api/session_stats', http_headers['ok'], requests_json['session_stats_ok'])))
+        self.assertEqual((400, 11000), _codes(POST('/api/session_stats', http_headers['ok'], requests_json['session_stats_non_empty_params'])))
+        self.assertEqual((200, 0), _codes(POST('/api/calc_previews', http_headers['ok'], requests_json['calc_previews_ok'])))
+        self.assertEqual((400, 11100), _codes(POST('/api/calc_previews', http_headers['ok'], requests_json['calc_previews_empty_indices'])))
+        self.assertEqual((400, 21100), _codes(POST('/api/calc_previews', http_headers['ok'], requests_json['calc_previews_unsupported_index'])))
+        self.assertEqual((500, 21101), _codes(POST('/api/calc_previews', http_headers['ok'], requests_json['calc_previews_index_not_created'])))
+        self.assertEqual((200, 0), _codes(POST('/api/query_pixels', http_headers['ok'], requests_json['query_pixels_ok'])))
+        self.assertEqual((400, 11201), _codes(POST('/api/query_pixels', http_headers['ok'], requests_json['query_pixels_inv_points'])))
+        self.assertEqual((500, 21200), _codes(POST('/api/query_pixels', http_headers['ok'], requests_json['query_pixels_not_created'])))
+        self.assertEqual((200, 0), _codes(POST('/api/zonal_stats', http_headers['ok'], requests_json['zonal_stats_ok'])))
+        self.assertEqual((400, 11301), _codes(POST('/api/zonal_stats', http_headers['ok'], requests_json['zonal_stats_inv_zones'])))
+        self.assertEqual((500, 21301), _codes(POST('/api/zonal_stats', http_headers['ok'], requests_json['zonal_stats_no_water_mask'])))
+        self.assertEqual((200, 0), _codes(POST('/api/set_aoi', http_headers['ok'], requests_json['set_aoi_ok'])))
+        self.assertEqual((400, 11400), _codes(POST('/api/set_aoi', http_headers['ok'], requests_json['set_aoi_inv_aoi'])))
+        self.assertEqual((400, 21402), _codes(POST('/api/set_aoi', http_headers['ok'], requests_json['set_aoi_outside'])))
+        self.assertEqual((400, 11500), _codes(POST('/api/water_bodies', http_headers['ok'], requests_json['water_bodies_inv_min_area'])))
+        self.assertEqual((500, 21500), _codes(POST('/api/water_bodies', http_headers['ok'], requests_json['water_bodies_ok'])))
+        self.assertEqual((400, 11600), _codes(POST('/api/save_session', http_headers['ok'], requests_json['save_session_inv_dir'])))
+        self.assertEqual((400, 11700), _codes(POST('/api/load_session', http_headers['ok'], requests_json['load_session_inv_dir'])))
+        self.assertEqual((500, 21700), _codes(POST('/api/load_session', http_headers['ok'], requests_json['load_session_no_snapshot'])))
+        self.assertEqual((200, 0), _codes(POST('/api/gdal_diagnostics', http_headers['ok'], requests_json['gdal_diagnostics_ok'])))
+        self.assertEqual((400, 11800), _codes(POST('/api/gdal_diagnostics', http_headers['ok'], requests_json['gdal_diagnostics_non_empty_params'])))
+
+    ### INTERNALS ###
+
+    def test_downsample_mask(self):
+        def _naive(mask, shape):
+            ret = np.zeros(shape, dtype=bool)
+            for i in range(shape[0]):
+                r0 = i * mask.shape[0] // shape[0]
+                r1 = max((i + 1) * mask.shape[0] // shape[0], r0 + 1)
+                for j in range(shape[1]):
+                    c0 = j * mask.shape[1] // shape[1]
+                    c1 = max((j + 1) * mask.shape[1] // shape[1], c0 + 1)
+                    ret[i, j] = mask[r0:r1, c0:c1].any()
+            return ret
+
+        rng = np.random.default_rng(42)
+        for src, dst in (((10, 10), (5, 5)), ((17, 23), (5, 7)), ((31, 13), (4, 13)), ((7, 9), (3, 20)), ((5, 5), (5, 5))):
+            mask = rng.random(src) > 0.9
+            ret = indcal.downsample_mask(mask, dst)
+            self.assertEqual(dst, ret.shape)
+            self.assertTrue(np.array_equal(_naive(mask, dst), ret), f'{src} -> {dst}')
+        mask = np.zeros((17, 23), dtype=bool)
+        mask[16, 22] = True
+        self.assertTrue(indcal.downsample_mask(mask, (5, 7))[4, 6])
+        self.assertEqual(1, indcal.downsample_mask(mask, (5, 7)).sum())
+
+    def test_cloud_mask(self):
+        qa = np.ma.array(np.array([[0, 8, 24], [0xffff, 16, 1]], dtype=np.uint16), mask=[[False, False, False], [True, False, False]])
+        ret = indcal.cloud_mask(qa, 3)
+        self.assertEqual(np.bool, ret.dtype)
+        self.assertTrue(np.array_equal([[False, True, True], [True, False, False]], np.ma.getdata(ret)))
+        self.assertTrue(np.array_equal(np.ma.getmaskarray(qa), np.ma.getmaskarray(ret)))
+        self.assertTrue(np.array_equal([[False, False, True], [True, True, False]], np.ma.getdata(indcal.cloud_mask(qa, 4))))
+        self.assertTrue(np.array_equal([[False, False, False], [True, False, False]], np.ma.getdata(indcal.cloud_mask(qa.astype(np.float32), 15))))
+        self.assertRaises(ValueError, indcal.cloud_mask, qa, 16)
+        self.assertRaises(ValueError, indcal.cloud_mask, qa, -1)
+
+    def test_preview_find(self):
+        manager = PreviewManager()
+        small = manager.add(np.zeros((50, 100), dtype=np.uint8), 'ndwi', 100, 50)
+        big = manager.add(np.zeros((100, 200), dtype=np.uint8), 'ndwi', 200, 100)
+        coarse = manager.add(np.zeros((30, 60), dtype=np.uint8), 'ndwi', 600, 300, final=False)
+        other = manager.add(np.zeros((50, 100, 3), dtype=np.uint8), 'nat_col', 100, 50)
+        self.assertEqual(small, manager.find('ndwi', 100, 50))
+        self.assertEqual(big, manager.find('ndwi', 200, 100))
+        self.assertEqual(coarse, manager.find('ndwi', 600, 300))
+        self.assertEqual(other, manager.find('nat_col', 100, 50))
+        self.assertIsNone(manager.find('ndwi', 150, 75))
+        self.assertIsNone(manager.find('mndwi', 100, 50))
+
+        self.assertEqual(small, manager.find_larger('ndwi', 50, 25))  # the coarse 60x30 preview is not final
+        self.assertEqual(small, manager.find_larger('ndwi', 100, 50))
+        self.assertEqual(big, manager.find_larger('ndwi', 150, 75))
+        self.assertEqual(big, manager.find_larger('ndwi', 100, 60))
+        self.assertIsNone(manager.find_larger('ndwi', 300, 150))
+        self.assertIsNone(manager.find_larger('mndwi', 20, 10))
+        manager.remove(small)
+        self.assertIsNone(manager.find('ndwi', 100, 50))
+        self.assertEqual(big, manager.find_larger('ndwi', 80, 40))
+
+    def test_preview_eviction(self):
+        renders = []
+        def _renderer(index, width, height):
+            renders.append((index, width, height))
+            if len(renders) == 1:
+                raise PreviewBusyError(2)
+            return np.full((height, width), 7, dtype=np.uint8), np.ones((height, width), dtype=bool)
+
+        manager = PreviewManager(_renderer, budget=10000)
+        first = manager.add(np.full((50, 100), 7, dtype=np.uint8), 'ndwi', 100, 50, np.ones((50, 100), dtype=bool))
+        second = manager.add(np.full((50, 100), 9, dtype=np.uint8), 'mndwi', 100, 50)
+        self.assertEqual(1, manager.get_memory_stats()['resident'])
+        with self.assertRaises(PreviewBusyError) as busy:
+            manager.get(first)
+        self.assertEqual(2, busy.exception.retry_after)
+        self.assertEqual(first, manager.find('ndwi', 100, 50))
+        pv = manager.get(first)
+        self.assertEqual([('ndwi', 100, 50)] * 2, renders)
+        self.assertTrue(np.array_equal(np.full((50, 100), 7, dtype=np.uint8), pv.array))
+        self.assertEqual((100, 50), (pv.req_width, pv.req_height))
+        self.assertEqual({'previews': 2, 'resident': 1, 'evictions': 2, 'regenerations': 1}, {k: v for k, v in manager.get_memory_stats().items() if k in ('previews', 'resident', 'evictions', 'regenerations')})
+        manager.remove(second)
+        self.assertRaises(KeyError, manager.get, second)
+
+    def test_preview_finalize(self):
+        manager = PreviewManager()
+        coarse = manager.add(np.zeros((30, 60), dtype=np.uint8), 'ndwi', 600, 300, final=False)
+        self.assertTrue(manager.finalize(coarse))
+        self.assertTrue(manager.get(coarse).final)
+        self.assertIsNone(manager.find('ndwi', 600, 300))
+        manager.remove(coarse)
+        self.assertFalse(manager.finalize(coarse))
+
+        ex = GdalExecutor(proto)
+        missing = ex.pv_man.add(np.zeros((30, 60), dtype=np.uint8), 'ndwi', 600, 300, final=False)
+        ex._refine_preview(missing, 'ndwi', 600, 300)
+        self.assertTrue(ex.pv_man.get(missing).final)
+        def _fail(*args):
+            raise RuntimeError('read failed')
+        ex._preview_size = _fail
+        failed = ex.pv_man.add(np.zeros((30, 60), dtype=np.uint8), 'ndwi', 600, 300, final=False)
+        ex._refine_preview(failed, 'ndwi', 600, 300)
+        self.assertTrue(ex.pv_man.get(failed).final)
+
+    def test_preview_regenerate(self):
+        with tempfile.TemporaryDirectory() as directory:
+            ex = scene_executor(directory)
+            self.assertEqual(0, execute(ex, 'calc_index', index='ndwi')['status'])
+            response = execute(ex, 'calc_preview', index='ndwi', width=100, height=100)
+            self.assertEqual(0, response['status'])
+            id_ = response['result']['url']
+            pv = ex.pv_man.get(id_)
+            array, alpha = pv.array.copy(), pv.get_alpha()
+
+            ex.pv_man.set_budget(0)
+            self.assertEqual(0, ex.pv_man.get_memory_stats()['resident'])
+            ex.admission = AdmissionController(budget=1, wait=0.05)
+            running = ex.admission.estimate('calc_index', 1)
+            self.assertTrue(ex.admission.acquire(running))
+            self.assertRaises(PreviewBusyError, ex.pv_man.get, id_)
+            self.assertEqual(0, ex.pv_man.get_memory_stats()['resident'])
+            ex.admission.release(running)
+
+            ex.pv_man.set_budget(PreviewManager.DEFAULT_BUDGET)
+            pv = ex.pv_man.get(id_)
+            self.assertTrue(np.array_equal(array, pv.array))
+            self.assertTrue(np.array_equal(alpha, pv.get_alpha()))
+            self.assertEqual(1, ex.pv_man.get_memory_stats()['regenerations'])
+            execute(ex, 'end_session')
+
+    def test_encode_image(self):
+        img = Image.fromarray(np.arange(64, dtype=np.uint8).reshape(8, 8))
+        body = b''.join(encode_image(img, 'image/png'))
+        self.assertTrue(body.startswith(b'\x89PNG'))
+        self.assertEqual((8, 8), Image.open(io.BytesIO(body)).size)
+
+        class _Broken:
+            def save(self, fp, **params):
+                raise OSError('encoder failed')
+        self.assertRaises(OSError, encode_image, _Broken(), 'image/png')
+
+        class _Truncated:
+            def save(self, fp, **params):
+                fp.write(b'\x89PNG')
+                raise OSError('encoder failed')
+        body = encode_image(_Truncated(), 'image/png')
+        self.assertEqual(b'\x89PNG', next(body))
+        self.assertRaises(OSError, next, body)
+
+    def test_map_to_8bit(self):
+        array = np.ma.array(np.arange(100, dtype=np.uint8))
+        lut, index, hist, mask = indcal._stretch(array, 10, 4096)
+        self.assertEqual(257, len(lut))
+        self.assertEqual(100, hist.sum())
+        self.assertTrue(np.array_equal(np.arange(100), index))
+        ret = indcal.map_to_8bit(array, 10)
+        self.assertEqual(np.uint8, ret.dtype)
+        self.assertTrue((ret[:11] == 0).all())
+        self.assertTrue((ret[89:] == 255).all())
+        self.assertEqual(int((49 - 10) * 255 / (89 - 10)), ret[49])
+        self.assertTrue((np.diff(ret.astype(np.int32)) >= 0).all())
+        self.assertTrue(np.array_equal(np.arange(100) * 255 // 99, indcal.map_to_8bit(array).data))
+
+        array = np.ma.array(np.array([[0.5, np.nan, -1], [2, 0, 1]], dtype=np.float32), mask=[[False, False, False], [True, False, False]])
+        ret = indcal.map_to_8bit(array)
+        self.assertTrue(np.array_equal([[False, True, False], [True, False, False]], np.ma.getmaskarray(ret)))
+        self.assertTrue(np.array_equal([[191, 0, 0], [0, 127, 255]], ret.data))
+        ret = indcal.map_to_8bit(np.ma.array(np.full((3, 3), 0.3, dtype=np.float32)))
+        self.assertTrue((ret.data == 0).all())
+
+        dark = np.full((4, 4), 40, dtype=np.uint8)
+        self.assertTrue((indcal.normalize_brightness(dark) == int(40 * 128 / 40 * 0.4)).all())
+        mid = np.full((4, 4), 120, dtype=np.uint8)
+        self.assertIs(mid, indcal.normalize_brightness(mid))
+        valid = np.zeros((4, 4), dtype=bool)
+        valid[0, 0] = True
+        dark[0, 0] = 120
+        self.assertIs(dark, indcal.normalize_brightness(dark, valid))
+        alpha = np.ones((4, 4), dtype=bool)
+        alpha[3] = False
+        pv = Preview(np.full((4, 4), 40, dtype=np.uint8), 'ndwi', alpha=alpha)
+        self.assertTrue(np.array_equal(np.dstack((pv.array, alpha * 255)), np.asarray(pv.image())))
+        img = np.asarray(pv.image(normalize_brightness=True))
+        self.assertTrue((img[..., 0] == 51).all())
+        self.assertTrue(np.array_equal(alpha * 255, img[..., 1]))
+
+    def test_mask_overlay_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            ex = scene_executor(directory)
+            self.assertIsNone(ex.get_mask_overlay(80, 80))
+            self.assertEqual(0, execute(ex, 'calc_index', index='ndwi')['status'])
+            self.assertEqual(0, execute(ex, 'calc_index', index='water_mask')['status'])
+            old = ex.ds_man.find('water_mask')
+            overlay = ex.get_mask_overlay(80, 80)
+            self.assertIs(overlay, ex.get_mask_overlay(80, 80))
+            self.assertEqual([(old, 80, 80)], list(ex._mask_overlays))
+
+            # the mask is calculated again from another water index
+            ex.ds_man.close(old)
+            ex.ds_man.close(ex.ds_man.find('ndwi'))
+            self.assertEqual(0, execute(ex, 'calc_index', index='andwi')['status'])
+            self.assertEqual(0, execute(ex, 'calc_index', index='water_mask')['status'])
+            self.assertNotEqual(old, ex.ds_man.find('water_mask'))
+            self.assertEqual({}, ex._mask_overlays)
+            recalculated = ex.get_mask_overlay(80, 80)
+            self.assertIsNot(overlay, recalculated)
+            water = ex.get_water_mask(80, 80).filled(False)
+            self.assertTrue(np.array_equal(water, np.asarray(recalculated)[..., 3] > 0))
+            self.assertEqual([(ex.ds_man.find('water_mask'), 80, 80)], list(ex._mask_overlays))
+            execute(ex, 'end_session')
+
+    def test_label_components(self):
+        def _naive(mask, connectivity):
+            labels, count = np.zeros(mask.shape, dtype=np.int64), 0
+            steps = [(-1, 0), (1, 0), (0, -1), (0, 1)] + ([(-1, -1), (-1, 1), (1, -1), (1, 1)] if connectivity == 8 else [])
+            for start in zip(*np.nonzero(mask)):
+                if labels[start] > 0:
+                    continue
+                count += 1
+                labels[start], stack = count, [start]
+                while stack:
+                    y, x = stack.pop()
+                    for dy, dx in steps:
+                        ny, nx = y + dy, x + dx
+                        if 0 <= ny < mask.shape[0] and 0 <= nx < mask.shape[1] and mask[ny, nx] and labels[ny, nx] == 0:
+                            labels[ny, nx] = count
+                            stack.append((ny, nx))
+            return labels, count
+
+        # a diagonal line crosses tile corners, a U-shape is only closed in the tile below
+        mask = np.zeros((8, 8), dtype=bool)
+        mask[np.arange(6), np.arange(6)] = True
+        mask[5:8, 7] = True
+        labels, count = indcal.label_components(mask, tile_size=2)
+        self.assertEqual(2, count)
+        self.assertEqual({1}, set(labels[np.arange(6), np.arange(6)]))
+        labels, count = indcal.label_components(mask, connectivity=4, tile_size=2)
+        self.assertEqual(7, count)
+        u = np.zeros((6, 6), dtype=bool)
+        u[0:5, 1] = u[0:5, 4] = u[4, 1:5] = True
+        labels, count = indcal.label_components(u, connectivity=4, tile_size=3)
+        self.assertEqual(1, count)
+        self.assertTrue(np.array_equal(u, labels == 1))
+
+        # areas 1, 3 and 5
+        mask = np.zeros((5, 7), dtype=bool)
+        mask[0, 0] = True
+        mask[2, 2:5] = True
+        mask[0:5, 6] = True
+        labels, count = indcal.label_components(mask, min_area=3, tile_size=2)
+        self.assertEqual(2, count)
+        self.assertEqual(0, labels[0, 0])
+        self.assertEqual([3, 5], sorted(np.bincount(labels.ravel())[1:]))
+        self.assertEqual(3, indcal.label_components(mask, tile_size=2)[1])
+        self.assertEqual(0, indcal.label_components(mask, min_area=6)[1])
+        self.assertRaises(ValueError, indcal.label_components, mask, connectivity=6)
+
+        rng = np.random.default_rng(7)
+        for shape, tile_size in (((23, 17), 4), ((16, 16), 5), ((9, 31), 3), ((12, 12), 1024)):
+            mask = rng.random(shape) > 0.55
+            for connectivity in (4, 8):
+                labels, count = indcal.label_components(mask, connectivity=connectivity, tile_size=tile_size)
+                expected, expected_count = _naive(mask, connectivity)
+                self.assertEqual(expected_count, count)
+                self.assertEqual(set(range(1, count + 1)), set(labels[mask]))
+                # the same partition: every naive component maps to exactly one label and back
+                self.assertEqual(count, len(set(zip(expected[mask], labels[mask]))), f'{shape}, tile {tile_size}, connectivity {connectivity}')
+
+    def test_component_table(self):
+        labels = np.array([
+            [1, 1, 0, 0, 0],
+            [1, 0, 0, 2, 0],
+            [0, 0, 0, 2, 0],
+            [3, 0, 0, 2, 2],
+            [0, 0, 0, 0, 0]
+        ], dtype=np.uint32)
+        for tile_size in (2, 1024):
+            table = indcal.component_table(labels, 4, tile_size=tile_size)
+            self.assertEqual([3, 4, 1, 0], table['area'][1:].tolist())
+            self.assertEqual([0, 3, 0], table['xmin'][1:4].tolist())
+            self.assertEqual([0, 1, 3], table['ymin'][1:4].tolist())
+            self.assertEqual([1, 4, 0], table['xmax'][1:4].tolist())
+            self.assertEqual([1, 3, 3], table['ymax'][1:4].tolist())
+            self.assertTrue(np.allclose([1 / 3, 13 / 4, 0], table['x'][1:4]))
+            self.assertTrue(np.allclose([1 / 3, 9 / 4, 3], table['y'][1:4]))
+            self.assertTrue(np.isnan(table['x'][4]))
+
+    def test_timing_bind(self):
+        def _work(_):
+            with timing.span('inner'):
+                sleep(0.05)
+
+        timing.enable()
+        recorder = timing.begin('test')
+        with timing.span('outer'):
+            with ThreadPoolExecutor(2) as pool:
+                list(pool.map(timing.bind(_work), range(2)))
+        timing.finish(200)
+        timing.enable(False)
+        spans = recorder.to_dict()['spans']
+        self.assertEqual(2, spans['inner']['count'])
+        self.assertGreaterEqual(spans['inner']['seconds'], 0.1)
+        # both inner spans ran in parallel, so 0.05 s of the outer span are covered once
+        outer = spans['outer']
+        self.assertGreaterEqual(outer['own_seconds'], 0)
+        self.assertLess(outer['own_seconds'], outer['seconds'] - 0.04)
+        self.assertIsNone(timing.current())
+
+    def test_batch_find_scene(self):
+        with tempfile.TemporaryDirectory() as directory:
+            l1 = os.path.join(directory, 'LC09_L1TP_179021_20250610_20250610_02_T1')
+            l2 = os.path.join(directory, 'LC09_L2SP_179021_20250610_20250611_02_T1')
+            os.makedirs(l1)
+            os.makedirs(l2)
+            for name in ('LC09_L1TP_179021_20250610_20250610_02_T1_MTL.txt', 'LC09_L1TP_179021_20250610_20250610_02_T1_B1.TIF', 'lc09_l1tp_179021_20250610_20250610_02_t1_b2.tif',
+                         'other_SR_B3.TIF', 'other_ST_B10.TIF', 'LC09_L1TP_179021_20250610_20250610_02_T1_B10.TIF', 'LC09_L1TP_179021_20250610_20250610_02_T1_QA_PIXEL.TIF'):
+                open(os.path.join(l1, name), 'w').close()
+            for name in ('LC09_L2SP_179021_20250610_20250611_02_T1_MTL.txt', 'LC09_L2SP_179021_20250610_20250611_02_T1_SR_B1.TIF', 'LC09_L2SP_179021_20250610_20250611_02_T1_ST_B10.TIF',
+                         'LC09_L2SP_179021_20250610_20250611_02_T1_ST_QA.TIF'):
+                open(os.path.join(l2, name), 'w').close()
+
+            scene = batch.find_scene(l1)
+            self.assertEqual(('LC09_L1TP_179021_20250610_20250610_02_T1', 'L1TP'), (scene['name'], scene['proc_level']))
+            self.assertEqual(os.path.join(l1, 'LC09_L1TP_179021_20250610_20250610_02_T1_MTL.txt'), scene['mtl'])
+            # '_SR_B3' and '_ST_B10' are bands of Level 2 products and are not taken for B3 and B10
+            self.assertEqual({'1', '2', '10', 'QA_PIXEL'}, set(scene['bands']))
+            self.assertEqual(os.path.join(l1, 'lc09_l1tp_179021_20250610_20250610_02_t1_b2.tif'), scene['bands']['2'])
+            self.assertEqual(os.path.join(l1, 'LC09_L1TP_179021_20250610_20250610_02_T1_B10.TIF'), scene['bands']['10'])
+            scene = batch.find_scene(l2)
+            self.assertEqual('L2SP', scene['proc_level'])
+            self.assertEqual({'1': os.path.join(l2, 'LC09_L2SP_179021_20250610_20250611_02_T1_SR_B1.TIF'), '10': os.path.join(l2, 'LC09_L2SP_179021_20250610_20250611_02_T1_ST_B10.TIF')}, scene['bands'])
+
+            self.assertRaises(ValueError, batch.find_scene, directory)
+            open(os.path.join(l2, 'copy_MTL.txt'), 'w').close()
+            self.assertRaises(ValueError, batch.find_scene, l2)
+            other = os.path.join(directory, 'LT05_L1GS')
+            os.makedirs(other)
+            open(os.path.join(other, 'LT05_L1GS_179021_19900610_20200915_02_T2_MTL.txt'), 'w').close()
+            self.assertRaises(ValueError, batch.find_scene, other)
+            scenes, errors = batch.find_scenes([os.path.join(directory, '*')])
+            self.assertEqual([os.path.basename(l1)], [scene['name'] for scene in scenes])
+            self.assertEqual(2, len(errors))
+
+    def test_batch_failed_scene(self):
+        with tempfile.TemporaryDirectory() as output:
+            # a scene without bands makes 'process_scene' raise KeyError in the worker
+            scene = {'name': 'broken', 'dir': output, 'proc_level': 'L2SP', 'mtl': None}
+            done, failed = batch.run_batch([scene], ['ndwi'], output, 1)
+            self.assertEqual([], done)
+            self.assertEqual(1, len(failed))
+            self.assertEqual('broken', failed[0]['scene'])
+            self.assertTrue(failed[0]['error'].startswith('KeyError'))
+            self.assertIsNone(batch.load_marker(output, scene, ['ndwi']))
+
+    def test_batch_memory_watchdog(self):
+        watchdog = batch._MemoryWatchdog(1)
+        sleep(batch.WATCHDOG_INTERVAL * 3)
+        self.assertRaises(MemoryError, watchdog.check)
+        watchdog.reset()
+        watchdog.limit = 1 << 50
+        sleep(batch.WATCHDOG_INTERVAL * 3)
+        watchdog.check()
+        watchdog.limit = 1
+        batch._watchdog = watchdog
+        try:
+            self.assertRaises(MemoryError, batch._check, {'status': 0, 'result': {}}, 'PING')
+        finally:
+            batch._watchdog = None
+
+    def test_batch_order_indices(self):
+        self.assertEqual(['ndwi', 'andwi', 'water_mask'], batch.order_indices(['water_mask', 'ndwi', 'ndwi', 'andwi', 'water_mask']))
+        self.assertEqual(['ndwi', 'oc3'], batch.order_indices(['ndwi', 'oc3', 'ndwi']))
+        self.assertEqual([], batch.order_indices([]))
+
+    def test_batch_load_marker(self):
+        with tempfile.TemporaryDirectory() as output:
+            scene = {'name': 'scene'}
+            self.assertIsNone(batch.load_marker(output, scene, ['ndwi']))
+            os.makedirs(os.path.join(output, 'scene'))
+            marker = {'scene': 'scene', 'dir': '/data/scene', 'proc_level': 'L2SP', 'seconds': 1.0, 'indices': {
+                'ndwi': {'file': 'ndwi.tif', 'min': -1.0, 'max': 1.0, 'mean': 0.0, 'stdev': 0.5, 'ph_unit': None},
+                'water_mask': {'file': 'water_mask.tif', 'min': 0, 'max': 2, 'mean': 1.0, 'stdev': 0.5, 'ph_unit': None}
+            }}
+            with open(os.path.join(output, 'scene', batch.MARKER_FILE), 'w', encoding='utf-8') as f:
+                json.dump(marker, f)
+            open(os.path.join(output, 'scene', 'ndwi.tif'), 'w').close()
+            self.assertEqual(marker, batch.load_marker(output, scene, ['ndwi']))
+            # a file is missing
+            self.assertIsNone(batch.load_marker(output, scene, ['ndwi', 'water_mask']))
+            open(os.path.join(output, 'scene', 'water_mask.tif'), 'w').close()
+            self.assertEqual(marker, batch.load_marker(output, scene, ['ndwi', 'water_mask']))
+            # an index was not calculated
+            self.assertIsNone(batch.load_marker(output, scene, ['ndwi', 'andwi']))
+            with open(os.path.join(output, 'scene', batch.MARKER_FILE), 'w', encoding='utf-8') as f:
+                f.write('{"scene": "scene", "indices": ')
+            self.assertIsNone(batch.load_marker(output, scene, ['ndwi']))
+
+    def test_timeseries_indices(self):
+        self.assertEqual(['oc3'], timeseries.scene_indices('oc3'))
+        self.assertEqual(['ndwi', 'water_mask', 'oc3'], timeseries.scene_indices('oc3', 'ndwi'))
+        # 'wi2015' would be taken for the water mask if it was calculated before it
+        self.assertEqual(['ndwi', 'water_mask', 'wi2015'], timeseries.scene_indices('wi2015', 'ndwi'))
+        self.assertEqual(['ndwi', 'water_mask'], timeseries.scene_indices('ndwi', 'ndwi'))
+
+    def test_timeseries_statistics(self):
+        nan = np.nan
+        tile = np.array([
+            [1, nan, nan, 1, 5],
+            [3, 2, nan, nan, 5],
+            [5, nan, nan, 5, 5],
+            [7, 4, nan, 7, 5]
+        ], dtype=np.float32).reshape(4, 1, 5)
+        stats = timeseries.tile_statistics(tile, np.array([0, 1, 2, 3]))
+        self.assertEqual([4, 2, 0, 3, 4], stats['count'][0].tolist())
+        self.assertEqual(np.uint16, stats['count'].dtype)
+        self.assertTrue(np.allclose([4, 3, nan, 13 / 3, 5], stats['mean'][0], equal_nan=True))
+        self.assertTrue(np.allclose([4, 3, nan, 5, 5], stats['median'][0], equal_nan=True))
+        # 2 dates are less than MIN_TREND_DATES, a constant pixel has no trend
+        self.assertTrue(np.allclose([2, nan, nan, 2, 0], stats['trend'][0], equal_nan=True))
+        stats = timeseries.tile_statistics(tile, np.array([0, 0.5, 1, 1.5]))
+        self.assertTrue(np.isclose(4, stats['trend'][0, 0]))
+
+        water = np.array([
+            [2, 0, 0, 1],
+            [2, 2, 0, 1],
+            [1, 0, 0, 0]
+        ], dtype=np.uint8).reshape(3, 1, 4)
+        self.assertTrue(np.allclose([2 / 3, 1, nan, 0], timeseries.water_frequency(water)[0], equal_nan=True))
+
+    def test_timeseries_build_stack(self):
+        def _raster(file, x, y, pixel=30):
+            ds = gdal.GetDriverByName('GTiff').Create(file, 4, 4, 1, gdal.GDT_Float32)
+            srs = osr.SpatialReference()
+            srs.ImportFromEPSG(32637)
+            ds.SetProjection(srs.ExportToWkt())
+            ds.SetGeoTransform((x, pixel, 0, y, 0, -pixel))
+            ds.GetRasterBand(1).SetNoDataValue(float('nan'))
+            ds.GetRasterBand(1).WriteArray(np.ones((4, 4), dtype=np.float32))
+            ds = None
+            return file
+
+        with tempfile.TemporaryDirectory() as directory:
+            first = _raster(os.path.join(directory, 'a.tif'), 500000, 6000000)
+            # one whole pixel to the east is on the same grid
+            second = _raster(os.path.join(directory, 'b.tif'), 500030, 6000000)
+            dates = [datetime.date(2024, 6, 1), datetime.date(2025, 6, 1)]
+            stack = timeseries.build_stack([first, second], dates, os.path.join(directory, 'stack.vrt'))
+            self.assertEqual((5, 4, 2), (stack.RasterXSize, stack.RasterYSize, stack.RasterCount))
+            self.assertEqual(['2024-06-01', '2025-06-01'], [stack.GetRasterBand(i + 1).GetDescription() for i in range(2)])
+            stack = None
+            shifted = _raster(os.path.join(directory, 'c.tif'), 500015, 6000000)
+            self.assertRaises(ValueError, timeseries.build_stack, [first, shifted], dates, os.path.join(directory, 'shifted.vrt'))
+            coarse = _raster(os.path.join(directory, 'd.tif'), 500000, 6000000, 60)
+            self.assertRaises(ValueError, timeseries.build_stack, [first, coarse], dates, os.path.join(directory, 'coarse.vrt'))
+
     ### DIFFERENT FILES ###
 
     # def test_calc_preview_files(self):